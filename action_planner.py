@@ -0,0 +1,161 @@
+from heapq import heapify, heappush, heappop
+from file_action import FileAction
+from os_abstraction import IOSAbstraction
+
+
+class PlannedOperation:
+    """
+    A single operation on the filesystem, derived from a target of an index entry.
+    Operations breaking a cycle of renames are split in two: a move of the source
+    to a temporary name, and a move from the temporary name to the target.
+    """
+
+    WHOLE = 0           # The operation as specified by the user
+    TO_TEMPORARY = 1    # First half of a split rename
+    FROM_TEMPORARY = 2  # Second half of a split rename
+
+    __slots__ = ("entry", "action", "source", "target", "target_name", "part",
+                 "partner", "seq", "_successors", "_predecessors", "_pending")
+
+    def __init__(self, entry, action, source, target, seq):
+        self.entry = entry
+        self.action = action
+        self.source = source
+        self.target = target
+        # Target name as specified in the entry, kept there if the operation fails
+        self.target_name = target
+        self.part = self.WHOLE
+        self.partner = None
+        self.seq = seq
+        self._successors = []
+        self._predecessors = []
+        self._pending = 0
+
+    def __lt__(self, other):
+        return self.seq < other.seq
+
+    def __str__(self):
+        return "%c %s -> %s" % (self.action, self.source, self.target)
+
+    def get_predecessors(self):
+        """
+        Returns the operations that have to be done before this one.
+        """
+        return self._predecessors
+
+    def vacates_source(self):
+        return self.action in [FileAction.RENAME_MOVE, FileAction.DELETE]
+
+    def _add_successor(self, op):
+        self._successors.append(op)
+        op._predecessors.append(self)
+        op._pending += 1
+
+
+def _collect_operations(entries):
+    operations = []
+    for entry in entries:
+        entry_ops = []
+        for target_name, action in entry.target_names:
+            if action in [FileAction.RENAME_MOVE, FileAction.COPY, FileAction.LINK] \
+                    and entry.current_name != target_name:
+                entry_ops.append(PlannedOperation(entry, action, entry.current_name, target_name, len(operations)))
+            elif action == FileAction.DELETE:
+                entry_ops.append(PlannedOperation(entry, action, entry.current_name, None, len(operations)))
+            else:
+                continue
+            operations.append(entry_ops[-1])
+
+        # Copies and links of the file have to be made before it is moved away or deleted
+        vacating = [op for op in entry_ops if op.vacates_source()]
+        if len(vacating) > 0:
+            for op in entry_ops:
+                if not op.vacates_source():
+                    op._add_successor(vacating[0])
+    return operations
+
+
+def _is_on_cycle(op):
+    """
+    Checks whether the operation is reachable from itself through operations
+    not executed yet.
+    """
+    visited = set()
+    stack = list(op._successors)
+    while stack:
+        current = stack.pop()
+        if current is op:
+            return True
+        if current._pending > 0 and id(current) not in visited:
+            visited.add(id(current))
+            stack.extend(current._successors)
+    return False
+
+
+def plan_operations(entries: list, os: IOSAbstraction):
+    """
+    Orders the operations of the entries so that each file is moved away or deleted
+    before another file is put in its place, and the copies and links of a file are
+    made before it is moved away. Cycles of renames (like swapping the names of two
+    files) are broken by moving one of the files to a temporary name first.
+    Apart from that, the order given by the entries is kept.
+
+    Returns:
+    list:PlannedOperation objects in the order of execution
+    """
+    operations = _collect_operations(entries)
+
+    vacated_by = {}
+    for op in operations:
+        if op.vacates_source() and op.source not in vacated_by:
+            vacated_by[op.source] = op
+
+    for op in operations:
+        if op.target is not None and op.target in vacated_by:
+            blocker = vacated_by[op.target]
+            if blocker.entry is not op.entry:
+                blocker._add_successor(op)
+
+    ready = [op for op in operations if op._pending == 0]
+    heapify(ready)
+    cycle_candidates = iter(operations)
+    result = []
+    seq = len(operations)
+
+    while len(result) < len(operations):
+        if len(ready) == 0:
+            op = next((op for op in cycle_candidates
+                       if op._pending > 0 and op.action == FileAction.RENAME_MOVE and _is_on_cycle(op)), None)
+            if op is None:
+                # Dependencies that cannot be resolved by renaming; fall back to the original order
+                result += sorted(op for op in operations if op._pending > 0)
+                break
+
+            # Split the rename: the source goes to a temporary name right away, and
+            # the move to the target waits for the target to be vacated
+            second = PlannedOperation(op.entry, op.action, None, op.target, seq)
+            second.part = PlannedOperation.FROM_TEMPORARY
+            seq += 1
+            op.target = os.make_temporary_name(op.source)
+            op.part = PlannedOperation.TO_TEMPORARY
+            op.partner = second
+            second.partner = op
+            second.source = op.target
+            second._pending = op._pending
+            second._predecessors = op._predecessors
+            op._pending = 0
+            op._predecessors = []
+            for predecessor in second._predecessors:
+                predecessor._successors = [second if successor is op else successor
+                                           for successor in predecessor._successors]
+            operations.append(second)
+            heappush(ready, op)
+
+        op = heappop(ready)
+        result.append(op)
+        for successor in op._successors:
+            successor._pending -= 1
+            if successor._pending == 0:
+                heappush(ready, successor)
+
+    return result
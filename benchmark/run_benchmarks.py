@@ -0,0 +1,326 @@
+import getopt
+import io
+import json
+import os
+import platform
+import re
+import tempfile
+from contextlib import contextmanager, redirect_stdout
+from sys import argv
+from threading import Thread
+from time import perf_counter
+
+import console_output
+from benchmark.tree_generator import TreeGenerator, SIZE_DISTRIBUTIONS
+from configuration import Configuration
+from extension_handler import use_extension
+from file_index import FileIndex
+from ifstool import execute_actions, postproc_worker, parse_number
+from os_abstraction import OSAbstraction, get_file_list_recursive
+from tree_walker import TreeWalker
+
+BASELINE_FORMAT_VERSION = 1
+DEFAULT_REPEATS = 3
+DEFAULT_THRESHOLD = 1.2
+
+ALL_USER_INPUT_PHASES = ["generate_user_input", "handle_user_input", "execute_actions"]
+ALL_PHASES = ["walk", "index_add", "postprocess_df", "postprocess_cadf_audio"] + ALL_USER_INPUT_PHASES
+
+# Lines of the editor input describing the files
+_ENTRY_LINE = re.compile(r"^(\d+ r\s+)(.*)$")
+
+
+@contextmanager
+def _quiet():
+    """
+    Hides the console output of the code measured, which would dominate the
+    results otherwise.
+    """
+    with open(os.devnull, "w") as devnull:
+        saved_stdout = console_output.stdout
+        console_output.stdout = devnull
+        try:
+            with redirect_stdout(devnull):
+                yield
+        finally:
+            console_output.stdout = saved_stdout
+
+
+def _create_index(config, extensions=None):
+    os_abs = OSAbstraction(config)
+    if extensions is None:
+        extensions = []
+    for extension in extensions:
+        use_extension(config, os_abs, extension)
+    for extension in config.extensions_chain:
+        extension.on_config_complete(config)
+    return FileIndex(config, os_abs), os_abs
+
+
+def _build_index(file_index, config, root):
+    workers = [Thread(target=postproc_worker, args=(file_index, i)) for i in range(config.postprocess_num_threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        file_index.add(TreeWalker(order=config.walk_order).walk_all([], [root]))
+    finally:
+        file_index.close_postprocess_queue()
+    for worker in workers:
+        worker.join()
+    for extension in config.extensions_chain:
+        extension.on_index_complete(file_index)
+
+
+def bench_walk(root):
+    return len(list(get_file_list_recursive(root, False)))
+
+
+def bench_index_add(root):
+    config = Configuration()
+    file_index, _ = _create_index(config)
+    _build_index(file_index, config, root)
+    return file_index.get_size()
+
+
+def bench_postprocess_df(root):
+    config = Configuration()
+    file_index, _ = _create_index(config, ["df"])
+    _build_index(file_index, config, root)
+    return file_index.get_postprocess_total()
+
+
+def bench_postprocess_cadf_audio(root):
+    config = Configuration()
+    file_index, _ = _create_index(config, ["cadf.audio"])
+    _build_index(file_index, config, root)
+    return file_index.get_postprocess_total()
+
+
+class _UserInputBenchmark:
+    """
+    Prepares an index outside of the measured code, and measures the phases
+    working on the editor input.
+    """
+
+    def __init__(self, root):
+        self._config = Configuration()
+        self._config.simulation_mode = True
+        self._config.prompt_on_actions = False
+        self._file_index, self._os_abs = _create_index(self._config)
+        _build_index(self._file_index, self._config, root)
+        self._entries = None
+
+    def generate_user_input(self):
+        stream = io.StringIO()
+        self._file_index.write_user_input(stream)
+        self._user_input = stream.getvalue().splitlines()
+        return self._file_index.get_size()
+
+    def handle_user_input(self):
+        edited = [_ENTRY_LINE.sub(r"\1\2.renamed", line) for line in self._user_input]
+        self._entries = self._file_index.handle_user_input(edited)
+        return len(self._entries)
+
+    def execute_actions(self):
+        ops_done, _ = execute_actions(self._file_index, self._os_abs, self._config, self._entries)
+        return ops_done
+
+
+def _measure(function, repeats):
+    best = None
+    items = 0
+    for _ in range(repeats):
+        with _quiet():
+            start = perf_counter()
+            items = function()
+            elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "seconds": best,
+        "items": items,
+        "items_per_second": items / best if best > 0 else None
+    }
+
+
+def run_benchmarks(root, repeats=DEFAULT_REPEATS, phases=None):
+    """
+    Measures the phases of ifstool on the tree given. The best time of the
+    repeated runs is reported for each phase.
+
+    Returns:
+    dict:Results of the phases, by the phase name
+    """
+    results = {}
+
+    def measure(name, function, phase_repeats=repeats):
+        if phases is None or name in phases:
+            results[name] = _measure(function, phase_repeats)
+
+    measure("walk", lambda: bench_walk(root))
+    measure("index_add", lambda: bench_index_add(root))
+    measure("postprocess_df", lambda: bench_postprocess_df(root))
+    measure("postprocess_cadf_audio", lambda: bench_postprocess_cadf_audio(root))
+
+    if phases is None or len(set(phases) & set(ALL_USER_INPUT_PHASES)) > 0:
+        # The phases modify the index, so each repetition needs a fresh one
+        for _ in range(repeats):
+            with _quiet():
+                user_input = _UserInputBenchmark(root)
+            for name in ALL_USER_INPUT_PHASES:
+                if phases is None or name in phases:
+                    result = _measure(getattr(user_input, name), 1)
+                    if name not in results or result["seconds"] < results[name]["seconds"]:
+                        results[name] = result
+                else:
+                    getattr(user_input, name)()
+    return results
+
+
+def compare_results(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares the results with the baseline.
+
+    Returns:
+    list:Tuples of the phase name, baseline time, current time and the flag telling
+         if the phase is slower than the baseline by more than the threshold
+    """
+    comparison = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_seconds = baseline[name]["seconds"]
+        regression = result["seconds"] > baseline_seconds * threshold
+        comparison.append((name, baseline_seconds, result["seconds"], regression))
+    return comparison
+
+
+def display_help():
+    print("""IFSTool benchmarks
+Generates a synthetic directory tree and measures the phases of ifstool on it.
+USAGE: python -m benchmark.run_benchmarks [options]\n
+Options available:
+  -b, --baseline=path         Compare the results with the baseline saved before. Exits with
+                              status 2 if any phase is slower than the threshold allows.
+  -o, --output=path           Save the results as a baseline, in JSON format.
+  -p, --phases=list           Comma-separated list of phases to measure (default: all):
+                              %s
+  -r, --repeats=N             Number of repetitions of each phase (default: %d).
+  -t, --threshold=ratio       Slowdown against the baseline considered a regression (default: %.1f).
+  -T, --tree=path             Use an existing directory tree instead of generating one.
+Parameters of the generated tree:
+      --depth=N               Levels of subdirectories (default: 3).
+      --fan-out=N             Subdirectories in each directory (default: 4).
+      --files=N               Number of files (default: 1000).
+      --min-size=bytes        Minimum size of a file (default: 0).
+      --max-size=bytes        Maximum size of a file (default: 65536).
+      --size-distribution=d   Distribution of file sizes: %s (default: uniform).
+      --duplicates=ratio      Fraction of files being duplicates of other files (default: 0.1).
+      --mp3=ratio             Fraction of files being MP3 files (default: 0.0).
+      --seed=N                Seed of the random generator (default: 0).
+""" % (", ".join(ALL_PHASES), DEFAULT_REPEATS, DEFAULT_THRESHOLD, ", ".join(SIZE_DISTRIBUTIONS)))
+    exit(1)
+
+
+def run(args):
+    generator = TreeGenerator()
+    tree = None
+    baseline_file = None
+    output_file = None
+    phases = None
+    repeats = DEFAULT_REPEATS
+    threshold = DEFAULT_THRESHOLD
+
+    options, _ = getopt.gnu_getopt(args, "b:o:p:r:t:T:", [
+        "baseline=", "output=", "phases=", "repeats=", "threshold=", "tree=",
+        "depth=", "fan-out=", "files=", "min-size=", "max-size=", "size-distribution=",
+        "duplicates=", "mp3=", "seed=", "help"])
+
+    for option, value in options:
+        if option in ['-b', '--baseline']:
+            baseline_file = value
+        if option in ['-o', '--output']:
+            output_file = value
+        if option in ['-p', '--phases']:
+            phases = value.split(',')
+            for phase in phases:
+                if phase not in ALL_PHASES:
+                    console_output.print_error("Incorrect phase: %s" % phase)
+                    exit(1)
+        if option in ['-r', '--repeats']:
+            repeats = parse_number(option, value, 1)
+        if option in ['-t', '--threshold']:
+            threshold = parse_number(option, value, 0, float)
+        if option in ['-T', '--tree']:
+            tree = value
+        if option in ['--depth']:
+            generator.depth = parse_number(option, value, 0)
+        if option in ['--fan-out']:
+            generator.fan_out = parse_number(option, value, 1)
+        if option in ['--files']:
+            generator.num_files = parse_number(option, value, 0)
+        if option in ['--min-size']:
+            generator.min_size = parse_number(option, value, 0)
+        if option in ['--max-size']:
+            generator.max_size = parse_number(option, value, 0)
+        if option in ['--size-distribution']:
+            if value not in SIZE_DISTRIBUTIONS:
+                console_output.print_error("Incorrect size distribution: %s" % value)
+                exit(1)
+            generator.size_distribution = value
+        if option in ['--duplicates']:
+            generator.duplicate_ratio = parse_number(option, value, 0, float, 1)
+        if option in ['--mp3']:
+            generator.mp3_ratio = parse_number(option, value, 0, float, 1)
+        if option in ['--seed']:
+            generator.seed = parse_number(option, value, None)
+        if option in ['--help']:
+            display_help()
+
+    report = {
+        "version": BASELINE_FORMAT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": repeats
+    }
+
+    with tempfile.TemporaryDirectory(prefix="ifstool-bench-") as temp_dir:
+        if tree is None:
+            tree = temp_dir
+            console_output.print_message("Generating the tree in %s" % tree)
+            report["tree"] = generator.get_params()
+            report["tree"].update(generator.generate(tree))
+        else:
+            report["tree"] = {"path": os.path.abspath(tree)}
+
+        results = run_benchmarks(tree, repeats, phases)
+
+    report["results"] = results
+    for name, result in results.items():
+        console_output.print_message("%-24s %10.4f s %10d items %12.1f items/s" % (
+            name, result["seconds"], result["items"], result["items_per_second"] or 0))
+
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline.get("tree") != report["tree"]:
+            console_output.print_warning("The baseline has been measured on a different tree")
+
+        regressions = 0
+        for name, baseline_seconds, seconds, regression in compare_results(baseline["results"], results, threshold):
+            message = "%-24s %10.4f s -> %10.4f s (%+.1f%%)" % (
+                name, baseline_seconds, seconds, (seconds / baseline_seconds - 1) * 100 if baseline_seconds > 0 else 0)
+            if regression:
+                console_output.print_error(message)
+                regressions += 1
+            else:
+                console_output.print_message(message)
+        if regressions > 0:
+            exit(2)
+
+
+if __name__ == "__main__":
+    run(argv[1:])
@@ -0,0 +1,123 @@
+import os
+import random
+
+
+SIZE_DISTRIBUTIONS = ["uniform", "lognormal"]
+
+ID3v2_TAG_SIZE = 1024
+ID3v1_TAG_SIZE = 128
+MP3_FRAME_HEADER = b'\xff\xfb\x90\x64'
+
+
+def _syncsafe(value):
+    return bytes([(value >> 21) & 0x7F, (value >> 14) & 0x7F, (value >> 7) & 0x7F, value & 0x7F])
+
+
+def _make_mp3(rng, audio):
+    """
+    Wraps the audio data into an MP3-like file, with ID3v2 and ID3v1 tags of
+    random content, so that the copies of the same audio differ only in tags.
+    """
+    tag = rng.randbytes(ID3v2_TAG_SIZE)
+    id3v2 = b'ID3\x03\x00\x00' + _syncsafe(len(tag)) + tag
+    id3v1 = b'TAG' + rng.randbytes(ID3v1_TAG_SIZE - 3)
+    return id3v2 + MP3_FRAME_HEADER + audio + id3v1
+
+
+def _make_directories(root, depth, fan_out):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fan_out):
+                directory = os.path.join(parent, "dir%03d" % i)
+                os.mkdir(directory)
+                next_level.append(directory)
+        directories += next_level
+        level = next_level
+    return directories
+
+
+class TreeGenerator:
+    """
+    Generates a directory tree with files of random content, for benchmarking.
+    The same parameters and seed always give the same tree.
+
+    Parameters:
+    depth: Number of levels of subdirectories below the root
+    fan_out: Number of subdirectories in each directory
+    num_files: Number of files, spread evenly across all the directories
+    min_size, max_size: Range of the file sizes, in bytes
+    size_distribution: "uniform", or "lognormal" for many small files and a few big ones
+    duplicate_ratio: Fraction of the files being copies of another file
+    mp3_ratio: Fraction of the files being MP3 files. The duplicates of MP3 files
+               have the same audio data, but different tags.
+    seed: Seed of the random number generator
+    """
+
+    def __init__(self, depth=3, fan_out=4, num_files=1000, min_size=0, max_size=65536,
+                 size_distribution="uniform", duplicate_ratio=0.1, mp3_ratio=0.0, seed=0):
+        assert(size_distribution in SIZE_DISTRIBUTIONS)
+        self.depth = depth
+        self.fan_out = fan_out
+        self.num_files = num_files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size_distribution = size_distribution
+        self.duplicate_ratio = duplicate_ratio
+        self.mp3_ratio = mp3_ratio
+        self.seed = seed
+
+    def get_params(self):
+        return dict(vars(self))
+
+    def _random_size(self, rng):
+        if self.size_distribution == "uniform":
+            return rng.randint(self.min_size, self.max_size)
+        # Median at 1/16 of the maximum size
+        size = int(rng.lognormvariate(0, 1.5) * (self.max_size - self.min_size) / 16) + self.min_size
+        return min(size, self.max_size)
+
+    def generate(self, root):
+        """
+        Creates the tree in the directory given, which has to exist.
+
+        Returns:
+        dict:Numbers of the directories, files and duplicates created, and the
+             total size of the files
+        """
+        rng = random.Random(self.seed)
+        directories = _make_directories(root, self.depth, self.fan_out)
+        originals = []
+        num_duplicates = 0
+        total_size = 0
+
+        for i in range(self.num_files):
+            # Only the seeds of the contents are kept, so that the memory usage
+            # does not depend on the size of the tree
+            if len(originals) > 0 and rng.random() < self.duplicate_ratio:
+                content_seed, size, is_mp3 = rng.choice(originals)
+                num_duplicates += 1
+            else:
+                content_seed, size, is_mp3 = rng.getrandbits(64), self._random_size(rng), rng.random() < self.mp3_ratio
+                originals.append((content_seed, size, is_mp3))
+            content = random.Random(content_seed).randbytes(size)
+
+            if is_mp3:
+                data = _make_mp3(rng, content)
+                name = "file%06d.mp3" % i
+            else:
+                data = content
+                name = "file%06d.bin" % i
+
+            with open(os.path.join(directories[i % len(directories)], name), "wb") as f:
+                f.write(data)
+            total_size += len(data)
+
+        return {
+            "directories": len(directories),
+            "files": self.num_files,
+            "duplicates": num_duplicates,
+            "total_size": total_size
+        }
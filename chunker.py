@@ -0,0 +1,84 @@
+import os
+
+
+CHUNK_BY_COUNT = "count"
+CHUNK_BY_DIRECTORY = "dir"
+CHUNK_BY_GROUP = "group"
+ALL_CHUNK_MODES = [CHUNK_BY_COUNT, CHUNK_BY_DIRECTORY, CHUNK_BY_GROUP]
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def _split(entries, size):
+    for start in range(0, len(entries), size):
+        yield entries[start:start + size]
+
+
+def _get_top_level_directory(name, roots):
+    """
+    Returns the directory directly below the scanned root directory that
+    contains the file, or the root itself for the files placed directly in it.
+    """
+    for root in roots:
+        prefix = os.path.join(root, "")
+        if name.startswith(prefix):
+            rest = name[len(prefix):]
+            pos = rest.find(os.sep)
+            return os.path.join(root, rest[:pos]) if pos != -1 else root
+    return os.path.dirname(name)
+
+
+def split_into_chunks(entries, mode, size=DEFAULT_CHUNK_SIZE, roots=[]):
+    """
+    Splits the entries into chunks edited in separate editor sessions. The
+    order of the entries is kept within the chunks.
+
+    Parameters:
+    entries: Entries in the order of presentation (grouped entries first)
+    mode: CHUNK_BY_COUNT - consecutive entries, up to size entries per chunk
+          CHUNK_BY_DIRECTORY - entries under the same top-level directory,
+                               split further if there are more than size of them
+          CHUNK_BY_GROUP - whole groups, as many as fit in size entries (a group
+                           bigger than that is not split); ungrouped entries
+                           are split by count
+    size: Maximum number of entries in a chunk
+    roots: Scanned directories, used to tell the top-level directories
+
+    Returns:
+    list:Lists of entries
+    """
+    assert(mode in ALL_CHUNK_MODES)
+    entries = list(entries)
+    if mode == CHUNK_BY_COUNT:
+        return list(_split(entries, size))
+
+    if mode == CHUNK_BY_DIRECTORY:
+        # Longer roots first, so that nested roots are matched before their parents
+        roots = sorted((root.rstrip(os.sep) or os.sep for root in roots), key=len, reverse=True)
+        by_directory = {}
+        for entry in entries:
+            by_directory.setdefault(_get_top_level_directory(entry.current_name, roots), []).append(entry)
+        return [chunk for directory_entries in by_directory.values() for chunk in _split(directory_entries, size)]
+
+    chunks = []
+    current = []
+    ungrouped = []
+    group_id = None
+    group = []
+    for entry in entries + [None]:
+        if entry is not None and entry.get_group_id() is None:
+            ungrouped.append(entry)
+            continue
+        if entry is not None and entry.get_group_id() == group_id:
+            group.append(entry)
+            continue
+
+        # A group has ended
+        if len(current) > 0 and len(current) + len(group) > size:
+            chunks.append(current)
+            current = []
+        current += group
+        group_id = entry.get_group_id() if entry is not None else None
+        group = [entry] if entry is not None else []
+    if len(current) > 0:
+        chunks.append(current)
+    return chunks + list(_split(ungrouped, size))
@@ -1,4 +1,10 @@
 from file_action import FileAction
+from tree_walker import TreeWalker
+from walk_filter import WalkFilter
+from file_check import FileCheck
+from hash_cache import HashCache
+from journal import Journal
+from chunker import DEFAULT_CHUNK_SIZE
 
 class Configuration:
     def __init__(self):
@@ -10,6 +16,30 @@ class Configuration:
         self.multistage_mode = False
         self.create_directories = False
         self.allow_overwriting = False
+        self.preserve_metadata = False
+        self.stat_cache_ttl = 60
+        self.show_stats = False
+        self.stats_file = None
         self.postprocess_num_threads = 2
+        self.use_process_pool = False
+        self.postprocess_queue_size = 4096
+        self.walk_order = TreeWalker.DEPTH_FIRST
+        self.scan_num_threads = 1
+        self.walk_filter = WalkFilter()
+        self.file_checks = list(FileCheck.ALL_CHECKS)
+        self.hash_cache_file = None
+        self.hash_cache_limit = HashCache.DEFAULT_LIMIT
+        self.hash_cache = None
+        self.snapshot_file = None
+        self.journal_file = None
+        self.journal_sync_interval = Journal.DEFAULT_SYNC_INTERVAL
+        self.discard_journal = False
+        self.resume_mode = False
+        self.undo_mode = False
+        self.dump_plan_file = None
+        self.apply_plan_file = None
+        self.plan_format = "text"
+        self.chunk_mode = None
+        self.chunk_size = DEFAULT_CHUNK_SIZE
         self.extensions_chain = []
 
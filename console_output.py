@@ -3,6 +3,15 @@ from sys import stdout
 _last_line_is_status = False
 
 
+def use_stream(stream):
+    """
+    Makes all the messages go to the stream given (eg. standard error, when
+    the standard output is used for data).
+    """
+    global stdout
+    stdout = stream
+
+
 def _ansi_cseq(*args):
     for s in args:
         stdout.write("\x1b[%s" % s)
@@ -25,7 +34,7 @@ def print_message(message, formatting=None):
         _reset_current_line()
     if formatting is not None:
         _format(formatting)
-    print(message)
+    print(message, file=stdout)
     _last_line_is_status = False
 
 
@@ -57,6 +57,33 @@ class Extension:
         """
         return None
 
+    def on_config_complete(self, config):
+        """
+        Invoked once all the command-line options are parsed, before any file
+        is added to the index.
+
+        Parameters:
+        config: Configuration object of the application
+        """
+        pass
+
+    def before_directory_entered(self, dirname):
+        """
+        Invoked for each directory encountered while walking the directory tree,
+        before it is entered. Allows to skip whole subtrees, so that none of the
+        files below them is even listed.
+
+        May be invoked from several threads at once when the directories are
+        listed in parallel, and more than once for the same directory.
+
+        Parameters:
+        dirname: Path of the directory
+
+        Returns:
+        True if the directory is to be entered. False if it has to be skipped.
+        """
+        return True
+
     def before_file_added(self, filename):
         """
         Invoked for each file encountered before its entry is created and added
@@ -78,12 +105,80 @@ class Extension:
         """
         pass
 
+    def on_process_safety_query(self):
+        """
+        Tells whether the post-processing of files done by the extension can be
+        run in a worker process (see analyze_file).
+
+        Returns:
+        bool:True if analyze_file can be run in a worker process
+        """
+        return False
+
+    def analyze_file(self, entry):
+        """
+        Part of the post-processing that can be run in a worker process, when the
+        process pool is in use and the extension declares itself process-safe.
+        The entry is then a detached copy of the index entry, and the extension
+        object is a copy of the one in the main process, made when the pool was
+        started.
+
+        The default implementation runs after_file_added on the entry and collects
+        the group, metadata and remarks it has assigned.
+
+        Returns:
+        A picklable object, passed to apply_file_analysis in the main process
+        """
+        self.after_file_added(entry)
+        return (entry.get_group_id(), entry.metadata, entry.remarks)
+
+    def on_analysis_version_query(self):
+        """
+        Tells the version of the analysis done by analyze_file, to be changed
+        whenever the analysis changes its result for the same file. Allows the
+        analyses to be kept in the snapshot of the index and reused in the next
+        runs, for the files that have not changed.
+
+        Returns:
+        str:Version of the analysis, or None if the analyses are not to be kept
+        """
+        return None
+
+    def apply_file_analysis(self, entry, analysis):
+        """
+        Applies the result of analyze_file to the entry in the index. Invoked in
+        the main process.
+        """
+        group_id, metadata, remarks = analysis
+        if group_id is not None:
+            entry.assign_to_group(group_id)
+        entry.metadata.update(metadata)
+        entry.remarks += remarks
+
     def on_index_complete(self, index):
         """
         Invoked after all the files are added to the index. Allows to manipulate the index
         when its complete shape is already known.
         """
 
+    def on_index_changed(self, index, removed, changed):
+        """
+        Invoked in the multi-stage mode, before each stage following the first
+        one, instead of on_index_complete. Allows to update the index according
+        to the changes done by the operations of the previous stage, in time
+        proportional to the changes rather than to the size of the index.
+
+        The default implementation calls on_index_complete.
+
+        Parameters:
+        index: The index
+        removed: Entries removed from the index since the previous stage. They
+                 keep the group id they had in the index.
+        changed: Entries still in the index, whose operations were attempted
+                 in the previous stage
+        """
+        self.on_index_complete(index)
+
     def before_file_ops(self, entry):
         """
         Invoked for each file in the index before the rename/move/copy/link operations
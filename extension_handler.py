@@ -58,7 +58,10 @@ def use_extension(config: Configuration, os: IOSAbstraction, ext_str: str):
                 params_dict[key] = value
 
             params_dict = validate_and_fill(params_dict, extension_obj.on_params_query())
-            extension_obj.on_params_passed(params_dict)
+            error_message = extension_obj.on_params_passed(params_dict)
+            if error_message is not None:
+                print_error("%s: %s" % (ext_name, error_message))
+                exit(1)
         config.extensions_chain.append(extension_obj)
     else:
         print_error("No such extension: %s" % ext_name)
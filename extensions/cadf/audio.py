@@ -1,153 +1,391 @@
 from extension import Extension, ExtensionParam
 from file_index import FileIndex, FileIndexEntry
-import hashlib
-import io
+import mmap
+import os
+import re
+import struct
 from extensions.df import Extension_df
 from console_output import print_warning
+from stats import stats
 
 
 class Extension_cadf_audio(Extension_df):
-    READ_CHUNK_SIZE = 16384
     UNIQUE_FILES_POLICIES = ["drop", "ungroup", "group"]
 
     ID3v2_HEADER_LENGTH = 10
     ID3v2_MAGIC = b'ID3'
     ID3v2_HEADER_REGION_SZ_BEGIN = 6
     ID3v2_HEADER_REGION_SZ_END = 6 + 4
+    ID3v2_FLAG_FOOTER = 0x10
+    ID3v1_MAGIC = b'TAG'
+    ID3v1_LENGTH = 128
     MP3_SYNC_WORD_SIZE = 2
     MP3_SYNC_WORD_BITMASK = 0xFFF0
     MP3_SYNC_WORD_CONTENT = 0xFFF0
+    FLAC_MAGIC = b'fLaC'
+    RIFF_MAGIC = b'RIFF'
+    WAVE_MAGIC = b'WAVE'
+    OGG_MAGIC = b'OggS'
+    MP4_FTYP_ATOM = b'ftyp'
+    AUDIO_EXTENSIONS = [".mp3", ".flac", ".wav", ".ogg", ".oga", ".opus", ".m4a", ".m4b", ".mp4"]
+    FORMAT_PARSERS = {
+        "mp3": "_parse_mp3",
+        "flac": "_parse_flac",
+        "wav": "_parse_wav",
+        "ogg": "_parse_ogg",
+        "mp4": "_parse_mp4"
+    }
+    # Number of bytes read to recognize the format of files with other extensions
+    PROBE_SIZE = 4096
+    # Changed along with the way the audio regions are determined, so that
+    # the values cached by older versions are not used
+    CACHE_MODE = "audio2"
+
+    _NON_ZERO_BYTE = re.compile(b'[^\x00]')
 
     def __init__(self):
         Extension_df.__init__(self)
+        self._probe = False
 
     def on_name_query(self):
         return "Content-Aware Duplicate Finder for audio files"
 
     def on_description_query(self):
         return "Creates groups consisting of audio files that have identical sound data, "\
-                "regardless of the differences in the tags. Allows to quickly find" \
-                "audio files which have the same content, but may be tagged differently."
+                "regardless of the differences in the tags. Allows to quickly find " \
+                "audio files which have the same content, but may be tagged differently. " \
+                "Supported formats: MP3, FLAC, WAV, Ogg (Vorbis, Opus, FLAC) and MP4/M4A."
 
     def on_params_query(self):
-        return Extension_df.on_params_query(self);
+        return Extension_df.on_params_query(self) + [
+            ExtensionParam("probe",
+                "Whether the files with other extensions are examined for audio content",
+                values={
+                    "no": "Take only the files with extensions of the supported audio formats",
+                    "yes": "Also read the first bytes of the other files, and take the ones in a supported format"
+                }, default="no")
+        ]
+
+    def on_params_passed(self, params):
+        if params.get("probe", "no") not in ["yes", "no"]:
+            return "Invalid probe value: %s" % params["probe"]
+        self._probe = params.get("probe") == "yes"
+        return Extension_df.on_params_passed(self, params)
 
     def before_file_added(self, filename):
-        filename_lo = filename.lower()
-        if filename_lo.endswith(".mp3"):
+        if os.path.splitext(filename)[1].lower() in self.AUDIO_EXTENSIONS:
             return True
+        if not self._probe:
+            return False
+
+        try:
+            with open(filename, "rb") as f:
+                head = f.read(self.PROBE_SIZE)
+        except OSError:
+            return False
+        return self._detect_format(head) is not None
+
+    def _skip_id3v2(self, data, offset):
+        """
+        Skips the ID3v2 blocks starting at the offset given.
+
+        Returns:
+        tuple:Offset following the blocks, and the list of the blocks found
+        """
+        structure = []
+        # ID3 header consists of 10 bytes: mmmvvxllll
+        # where:
+        #   * mmm = "ID3"
+        #   * vv - version
+        #   * x - flags
+        #   * llll - length
+        while data[offset:offset + len(self.ID3v2_MAGIC)] == self.ID3v2_MAGIC:
+            id3_header = data[offset:offset + self.ID3v2_HEADER_LENGTH]
+            id3_region_length = 0
+            for byte in id3_header[self.ID3v2_HEADER_REGION_SZ_BEGIN:self.ID3v2_HEADER_REGION_SZ_END]:
+                # synch-safe format - only 7 bits are used
+                id3_region_length = (id3_region_length << 7) | (byte & 0x7F)
+            if len(id3_header) == self.ID3v2_HEADER_LENGTH and id3_header[5] & self.ID3v2_FLAG_FOOTER:
+                id3_region_length += self.ID3v2_HEADER_LENGTH
+
+            structure.append( (offset, id3_region_length, "ID3v2") )
+            offset += id3_region_length + self.ID3v2_HEADER_LENGTH
+        return offset, structure
 
-        return False
+    def _get_end_of_audio(self, data, offset):
+        """
+        Returns the end of the audio data, excluding the ID3v1 tag at the end of
+        the file, if there is one.
+        """
+        size = len(data)
+        if size - offset >= self.ID3v1_LENGTH and data[size - self.ID3v1_LENGTH:size - self.ID3v1_LENGTH + 3] == self.ID3v1_MAGIC:
+            return size - self.ID3v1_LENGTH
+        return size
 
-    def _get_audio_region_mp3(self, filename):
+    def _detect_format(self, data):
         """
-        Determines the offset and length of audio stream in MP3 file, skipping
-        ID3 tag block, ID3v2 tag regions and zero paddings.
+        Determines the format of the audio file from the magic bytes at its
+        beginning.
+
+        Returns:
+        str:Name of the format (key of FORMAT_PARSERS), or None if not recognized
+        """
+        offset, id3_blocks = self._skip_id3v2(data, 0)
+        head = data[offset:offset + 12]
+        if head[0:4] == self.FLAC_MAGIC:
+            return "flac"
+        if head[0:4] == self.RIFF_MAGIC and head[8:12] == self.WAVE_MAGIC:
+            return "wav"
+        if head[0:4] == self.OGG_MAGIC:
+            return "ogg"
+        if data[4:8] == self.MP4_FTYP_ATOM:
+            return "mp4"
+        if len(id3_blocks) > 0:
+            return "mp3"
+        if len(head) >= self.MP3_SYNC_WORD_SIZE and \
+                ((head[0] << 8) | head[1]) & self.MP3_SYNC_WORD_BITMASK == self.MP3_SYNC_WORD_CONTENT:
+            return "mp3"
+        return None
+
+    def _get_audio_region(self, filename):
+        """
+        Determines the offset and length of audio stream in the file, skipping
+        the tags. Only the headers of the file are read; the file is mapped to
+        the memory, so that the parts skipped are never loaded.
+
+        Returns:
+        tuple:Offset and length of the audio stream, or None if the format of the
+              file was not recognized
+        """
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                audio_format = self._detect_format(data)
+                if audio_format is None and filename.lower().endswith(".mp3"):
+                    audio_format = "mp3"
+                if audio_format is None:
+                    return None
+
+                try:
+                    offset, length, structure = getattr(self, self.FORMAT_PARSERS[audio_format])(data, filename)
+                except (ValueError, IndexError, struct.error) as ex:
+                    print_warning("Could not parse %s as %s (%s), the whole file will be compared" % (
+                        filename, audio_format, str(ex)))
+                    return None
+                return offset, length
+
+    def _parse_mp3(self, data, filename):
+        """
+        Finds the audio stream in the MP3 file contents. The data is searched
+        with bulk operations on the buffer, rather than read byte by byte.
+
+        Parameters:
+        data: Contents of the file (bytes-like object, eg. mmap)
+        filename: Name of the file, for the warnings
+
+        Returns:
+        tuple:Offset and length of the audio stream, and the list of the regions
+              found in the file, as (offset, length, description) tuples
         """
 
         # TODO: more in-depth analysis of mp3 audio stream to identify and
         # exclude ID3v2 blocks appearing between MP3 frames. Unlikely scenario,
         # but theoretically possible
+        size = len(data)
+        offset = 0
+        structure = []
+        # There might be more than one ID3v2 regions in the file, so we need
+        # to traverse them all
+        while offset + self.MP3_SYNC_WORD_SIZE <= size:
+            if data[offset:offset + len(self.ID3v2_MAGIC)] == self.ID3v2_MAGIC:
+                offset, id3_blocks = self._skip_id3v2(data, offset)
+                structure += id3_blocks
+                continue
+
+            # Check if MP3 sync word is present.
+            # We expect to encounter 0xFFFB or 0xFFFA (in case there is an error correction bit set)
+            sync_word = (data[offset] << 8) | data[offset + 1]
+            if sync_word & self.MP3_SYNC_WORD_BITMASK == self.MP3_SYNC_WORD_CONTENT:
+                # MP3 data encountered, audio stream begins here
+                break
+            elif data[offset] == 0:
+                # zero-padding; skip it all at once
+                match = self._NON_ZERO_BYTE.search(data, offset)
+                padding_end = match.start() if match is not None else size
+                structure.append( (offset, padding_end - offset, "Zero-padding") )
+                offset = padding_end
+            else:
+                structure.append( (offset, 0, "Unknown content starting with %04x" % sync_word))
+                print_warning("Unexpected data found in %s, determination of audio content might be inaccurate" % filename)
+                break
+
+        offset = min(offset, size)
+        # Check if ID3 (v1) region is present
+        end = self._get_end_of_audio(data, offset)
+        if end < size:
+            structure.append( (end, self.ID3v1_LENGTH, "ID3v1") )
+        return offset, end - offset, structure
+
+    def _parse_flac(self, data, filename):
+        """
+        Finds the audio frames in the FLAC file, following the metadata blocks
+        (stream info, tags, pictures, padding...). Each block starts with
+        a 4-byte header: last-block flag, 7-bit block type and 24-bit length.
+        """
+        offset, structure = self._skip_id3v2(data, 0)
+        if data[offset:offset + 4] != self.FLAC_MAGIC:
+            raise ValueError("FLAC marker not found")
+        offset += 4
+
+        while True:
+            block_header = data[offset:offset + 4]
+            if len(block_header) < 4:
+                raise ValueError("truncated metadata block header at %d" % offset)
+            block_length = int.from_bytes(block_header[1:4], "big")
+            structure.append( (offset, block_length + 4, "FLAC metadata block %d" % (block_header[0] & 0x7F)) )
+            offset += block_length + 4
+            if block_header[0] & 0x80:
+                break
+
+        offset = min(offset, len(data))
+        end = self._get_end_of_audio(data, offset)
+        return offset, end - offset, structure
+
+    def _parse_wav(self, data, filename):
+        """
+        Finds the "data" chunk of the RIFF/WAVE file. The other chunks (format,
+        LIST/INFO tags, id3...) are skipped using their lengths.
+        """
+        size = len(data)
+        structure = [(0, 12, "RIFF header")]
+        offset = 12
+        while offset + 8 <= size:
+            chunk_id = data[offset:offset + 4]
+            chunk_length = struct.unpack_from("<I", data, offset + 4)[0]
+            if chunk_id == b'data':
+                structure.append( (offset, 8, "data chunk header") )
+                offset += 8
+                return offset, min(chunk_length, size - offset), structure
+            structure.append( (offset, chunk_length + 8, "RIFF chunk %s" % chunk_id.decode("latin-1")) )
+            # Chunks are aligned to 2 bytes
+            offset += 8 + chunk_length + (chunk_length & 1)
+        raise ValueError("data chunk not found")
+
+    def _get_ogg_header_packets(self, first_packet):
+        """
+        Returns the number of header packets (identification, comments, setup...)
+        of the Ogg stream, based on its first packet.
+        """
+        if first_packet.startswith(b'\x01vorbis'):
+            return 3
+        if first_packet.startswith(b'\x7fFLAC') and len(first_packet) >= 9:
+            # The mapping header gives the number of header packets following it
+            return 1 + max(int.from_bytes(first_packet[7:9], "big"), 1)
+        # Opus, Speex: identification and comments
+        return 2
+
+    def _parse_ogg(self, data, filename):
+        """
+        Skips the Ogg pages carrying the header packets, including the comment
+        header. Each page has a 27-byte header ending with the number of segments,
+        followed by the table of their sizes; a segment shorter than 255 bytes
+        ends a packet.
+
+        The audio pages still carry their sequence numbers and checksums, so
+        files are recognized as duplicates as long as tagging did not change the
+        number of header pages.
+        """
+        size = len(data)
+        structure = []
         offset = 0
-        length = 0
+        header_packets = None
+        packets = 0
+        while header_packets is None or packets < header_packets:
+            if data[offset:offset + 4] != self.OGG_MAGIC:
+                raise ValueError("Ogg page not found at %d" % offset)
+            segments = data[offset + 26]
+            segment_table = data[offset + 27:offset + 27 + segments]
+            body = offset + 27 + segments
+            if header_packets is None:
+                header_packets = self._get_ogg_header_packets(data[body:body + 9])
+            packets += sum(1 for lacing in segment_table if lacing < 255)
+            page_size = 27 + segments + sum(segment_table)
+            structure.append( (offset, page_size, "Ogg header page") )
+            offset += page_size
+
+        offset = min(offset, size)
+        return offset, size - offset, structure
+
+    def _parse_mp4(self, data, filename):
+        """
+        Finds the "mdat" atom of the MP4/M4A file, which holds the audio samples.
+        The other top-level atoms (including "moov" with the iTunes-style tags)
+        are skipped using their sizes.
+        """
+        size = len(data)
         structure = []
+        offset = 0
+        while offset + 8 <= size:
+            atom_size = struct.unpack_from(">I", data, offset)[0]
+            atom_type = data[offset + 4:offset + 8]
+            header_size = 8
+            if atom_size == 1:
+                atom_size = struct.unpack_from(">Q", data, offset + 8)[0]
+                header_size = 16
+            elif atom_size == 0:
+                # The atom extends to the end of the file
+                atom_size = size - offset
+            if atom_size < header_size:
+                raise ValueError("invalid size of atom at %d" % offset)
+
+            if atom_type == b'mdat':
+                structure.append( (offset, header_size, "mdat atom header") )
+                offset += header_size
+                return offset, min(atom_size - header_size, size - offset), structure
+            structure.append( (offset, atom_size, "atom %s" % atom_type.decode("latin-1")) )
+            offset += atom_size
+        raise ValueError("mdat atom not found")
+
+    def _hash_region(self, filename, offset, length):
+        """
+        Hashes the region straight from the memory-mapped file, without copying
+        the data to intermediate buffers.
+        """
+        return self._hash_mapped(filename, [(offset, length)])
+
+    def _hash_partial(self, filename, offset, length):
+        block_size = min(self.PARTIAL_HASH_BLOCK_SIZE, length)
+        return self._hash_mapped(filename, [(offset, block_size), (offset + length - block_size, block_size)])
+
+    def _hash_mapped(self, filename, regions):
+        if stats.enabled:
+            stats.count("syscalls.open")
+        h = self._new_hash()
         with open(filename, "rb") as f:
-            # save the length of file
-            f.seek(0, io.SEEK_END)
-            length = f.tell()
-            f.seek(0, io.SEEK_SET)
-            # There might be more than one ID3v2 regions in the file, so we need
-            # to traverse them all
-            last_loop_offset = -1
-            while offset < length:
-                if offset == last_loop_offset:
-                    raise Exception("BUG: Loop stuck at offset %d" % offset)
-                last_loop_offset = offset
-                
-                # Check if ID3v2 region is present, and skip it to reach audio data
-                # ID3 header consists of 10 bytes: mmmvvxllll
-                # where:
-                #   * mmm = "ID3"
-                #   * vv - version
-                #   * x - flags
-                #   * llll - length
-                id3_header = f.read(self.ID3v2_HEADER_LENGTH)
-
-                if id3_header[0:len(self.ID3v2_MAGIC)] == self.ID3v2_MAGIC:
-                    # read remaining bytes of ID3v2 header
-
-                    id3_region_length = 0
-                    for byte in range(self.ID3v2_HEADER_REGION_SZ_BEGIN, self.ID3v2_HEADER_REGION_SZ_END):
-                        # synch-safe format - only 7 bits are used
-                        id3_region_length = (id3_region_length << 7) | id3_header[byte]
-
-                    structure.append( (offset, id3_region_length, "ID3v2") )
-                    offset += id3_region_length + self.ID3v2_HEADER_LENGTH
-
-                    length -= offset
-                else:
-                    # unread the header
-                    f.seek(-self.ID3v2_HEADER_LENGTH, io.SEEK_CUR)
-
-                # Check if MP3 sync word is present.
-                # We expect to encounter 0xFFFB or 0xFFFA (in case there is an error correction bit set)
-                f.seek(offset, io.SEEK_SET)
-                mp3_frame_hdr_part = f.read(self.MP3_SYNC_WORD_SIZE)
-                sync_word = (mp3_frame_hdr_part[0] << 8) | (mp3_frame_hdr_part[1])
-
-                # If we read something else, it might be another ID3v2 region
-                if sync_word & self.MP3_SYNC_WORD_BITMASK == self.MP3_SYNC_WORD_CONTENT:
-                    # MP3 data encountered, audio stream begins here
-                    break
-                else:
-                    if mp3_frame_hdr_part == self.ID3v2_MAGIC[0:2]:
-                        # another ID3v2 region found, this is okay
-                        # rewind back and repeat
-                        f.seek(-self.MP3_SYNC_WORD_SIZE, io.SEEK_CUR)
-
-                    elif sync_word == 0:
-                        # zero-padding; rewind it all
-                        initial_offset = offset
-                        offset += 2
-                        while True:
-                            b = f.read(1)
-                            if b != b'\0':
-                                f.seek(-1, io.SEEK_CUR)
-                                break
-                            else:
-                                offset += 1
-                        structure.append( (initial_offset, offset-initial_offset, "Zero-padding") )
-                    else:
-                        structure.append( (offset, 0, "Unknown content starting with %04x" % sync_word))
-                        print_warning("Unexpected data found in %s, determination of audio content might be inaccurate" % filename)
-                        break
-
-            # Check if ID3 (v1) region is present
-            f.seek(-128, io.SEEK_END)
-            id3_magic = f.read(3)
-            if id3_magic == b'TAG':
-                length -= 128
-        return offset, length, structure
-
-    
-    def after_file_added(self, entry):
-        if entry.current_name.lower().endswith("mp3"):
-            offset, length, structure = self._get_audio_region_mp3(entry.current_name)
-
-        h = hashlib.sha224()
-        with open(entry.current_name, "rb") as f:
-            f.seek(offset, io.SEEK_SET)
-            yet_to_read = length
-            while yet_to_read > 0:
-                read_size = self.READ_CHUNK_SIZE
-                if read_size > yet_to_read:
-                    read_size = yet_to_read
-
-                data = f.read(read_size)
-                h.update(data)
-
-                yet_to_read -= read_size
-
-        entry.assign_to_group(h.hexdigest())
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    with memoryview(data) as view:
+                        for offset, length in regions:
+                            # Fed in blocks of the chunk size, so that the pages
+                            # of big files are mapped in gradually
+                            end = offset + length
+                            for block_offset in range(offset, end, self._read_chunk_size):
+                                h.update(view[block_offset:min(block_offset + self._read_chunk_size, end)])
+                            if stats.enabled:
+                                stats.count("bytes.hashed", length)
+        return h.hexdigest()
 
+    def _get_content_region(self, filename, stat_result):
+        if self._hash_cache is not None:
+            region = self._hash_cache.get(stat_result, self.CACHE_MODE + "-region")
+            if region is not None:
+                offset, length = region.split(":")
+                return int(offset), int(length)
 
+        region = self._get_audio_region(filename)
+        if region is None:
+            region = Extension_df._get_content_region(self, filename, stat_result)
+        if self._hash_cache is not None:
+            self._hash_cache.put(stat_result, self.CACHE_MODE + "-region", "%d:%d" % region)
+        return region
@@ -1,13 +1,49 @@
 from extension import Extension, ExtensionParam
 from file_index import FileIndex, FileIndexEntry
+from console_output import print_warning
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from stats import stats
 import hashlib
+import io
+import os
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Read buffers reused by the hashing threads
+_read_buffers = local()
 
 class Extension_df(Extension):
-    READ_CHUNK_SIZE=16384
+    READ_CHUNK_SIZE=262144
+    PARTIAL_HASH_BLOCK_SIZE=65536
     UNIQUE_FILES_POLICIES=["drop", "ungroup", "group"]
+    HASH_ALGORITHMS={
+        "sha224": "SHA-224",
+        "sha256": "SHA-256",
+        "sha1": "SHA-1",
+        "md5": "MD5",
+        "blake2b": "BLAKE2b, usually the fastest of the cryptographic hashes on 64-bit CPUs"
+    }
+    XXHASH_ALGORITHMS={
+        "xxh64": "xxHash64, non-cryptographic, very fast",
+        "xxh3_128": "XXH3 128-bit, non-cryptographic, very fast"
+    }
+    DEFAULT_HASH_ALGORITHM="sha224"
+    CACHE_MODE="file"
 
     def __init__(self):
         self._unique_files_policy = "ungroup"
+        self._hash_algorithm = self.DEFAULT_HASH_ALGORITHM
+        self._read_chunk_size = self.READ_CHUNK_SIZE
+        # Entries waiting for duplicate detection, bucketed by the length of
+        # their content: {length: [(entry, offset, stat_result), ...]}
+        self._candidates = {}
+        self._candidates_lock = Lock()
+        self._hash_cache = None
+        self._num_threads = None
 
     def on_name_query(self):
         return "Duplicate Finder"
@@ -24,33 +60,236 @@ class Extension_df(Extension):
                     "drop": "Remove them from the index, so that only duplicates will be shown",
                     "ungroup": "Keep them in the index, but ungroup them (they will be placed in \"remaining files\" section)",
                     "group": "Keep them in the index grouped, even though they will be the only ones in the group"
-                }, default="ungroup")
+                }, default="ungroup"),
+            ExtensionParam("algo",
+                "Hash algorithm used to compare the file contents",
+                values=self._get_hash_algorithms(), default=self.DEFAULT_HASH_ALGORITHM),
+            ExtensionParam("chunk",
+                "Size of the blocks the files are read in, in bytes",
+                default=str(self.READ_CHUNK_SIZE))
         ]
 
+    def _get_hash_algorithms(self):
+        algorithms = dict(self.HASH_ALGORITHMS)
+        if xxhash is not None:
+            algorithms.update(self.XXHASH_ALGORITHMS)
+        return algorithms
+
     def on_params_passed(self, params):
         assert("unique" in params)
         assert(params["unique"] in self.UNIQUE_FILES_POLICIES)
         self._unique_files_policy = params["unique"]
 
+        if params["algo"] not in self._get_hash_algorithms():
+            return "Unsupported hash algorithm: %s" % params["algo"]
+        self._hash_algorithm = params["algo"]
+
+        try:
+            self._read_chunk_size = int(params["chunk"])
+        except ValueError:
+            return "Invalid chunk size: %s" % params["chunk"]
+        if self._read_chunk_size <= 0:
+            return "Invalid chunk size: %s" % params["chunk"]
+
+        return None
+
+    def on_config_complete(self, config):
+        self._hash_cache = config.hash_cache
+        self._num_threads = max(1, config.postprocess_num_threads)
+
+    def _get_content_region(self, filename, stat_result):
+        """
+        Returns the offset and length of the part of the file that is compared
+        when looking for duplicates.
+        """
+        return 0, stat_result.st_size
+
+    def _new_hash(self):
+        if self._hash_algorithm in self.XXHASH_ALGORITHMS:
+            return getattr(xxhash, self._hash_algorithm)()
+        return hashlib.new(self._hash_algorithm)
+
+    def _get_read_buffer(self):
+        buffer = getattr(_read_buffers, "buffer", None)
+        if buffer is None or len(buffer) != self._read_chunk_size:
+            buffer = memoryview(bytearray(self._read_chunk_size))
+            _read_buffers.buffer = buffer
+        return buffer
+
+    def _update_hash(self, h, f, length):
+        """
+        Feeds the hash with the next length bytes of the file, reading them
+        into a reused buffer rather than allocating a new object per block.
+        """
+        buffer = self._get_read_buffer()
+        yet_to_read = length
+        while yet_to_read > 0:
+            bytes_read = f.readinto(buffer[:min(len(buffer), yet_to_read)])
+            if not bytes_read: break
+            h.update(buffer[:bytes_read])
+            yet_to_read -= bytes_read
+        if stats.enabled:
+            stats.count("bytes.hashed", length - max(yet_to_read, 0))
+
+    def _hash_region(self, filename, offset, length):
+        if stats.enabled:
+            stats.count("syscalls.open")
+        h = self._new_hash()
+        with open(filename, "rb", buffering=0) as f:
+            f.seek(offset, io.SEEK_SET)
+            self._update_hash(h, f, length)
+
+        return h.hexdigest()
+
+    def _hash_partial(self, filename, offset, length):
+        """
+        Hashes only the first and the last block of the content region.
+        """
+        if stats.enabled:
+            stats.count("syscalls.open")
+        h = self._new_hash()
+        with open(filename, "rb", buffering=0) as f:
+            f.seek(offset, io.SEEK_SET)
+            self._update_hash(h, f, self.PARTIAL_HASH_BLOCK_SIZE)
+            f.seek(offset + length - self.PARTIAL_HASH_BLOCK_SIZE, io.SEEK_SET)
+            self._update_hash(h, f, self.PARTIAL_HASH_BLOCK_SIZE)
+
+        return h.hexdigest()
+
+    def _hash_entries(self, executor, hash_function, cache_mode, candidates):
+        """
+        Hashes the candidates of all the size buckets of a stage at once on the
+        executor, returning them bucketed by their length and digest. Files that
+        could not be read are reported and left out.
+
+        Parameters:
+        candidates: List of (length, candidate) pairs
+        """
+        def hash_candidate(length_and_candidate):
+            length, (entry, offset, stat_result) = length_and_candidate
+            if self._hash_cache is not None:
+                digest = self._hash_cache.get(stat_result, cache_mode)
+                if digest is not None:
+                    return digest
+            try:
+                digest = hash_function(entry.current_name, offset, length)
+                if self._hash_cache is not None:
+                    self._hash_cache.put(stat_result, cache_mode, digest)
+                return digest
+            except OSError as ex:
+                print_warning("Cannot read %s (%s), it will not be checked for duplicates" % (
+                    entry.current_name, str(ex)))
+                return None
+
+        buckets = {}
+        for (length, candidate), digest in zip(candidates, executor.map(hash_candidate, candidates)):
+            if digest is not None:
+                buckets.setdefault((length, digest), []).append(candidate)
+        return buckets
+
+    def _get_cache_mode(self, stage):
+        return "%s-%s:%s" % (self.CACHE_MODE, stage, self._hash_algorithm)
+
+    def __getstate__(self):
+        # Copies sent to worker processes only need the parameters
+        state = dict(self.__dict__)
+        state["_candidates"] = {}
+        del state["_candidates_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._candidates_lock = Lock()
+
+    def on_process_safety_query(self):
+        return True
+
+    def on_analysis_version_query(self):
+        return self.CACHE_MODE
+
+    def analyze_file(self, entry:FileIndexEntry):
+        if stats.enabled:
+            stats.count("syscalls.stat")
+        stat_result = os.stat(entry.current_name)
+        offset, length = self._get_content_region(entry.current_name, stat_result)
+        return offset, length, stat_result
+
+    def apply_file_analysis(self, entry:FileIndexEntry, analysis):
+        offset, length, stat_result = analysis
+        with self._candidates_lock:
+            self._candidates.setdefault(length, []).append((entry, offset, stat_result))
 
     def after_file_added(self, entry:FileIndexEntry):
-        h = hashlib.sha224()
-        with open(entry.current_name, "rb") as f:
-            while True:
-                data = f.read(self.READ_CHUNK_SIZE)
-                if not data: break
-                h.update(data)
+        self.apply_file_analysis(entry, self.analyze_file(entry))
+
+    def _find_duplicates(self, index: FileIndex, executor):
+        """
+        Finds the duplicates among the candidates in stages: files are bucketed by size
+        first, then files of colliding sizes are compared by hashes of their first and last
+        blocks, and only the files that still collide get their whole content hashed.
+        Each unique file is labelled with the key that set it apart from others.
+        """
+        with self._candidates_lock:
+            candidates = self._candidates
+            self._candidates = {}
+
+        to_hash_partially = []
+        to_hash = []
+        for length, entries in candidates.items():
+            entries = [candidate for candidate in entries if index.contains(candidate[0])]
+            if len(entries) == 1:
+                self._handle_unique(index, entries[0][0], "size:%d" % length)
+            elif length > 2 * self.PARTIAL_HASH_BLOCK_SIZE:
+                to_hash_partially += [(length, candidate) for candidate in entries]
+            else:
+                # The partial hash would cover the whole content anyway
+                to_hash += [(length, candidate) for candidate in entries]
+
+        # The files of all the sizes are hashed together, so that many small
+        # buckets keep all the threads busy as well as a few big ones
+        partial_buckets = self._hash_entries(executor, self._hash_partial, self._get_cache_mode("partial"),
+                                             to_hash_partially)
+        for (length, digest), bucket in partial_buckets.items():
+            if len(bucket) == 1:
+                self._handle_unique(index, bucket[0][0], "partial:%d:%s" % (length, digest))
+            else:
+                to_hash += [(length, candidate) for candidate in bucket]
 
-        entry.assign_to_group(h.hexdigest())
+        for (length, digest), bucket in self._hash_entries(executor, self._hash_region, self._get_cache_mode("full"),
+                                                           to_hash).items():
+            if len(bucket) == 1:
+                self._handle_unique(index, bucket[0][0], digest)
+            else:
+                for entry, offset, stat_result in bucket:
+                    entry.assign_to_group(digest)
+
+    def _handle_unique(self, index: FileIndex, entry: FileIndexEntry, label):
+        if self._unique_files_policy == "group":
+            entry.assign_to_group(label)
+        elif self._unique_files_policy == "drop":
+            index.remove(entry)
+
+    def _handle_became_unique(self, index: FileIndex, groups):
+        """
+        Handles the files that have become unique after their duplicates were
+        processed, in the groups given.
+        """
+        for group in groups:
+            if index.get_group_size(group) != 1:
+                continue
+            entry = index.get_group_members(group)[0]
+            if self._unique_files_policy == "ungroup":
+                entry.ungroup()
+            if self._unique_files_policy == "drop":
+                index.remove(entry)
 
     def on_index_complete(self, index: FileIndex):
-        groups, ungrouped = index.get_files_by_groups()
-
-        for group, entries_in_group in groups.items():
-            if len(entries_in_group) == 1:
-                if self._unique_files_policy == "ungroup":
-                    entries_in_group[0].ungroup()
-                if self._unique_files_policy == "drop":
-                    index.remove(entries_in_group[0])
-        index.purge()
+        with ThreadPoolExecutor(self._num_threads) as executor:
+            self._find_duplicates(index, executor)
+        self._handle_became_unique(index, index.get_groups_of_size(1))
+
+    def on_index_changed(self, index: FileIndex, removed, changed):
+        # Only the groups that lost members can have become single-member ones
+        groups = set(entry.get_group_id() for entry in removed if entry.get_group_id() is not None)
+        self._handle_became_unique(index, groups)
 
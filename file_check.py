@@ -0,0 +1,9 @@
+
+class FileCheck:
+    BROKEN_LINKS = 'broken'  # Discard symlinks pointing to nonexistent files
+    READABLE = 'readable'    # Discard files without read permission
+
+    ALL_CHECKS=[
+            BROKEN_LINKS,
+            READABLE]
+
@@ -1,79 +1,269 @@
+from os import fspath, sep as os_sep, altsep as os_altsep
+from sys import intern
+from itertools import count
+from io import StringIO
+import json
+from queue import Queue
+from threading import Lock
+from time import perf_counter
 from configuration import Configuration
 from os_abstraction import IOSAbstraction
 from file_action import FileAction
-from console_output import print_debug, print_warning
+from console_output import print_debug, print_warning, print_error
+from stats import stats
 
 
-def index_uid():
-    while True:
-        index_uid.lastval += 1
-        yield "%08d" % index_uid.lastval
+_next_uid = count(1).__next__
+_SEPARATORS = [sep for sep in (os_sep, os_altsep) if sep is not None]
 
 
-index_uid.lastval = 0
+def _split_name(name):
+    """
+    Splits the path after the last separator, keeping the separator with the
+    directory part, so that concatenation of both parts gives the path back.
+    """
+    pos = max(name.rfind(sep) for sep in _SEPARATORS)
+    return name[:pos + 1], name[pos + 1:]
+
+
+# Action column of the line telling the current name of the file of an id
+SOURCE_MARKER = '<'
+
 
 class FileIndexEntry:
+    """
+    Entry of the index, describing a single file and the operations to be done
+    on it. The representation is kept compact, as there may be tens of millions
+    of entries: the directory part of the name is shared between the entries
+    of the same directory, the common case of a single operation on the file
+    under its current name is stored as just the action, and the remarks and
+    metadata containers are only created when used.
+    """
+
+    __slots__ = ("_index", "_uid", "_directory", "_basename", "_targets",
+                 "_remarks", "_metadata", "_group_id")
+
     def __init__(self, current_name, action, index=None):
         self._index = index
-        self._unique_id = next(index_uid())
+        self._uid = _next_uid()
         self.current_name = current_name
-        self.target_names = [(current_name, action)]
-        self.remarks = []
+        self._targets = action
+        self._remarks = None
+        self._metadata = None
         self._group_id = None
-        self.metadata = {}
 
     def __str__(self):
-        return "%s: %s -> %s" % (self.unique_id, self.current_name, self.target_names)
+        return "%s: %s -> %s" % (self.get_uid(), self.current_name, self.target_names)
+
+    @property
+    def current_name(self):
+        return self._directory + self._basename
+
+    @current_name.setter
+    def current_name(self, name):
+        directory, self._basename = _split_name(name)
+        self._directory = intern(directory)
+
+    @property
+    def target_names(self):
+        """
+        List of (name, action) pairs. For an entry in the compact form this is a
+        temporary list, so changes to it are not kept; use add_target_name() or
+        assign the attribute instead.
+        """
+        if isinstance(self._targets, str):
+            return [(self.current_name, self._targets)]
+        return self._targets
+
+    @target_names.setter
+    def target_names(self, target_names):
+        if len(target_names) == 1 and target_names[0][0] == self.current_name:
+            self._targets = target_names[0][1]
+        else:
+            self._targets = target_names
+
+    @property
+    def remarks(self):
+        if self._remarks is None:
+            self._remarks = []
+        return self._remarks
+
+    @remarks.setter
+    def remarks(self, remarks):
+        self._remarks = remarks if len(remarks) > 0 else None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = {}
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata if len(metadata) > 0 else None
 
     def reset(self):
-        self.target_names = []
-        self.remarks = []
+        self._targets = []
+        self._remarks = None
 
     def get_uid(self):
-        return self._unique_id
+        return "%08d" % self._uid
+
+    def get_uid_number(self):
+        return self._uid
 
     def get_group_id(self):
         return self._group_id
 
     def generate_user_input(self):
-        max_key_len = 0
-        for key in self.metadata:
-            if len(key) > max_key_len:
-                max_key_len = len(key)
-
-        result = ""
-        for remark in self.remarks:
-            result += "# %s\n" % remark
-        for name, action in self.target_names:
-            result += "%s %c   %s\n" % (self._unique_id, action, name)
-
-        for key, value in self.metadata.items():
-            if str(value).find('\n') != -1:
-                result += "%-*s = <<END\n%s\n<<END\n" % (max_key_len, key, value)
-            else:
-                result += "%-*s = %s\n" % (max_key_len, key, value)
+        result = StringIO()
+        self.write_user_input(result)
+        return result.getvalue()
+
+    def write_user_input(self, stream, with_source=False):
+        """
+        Writes the lines describing the entry in the editor to the stream.
+
+        Parameters:
+        with_source: Whether to write the source line, telling the current name of
+                     the file the id refers to, so that a plan can be checked against
+                     the index it is applied to
+        """
+        if self._remarks is not None:
+            for remark in self._remarks:
+                stream.write("# %s\n" % remark)
 
-        return result
+        if with_source:
+            stream.write("%08d %c   %s\n" % (self._uid, SOURCE_MARKER, self.current_name))
+
+        if isinstance(self._targets, str):
+            stream.write("%08d %c   %s\n" % (self._uid, self._targets, self.current_name))
+        else:
+            for name, action in self._targets:
+                stream.write("%08d %c   %s\n" % (self._uid, action, name))
+
+        if self._metadata is not None:
+            max_key_len = max(len(key) for key in self._metadata)
+            for key, value in self._metadata.items():
+                if str(value).find('\n') != -1:
+                    stream.write("%-*s = <<END\n%s\n<<END\n" % (max_key_len, key, value))
+                else:
+                    stream.write("%-*s = %s\n" % (max_key_len, key, value))
+
+    def write_user_input_jsonl(self, stream):
+        """
+        Writes the entry to the stream as a single line of JSON, holding the
+        current name along with the targets, so that it can be applied without
+        the index it came from.
+        """
+        record = {
+            "id": self.get_uid(),
+            "source": self.current_name,
+            "targets": [{"action": action, "name": name} for name, action in self.target_names]
+        }
+        if self._group_id is not None:
+            record["group"] = self._group_id
+        if self._remarks is not None:
+            record["remarks"] = self._remarks
+        if self._metadata is not None:
+            record["metadata"] = self._metadata
+        stream.write(json.dumps(record, ensure_ascii=False, default=str))
+        stream.write("\n")
 
     def add_target_name(self, name, action):
         assert(action in FileAction.ALL_ACTIONS)
-        self.target_names.append((name, action))
+        if isinstance(self._targets, str):
+            self._targets = [(self.current_name, self._targets)]
+        self._targets.append((name, action))
 
     def assign_to_group(self, group_id):
-        self._index.register_group(group_id)
-        self._group_id = group_id
+        if self._index is not None:
+            self._index.move_to_group(self, group_id)
+        else:
+            self._group_id = group_id
 
     def ungroup(self):
-        self._group_id = None
+        self.assign_to_group(None)
 
 
 class FileIndex:
     def __init__(self, config: Configuration, os_abstraction: IOSAbstraction):
         self._files = {}
-        self._files_to_postprocess = []
+        # Pipeline between the population of the index and the post-processing
+        # workers. Bounded, so that adding the files blocks when post-processing
+        # does not keep up.
+        self._postprocess_queue = Queue(config.postprocess_queue_size)
+        self._postprocess_closed = False
+        self._postprocess_lock = Lock()
+        self._postprocess_queued = 0
+        self._postprocess_done = 0
         self._config = config
         self._os = os_abstraction
-        self._groups = []
+        # Group index: {group_id: {uid: entry}}, and the ids of groups by their
+        # size: {size: {group_id, ...}}
+        self._groups = {}
+        self._groups_by_size = {}
+        self._groups_lock = Lock()
+        self._process_backend = None
+        self._snapshot = None
+        # Entries removed and changed since the last call of take_changes():
+        # ({uid: entry}, {uid: entry}), or None if the changes are not tracked
+        self._changes = None
+
+    def use_snapshot(self, snapshot):
+        """
+        Makes the post-processing reuse the analyses of the files kept in the
+        snapshot, and record the analyses done in it.
+        """
+        self._snapshot = snapshot
+
+    def _analyze_and_apply(self, ext_id, ext, entry, analyses):
+        analysis = analyses.get(ext_id)
+        if analysis is None:
+            if self._process_backend is not None:
+                analysis = self._process_backend.analyze_file(ext_id, ext, entry)
+            else:
+                analysis = ext.analyze_file(entry)
+        ext.apply_file_analysis(entry, analysis)
+        return analysis
+
+    def track_changes(self):
+        """
+        Starts tracking the entries removed from the index and the entries
+        changed by the execution of their operations, see take_changes().
+        """
+        self._changes = ({}, {})
+
+    def take_changes(self):
+        """
+        Returns the entries removed and the entries changed since the previous
+        call (or since track_changes() was called), and starts collecting anew.
+        The removed entries keep the id of the group they belonged to.
+
+        Returns:
+        tuple:List of removed entries, list of changed entries
+        """
+        if self._changes is None:
+            return ([], [])
+        removed, changed = self._changes
+        self._changes = ({}, {})
+        return (list(removed.values()), list(changed.values()))
+
+    def _record_removed(self, entry: FileIndexEntry):
+        if self._changes is not None:
+            removed, changed = self._changes
+            removed[entry.get_uid_number()] = entry
+            changed.pop(entry.get_uid_number(), None)
+
+    def _record_changed(self, entry: FileIndexEntry):
+        if self._changes is not None:
+            self._changes[1][entry.get_uid_number()] = entry
+
+    def use_process_backend(self, backend):
+        """
+        Makes the post-processing of process-safe extensions run in worker processes.
+        """
+        self._process_backend = backend
 
     def get_all(self):
         return self._files
@@ -82,49 +272,132 @@ class FileIndex:
         return len(self._files)
 
     def add(self, filenames: list, action: str = None):
+        """
+        Adds files to the index.
+
+        Parameters:
+        filenames: Iterable of paths or os.DirEntry objects
+        action: Initial action of the created entries; the default action is used if None
+
+        Returns:
+        list:Created entries
+        """
         created_entries = []
 
         if action is None:
             action = self._config.default_action
 
-        for filename in filenames:
+        for item in filenames:
+            filename = fspath(item)
             if self._config.use_absolute_paths:
                 filename = self._os.abspath(filename)
 
+            # The extensions filter the files before they are validated, so that
+            # the files discarded by them cost no filesystem calls
             do_add_file = True
-            try:
-                if not self._os.isdir(filename):
-                    open(filename, "r")
-            except FileNotFoundError as ex:
-                print_warning("Cannot open %s - insufficient permissions or broken symlink (%s). Discarding" % (
-                    filename, str(ex)))
-                do_add_file = False
-
-            if do_add_file:
-                for ext in self._config.extensions_chain:
-                    do_add_file = do_add_file and ext.before_file_added(filename)
-
-                    if not do_add_file:
-                        print_debug("File %s was discarded from index by extension %s" % (filename, ext.on_name_query()))
+            for ext in self._config.extensions_chain:
+                if stats.enabled:
+                    start = perf_counter()
+                    do_add_file = ext.before_file_added(filename)
+                    stats.add_time("%s.before_file_added" % ext.on_name_query(), perf_counter() - start)
+                else:
+                    do_add_file = ext.before_file_added(filename)
+
+                if not do_add_file:
+                    print_debug("File %s was discarded from index by extension %s" % (filename, ext.on_name_query()))
+                    break
+
+            if do_add_file and len(self._config.file_checks) > 0:
+                if stats.enabled:
+                    start = perf_counter()
+                    error_message = self._os.validate_file(item, self._config.file_checks)
+                    stats.add_time("index.validate_file", perf_counter() - start)
+                else:
+                    error_message = self._os.validate_file(item, self._config.file_checks)
+                if error_message is not None:
+                    print_warning("Cannot access %s - insufficient permissions or broken symlink (%s). Discarding" % (
+                        filename, error_message))
+                    do_add_file = False
 
             if do_add_file:
                 entry = FileIndexEntry(filename, action, self)
-                self._files[entry.get_uid()] = entry
+                self._files[entry.get_uid_number()] = entry
+                if entry.get_group_id() is not None:
+                    with self._groups_lock:
+                        self._join_group(entry)
                 created_entries.append(entry)
-                self._files_to_postprocess.append(entry.get_uid())
+                if stats.enabled:
+                    stats.count("files.added")
+                if not self._postprocess_closed and len(self._config.extensions_chain) > 0:
+                    self._postprocess_queued += 1
+                    if self._config.postprocess_num_threads > 0:
+                        self._postprocess_queue.put(entry)
+                    else:
+                        # No workers would ever take the file from the queue
+                        self._postprocess(entry)
+            elif stats.enabled:
+                stats.count("files.discarded")
 
         return created_entries
 
+    def close_postprocess_queue(self):
+        """
+        Signals the post-processing workers that no more files will be added. The
+        workers finish once the files already queued are processed.
+        """
+        self._postprocess_closed = True
+        self._postprocess_queue.put(None)
+
+    def is_postprocess_queue_closed(self):
+        return self._postprocess_closed
+
     def post_add_pop(self):
-        if len(self._files_to_postprocess) == 0:
-            return False
+        """
+        Takes the next file from the post-processing queue, waiting for one if
+        the queue is empty, and passes it to the extensions.
 
-        entry = self._files[self._files_to_postprocess.pop(0)]
-        for ext in self._config.extensions_chain:
-            ext.after_file_added(entry)
+        Returns:
+        False if the queue was closed and all the files were taken, True otherwise
+        """
+        entry = self._postprocess_queue.get()
+        if entry is None:
+            # Pass the end marker on to the other workers
+            self._postprocess_queue.put(None)
+            return False
 
+        self._postprocess(entry)
         return True
 
+    def _postprocess(self, entry: FileIndexEntry):
+        """
+        Passes the entry to the extensions.
+        """
+        if self._snapshot is not None:
+            file_key, saved_analyses = self._snapshot.get_analyses(entry.current_name)
+            analyses = {}
+
+        for ext_id, ext in enumerate(self._config.extensions_chain):
+            if stats.enabled:
+                start = perf_counter()
+            try:
+                if self._snapshot is not None and self._snapshot.is_analysis_kept(ext_id):
+                    analyses[ext_id] = self._analyze_and_apply(ext_id, ext, entry, saved_analyses)
+                elif self._process_backend is not None:
+                    self._process_backend.after_file_added(ext_id, ext, entry)
+                else:
+                    ext.after_file_added(entry)
+            except Exception as ex:
+                print_error("Post-processing of %s by extension %s failed: %s" % (
+                    entry.current_name, ext.on_name_query(), str(ex)))
+            if stats.enabled:
+                stats.add_time("%s.after_file_added" % ext.on_name_query(), perf_counter() - start)
+
+        if self._snapshot is not None:
+            self._snapshot.set_analyses(entry.current_name, file_key, analyses)
+
+        with self._postprocess_lock:
+            self._postprocess_done += 1
+
     def get_index_size(self):
         """
         Returns the size of index
@@ -135,94 +408,328 @@ class FileIndex:
         """
         Returns the number of files yet to be post-processed
         """
-        return len(self._files_to_postprocess)
+        return self._postprocess_queued - self._postprocess_done
+
+    def get_postprocess_total(self):
+        """
+        Returns the number of files passed to post-processing so far
+        """
+        return self._postprocess_queued
+
+    def contains(self, entry: FileIndexEntry):
+        return entry.get_uid_number() in self._files
+
+    def get_entry(self, uid: str):
+        """
+        Returns the entry with the unique id given in the textual form, or None
+        """
+        try:
+            return self._files.get(int(uid))
+        except ValueError:
+            return None
 
     def remove(self, item):
-        if isinstance(item, FileIndexEntry):
-            uid = item.get_uid()
-        elif isinstance(item, str) and item in self._files:
-            uid = item
+        """
+        Removes the entry from the index.
 
-        del self._files[uid]
+        Parameters:
+        item: The entry, or its unique id as a number or in the textual form
+        """
+        if isinstance(item, FileIndexEntry):
+            uid = item.get_uid_number()
+        else:
+            uid = int(item)
 
+        entry = self._files.pop(uid)
+        with self._groups_lock:
+            self._leave_group(entry)
+        self._record_removed(entry)
 
     def purge(self):
         """
         Purges the index - removes entries that have been processed
         """
 
-        keys = [key for key in self._files.keys()]
+        keys = [key for key, entry in self._files.items() if len(entry.target_names) == 0]
         for key in keys:
-            if len(self._files[key].target_names) == 0:
-                del self._files[key]
+            self.remove(key)
 
-        self._groups = []
-        groups, _ = self.get_files_by_groups()
-        for group in groups:
-            self._groups.append(group)
+    def move_to_group(self, entry: FileIndexEntry, group_id):
+        """
+        Moves the entry to another group (or out of any group if group_id is None),
+        keeping the group index up to date. Safe to call from multiple threads.
+        """
+        with self._groups_lock:
+            if entry.get_uid_number() in self._files:
+                self._leave_group(entry)
+                entry._group_id = group_id
+                self._join_group(entry)
+            else:
+                entry._group_id = group_id
+
+    def _set_group_size(self, group_id, old_size, new_size):
+        if old_size > 0:
+            same_size = self._groups_by_size[old_size]
+            same_size.discard(group_id)
+            if len(same_size) == 0:
+                del self._groups_by_size[old_size]
+        if new_size > 0:
+            self._groups_by_size.setdefault(new_size, set()).add(group_id)
+
+    def _join_group(self, entry: FileIndexEntry):
+        group_id = entry.get_group_id()
+        if group_id is None:
+            return
+        members = self._groups.setdefault(group_id, {})
+        members[entry.get_uid_number()] = entry
+        self._set_group_size(group_id, len(members) - 1, len(members))
+
+    def _leave_group(self, entry: FileIndexEntry):
+        group_id = entry.get_group_id()
+        members = self._groups.get(group_id)
+        if members is None or entry.get_uid_number() not in members:
+            return
+        del members[entry.get_uid_number()]
+        self._set_group_size(group_id, len(members) + 1, len(members))
+        if len(members) == 0:
+            del self._groups[group_id]
 
     def get_files_by_groups(self):
-        groups = {}
-        ungrouped = []
-
-        for uid, entry in self._files.items():
-            group_id = entry.get_group_id()
-
-            if group_id is not None:
-                if group_id not in groups:
-                    groups[group_id] = []
+        """
+        Returns the entries of each group, ordered by the ids of the entries,
+        and the list of entries not assigned to any group.
+        """
+        with self._groups_lock:
+            groups = {group_id: sorted(members.values(), key=FileIndexEntry.get_uid_number)
+                      for group_id, members in self._groups.items()}
 
-                groups[group_id].append(entry)
-            else:
-                ungrouped.append(entry)
+        groups = dict(sorted(groups.items(), key=lambda group: group[1][0].get_uid_number()))
+        ungrouped = [entry for entry in self._files.values() if entry.get_group_id() is None]
 
         return groups, ungrouped
 
     def get_groups(self):
-        return self._groups
+        return list(self._groups.keys())
+
+    def get_group_members(self, group_id):
+        """
+        Returns the list of entries in the group
+        """
+        with self._groups_lock:
+            return list(self._groups.get(group_id, {}).values())
+
+    def get_group_size(self, group_id):
+        return len(self._groups.get(group_id, {}))
+
+    def get_groups_of_size(self, size):
+        """
+        Returns the ids of the groups having exactly the given number of members
+        """
+        with self._groups_lock:
+            return list(self._groups_by_size.get(size, ()))
 
     def generate_user_input(self):
-        result = ""
-        if len(self._groups) > 0:
+        result = StringIO()
+        self.write_user_input(result)
+        return result.getvalue()
 
-            groups, ungrouped = self.get_files_by_groups()
+    def get_entries_in_order(self):
+        """
+        Returns the entries in the order they are presented to the user: grouped
+        entries first, group by group, followed by the ungrouped ones.
+        """
+        if len(self._groups) == 0:
+            return self._files.values()
+        groups, ungrouped = self.get_files_by_groups()
+        return [entry for entries in groups.values() for entry in entries] + ungrouped
 
-            for group, entries in groups.items():
-                result += "# group %s\n" % group
+    def write_user_input_jsonl(self, stream):
+        """
+        Writes the plan to the stream in JSON Lines format, one entry per line.
+        """
+        for entry in self.get_entries_in_order():
+            entry.write_user_input_jsonl(stream)
 
-                for entry in entries:
-                    result += entry.generate_user_input()
-                result += "\n"
+    def handle_user_input_jsonl(self, user_input):
+        """
+        Applies the plan in JSON Lines format to the index. Entries are looked up
+        by their ids, and the ones not found in the index (or having a different
+        current name) are added to it, so that the plan can be applied without
+        scanning the directories again.
 
-            if len(ungrouped):
-                result += "# ungrouped\n"
+        Parameters:
+        user_input: Iterable of lines
 
-            for entry in ungrouped:
-                result += entry.generate_user_input()
+        Returns:
+        list:Entries having operations to be executed, in the order of appearance
+        """
+        touched = {}
+        for line_number, line in enumerate(user_input, 1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                record = json.loads(line)
+                source = record["source"]
+                targets = [(target["name"], target["action"]) for target in record["targets"]]
+            except (ValueError, KeyError, TypeError) as ex:
+                print_error("Invalid plan entry in line %d: %s" % (line_number, str(ex)))
+                continue
+            if any(action not in FileAction.ALL_ACTIONS for _, action in targets):
+                print_error("Invalid action in line %d" % line_number)
+                continue
+
+            entry = self.get_entry(str(record.get("id", "")))
+            if entry is None or entry.current_name != source:
+                created = self.add([source], FileAction.IGNORE)
+                if len(created) == 0:
+                    continue
+                entry = created[0]
+
+            if all(action == FileAction.RENAME_MOVE and name == source for name, action in targets) \
+                    and entry.get_uid_number() not in touched:
+                # Nothing to do with the file
+                continue
+            if entry.get_uid_number() not in touched:
+                entry.reset()
+                touched[entry.get_uid_number()] = entry
+            for name, action in targets:
+                entry.add_target_name(name, action)
+
+        return list(touched.values())
+
+    def write_user_input(self, stream, entries=None, with_sources=False):
+        """
+        Writes the contents of the editor file to the stream, entry by entry,
+        so that the whole text is never held in memory.
+
+        Parameters:
+        stream: Stream to write to
+        entries: Entries to be written, in the order of presentation; all the
+                 entries of the index if None
+        with_sources: Whether to write the source lines of the entries (see
+                      FileIndexEntry.write_user_input)
+        """
+        if entries is None:
+            if len(self._groups) == 0:
+                for entry in self._files.values():
+                    entry.write_user_input(stream, with_sources)
+                return
+            entries = self.get_entries_in_order()
+
+        with_headers = len(self._groups) > 0
+        current_group = None
+        for position, entry in enumerate(entries):
+            group = entry.get_group_id()
+            if with_headers and (position == 0 or group != current_group):
+                if current_group is not None:
+                    stream.write("\n")
+                if group is not None:
+                    stream.write("# group %s\n" % group)
+                else:
+                    stream.write("# ungrouped\n")
+                current_group = group
+            entry.write_user_input(stream, with_sources)
+
+        if with_headers and current_group is not None:
+            stream.write("\n")
+
+    def handle_user_input(self, user_input, require_sources=False):
+        """
+        Applies the contents of the edited file to the index. The lines are consumed
+        one by one, so the input can be a lazily read file. Lines leaving a file
+        where it is (unchanged "r" lines) are skipped without touching the entry,
+        so only the entries with actual work to do are modified. The lines of an
+        id whose source line names another file than the one of the entry are
+        skipped, as the id no longer refers to the file they were written for.
+
+        Parameters:
+        user_input: Iterable of lines
+        require_sources: Whether to skip the lines of the ids without a source
+                         line before them, as with plans written by a previous run
+
+        Returns:
+        list:Entries having operations to be executed, in the order of appearance.
+             The remaining entries are to be left untouched.
+        """
+        touched = {}
+        in_multiline_value = False
+        # Whether the lines of the id are to be applied: {id: bool}
+        sources = {}
+
+        for line_number, line in enumerate(user_input, 1):
+            line = line.strip()
+            if in_multiline_value:
+                in_multiline_value = line != "<<END"
+                continue
 
-        else:
-            for entry_id, entry in self._files.items():
-                result += entry.generate_user_input()
-        
-        return result
-
-    def handle_user_input(self, user_input:list):
-        for entry_id, entry in self._files.items():
-            entry.reset()
-        for line in user_input:
-            line.strip()
             # Skip empty lines and comment lines
             if len(line) == 0 or line[0] == '#':
                 continue
 
             id, action, name = line.split(None, 2)
-            if id in self._files:
-                entry = self._files[id]
+            if action == '=':
+                # Metadata line, not editable
+                in_multiline_value = name == "<<END"
+                continue
+
+            if action == SOURCE_MARKER:
+                entry = self.get_entry(id)
+                sources[id] = entry is not None and entry.current_name == name
+                if not sources[id]:
+                    print_error("Id %s in line %d does not refer to %s any more, its operations are skipped" % (
+                        id, line_number, name))
+                continue
+            if id not in sources and require_sources:
+                print_error("No source line for id %s in line %d, its operations are skipped" % (id, line_number))
+                sources[id] = False
+            if not sources.get(id, True):
+                continue
+
+            entry = self.get_entry(id)
+            if entry is None:
+                for entry in self.add([name], action):
+                    touched[entry.get_uid_number()] = entry
+            elif entry.get_uid_number() in touched:
                 entry.add_target_name(name, action)
-            else:
-                entry = self.add([name], action)[0]
+            elif action != FileAction.RENAME_MOVE or name != entry.current_name:
+                entry.reset()
+                entry.add_target_name(name, action)
+                touched[entry.get_uid_number()] = entry
+            # Otherwise there is nothing to do with the file, unless other lines say so
 
-    def register_group(self, group_name):
-        if group_name not in self._groups:
-            self._groups.append(group_name)
+        return list(touched.values())
 
+    def retain(self, entries, scope=None):
+        """
+        Removes all the entries from the index, except the listed ones that still
+        have operations assigned.
+
+        Parameters:
+        entries: Entries to be kept if they have operations assigned
+        scope: If given, only the entries in the scope (and the listed ones) are
+               removed; the entries outside of it are kept as they are
+        """
+        if scope is not None:
+            kept = set(entry.get_uid_number() for entry in entries if len(entry.target_names) > 0)
+            for entry in list(scope) + list(entries):
+                if entry.get_uid_number() not in kept and self.contains(entry):
+                    self.remove(entry)
+                elif entry.get_uid_number() in kept:
+                    self._record_changed(entry)
+            return
+
+        files = {entry.get_uid_number(): entry for entry in entries if len(entry.target_names) > 0}
+        if self._changes is not None:
+            for uid, entry in self._files.items():
+                if uid not in files:
+                    self._record_removed(entry)
+            for entry in files.values():
+                self._record_changed(entry)
+        self._files = files
+
+        with self._groups_lock:
+            self._groups = {}
+            self._groups_by_size = {}
+            for entry in self._files.values():
+                self._join_group(entry)
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+from multiprocessing.util import Finalize
+from threading import Lock
+from time import time
+
+
+def get_default_cache_path():
+    cache_dir = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "ifstool", "hashes.sqlite")
+
+
+class HashCache:
+    """
+    Persistent cache of values computed from the file contents (hashes, audio
+    regions), shared between ifstool runs. The values are keyed by the device
+    and inode of the file and the mode of computation; a cached value is only
+    used when the size and modification time of the file did not change.
+
+    The cache is stored in an SQLite database, so that several ifstool processes
+    can use it at the same time. Updates are written in batches, and the least
+    recently used entries are evicted when the cache is closed.
+    """
+
+    DEFAULT_LIMIT = 1000000
+    FLUSH_INTERVAL = 1000
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, path, limit=DEFAULT_LIMIT):
+        self._path = path
+        self._limit = limit
+        self._lock = Lock()
+        self._pending_updates = []
+        self._pending_touches = []
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, mode TEXT,
+                size INTEGER, mtime_ns INTEGER,
+                value TEXT, last_used REAL,
+                PRIMARY KEY (dev, ino, mode))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS hashes_lru ON hashes (last_used)")
+
+    def __getstate__(self):
+        return {"path": self._path, "limit": self._limit}
+
+    def __setstate__(self, state):
+        # A copy in a worker process opens its own connection, and writes its
+        # pending updates when the worker exits
+        self.__init__(state["path"], state["limit"])
+        Finalize(self, self.flush, exitpriority=10)
+
+    def get(self, stat_result, mode):
+        """
+        Returns the cached value for the file, or None if there is no valid one.
+
+        Parameters:
+        stat_result: Result of os.stat() for the file
+        mode: Name of the computation the value comes from
+        """
+        key = (stat_result.st_dev, stat_result.st_ino, mode)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, value FROM hashes WHERE dev=? AND ino=? AND mode=?", key).fetchone()
+            if row is None or row[0] != stat_result.st_size or row[1] != stat_result.st_mtime_ns:
+                return None
+            self._pending_touches.append((time(),) + key)
+            self._flush_if_needed()
+        return row[2]
+
+    def put(self, stat_result, mode, value):
+        with self._lock:
+            self._pending_updates.append((
+                stat_result.st_dev, stat_result.st_ino, mode,
+                stat_result.st_size, stat_result.st_mtime_ns,
+                value, time()))
+            self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._pending_updates) + len(self._pending_touches) >= self.FLUSH_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending_updates)
+            self._db.executemany("UPDATE hashes SET last_used=? WHERE dev=? AND ino=? AND mode=?", self._pending_touches)
+        self._pending_updates = []
+        self._pending_touches = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Writes the pending updates and evicts the least recently used entries
+        exceeding the size limit.
+        """
+        with self._lock:
+            self._flush()
+            with self._db:
+                count = self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+                if count > self._limit:
+                    self._db.execute(
+                        "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                        (count - self._limit,))
+            self._db.close()
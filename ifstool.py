@@ -1,35 +1,118 @@
 import getopt
-from sys import argv
-from os import getenv
+import re
+from sys import argv, stdout, stdin, stderr
+from os import getenv, unlink
 import tempfile
 import subprocess
+from copy import copy
 from file_index import FileIndex
 from file_action import FileAction
+from file_check import FileCheck
+from action_planner import plan_operations, PlannedOperation
 from configuration import Configuration
 from os_abstraction import IOSAbstraction, OSAbstraction
 from extension import Extension
 from extension_handler import use_extension, get_extensions
 from console_output import print_status, create_progress_bar, print_message
-from console_output import print_error
+from console_output import print_error, print_warning, use_stream
 from threading import Thread
-from time import sleep
-from os_abstraction import get_file_list_recursive, get_file_list_nonrecursive
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
+from tree_walker import TreeWalker
+from walk_filter import parse_size, parse_time
+from hash_cache import HashCache, get_default_cache_path
+from process_backend import ProcessBackend
+from stats import stats
+from journal import Journal, load_journal, get_default_journal_path, has_unfinished_execution
+from snapshot import Snapshot, get_default_snapshot_path
+from chunker import split_into_chunks, ALL_CHUNK_MODES, DEFAULT_CHUNK_SIZE
 
+EDITOR_FILE_BUFFER_SIZE = 1 << 20
+PLAN_FORMAT_TEXT = "text"
+PLAN_FORMAT_JSONL = "jsonl"
+ALL_PLAN_FORMATS = [PLAN_FORMAT_TEXT, PLAN_FORMAT_JSONL]
 
-def get_user_input(user_input_string, editor_cmd):
-    result = []
 
+def get_user_input(file_index: FileIndex, editor_cmd, entries: list = None):
+    """
+    Lets the user edit the contents of the index in the editor, then yields
+    the lines of the edited file as they are read.
+    """
+    return edit_user_input(prepare_user_input(file_index, entries), editor_cmd)
+
+
+def prepare_user_input(file_index: FileIndex, entries: list = None):
+    """
+    Writes the editor file for the entries given (all the entries of the index
+    if None), skipping the entries no longer in the index.
+
+    Returns:
+    str:Name of the temporary file, to be passed to edit_user_input()
+    """
+    if entries is not None:
+        entries = [entry for entry in entries if file_index.contains(entry)]
+    with tempfile.NamedTemporaryFile("w", buffering=EDITOR_FILE_BUFFER_SIZE, delete=False) as tf:
+        file_index.write_user_input(tf, entries)
+    return tf.name
+
+
+def edit_user_input(file_name, editor_cmd):
+    """
+    Opens the editor file prepared by prepare_user_input() in the editor, then
+    yields the lines of the edited file as they are read. The file is removed
+    once it has been read.
+    """
     editor = editor_cmd  # TODO: parse command with arguments
-    tf = tempfile.NamedTemporaryFile("w+")
-    tf.write(user_input_string)
-    tf.flush()
-    editor = subprocess.run([editor, tf.name])
-    tf.seek(0, 0)
+    try:
+        subprocess.run([editor, file_name])
+
+        # The editor may have replaced the file rather than written into it,
+        # so it is opened again by name
+        with open(file_name, "r", buffering=EDITOR_FILE_BUFFER_SIZE) as edited_file:
+            for line in edited_file:
+                yield line.strip()
+    finally:
+        unlink(file_name)
+
+
+def write_plan(file_index: FileIndex, plan_file, plan_format):
+    """
+    Writes the plan (the contents of the editor file) to the file, or to the
+    standard output if the file name is "-".
+    """
+    if plan_file == "-":
+        write_plan_to_stream(file_index, stdout, plan_format)
+        stdout.flush()
+    else:
+        with open(plan_file, "w", buffering=EDITOR_FILE_BUFFER_SIZE) as f:
+            write_plan_to_stream(file_index, f, plan_format)
 
-    for line in tf:
-        result.append(line.strip())
 
-    return result
+def write_plan_to_stream(file_index: FileIndex, stream, plan_format):
+    if plan_format == PLAN_FORMAT_JSONL:
+        file_index.write_user_input_jsonl(stream)
+    else:
+        file_index.write_user_input(stream, with_sources=True)
+
+
+def read_plan(plan_file):
+    """
+    Yields the lines of the plan read from the file, or from the standard input
+    if the file name is "-".
+    """
+    if plan_file == "-":
+        for line in stdin:
+            yield line.strip()
+    else:
+        with open(plan_file, "r", buffering=EDITOR_FILE_BUFFER_SIZE) as f:
+            for line in f:
+                yield line.strip()
+
+
+def handle_plan(file_index: FileIndex, lines, plan_format):
+    if plan_format == PLAN_FORMAT_JSONL:
+        return file_index.handle_user_input_jsonl(lines)
+    return file_index.handle_user_input(lines, require_sources=True)
 
 
 def do_action_copy_move_common(current_name: str, target_name: str, action: str, os: IOSAbstraction, conf: Configuration):
@@ -108,8 +191,10 @@ def do_action_copy_move_common(current_name: str, target_name: str, action: str,
             print_error(msg)
             remarks.append(msg)
             return (False, remarks)
+        return (True, remarks)
 
-    return (True, remarks)
+    # Declined by the user
+    return (None, remarks)
 
 
 def do_action_delete(current_name: str, os: IOSAbstraction, conf: Configuration):
@@ -123,46 +208,316 @@ def do_action_delete(current_name: str, os: IOSAbstraction, conf: Configuration)
             print_error(msg)
             remarks.append(msg)
             return (False, remarks)
+        return (True, remarks)
 
-    return (True, remarks)
+    return (None, remarks)
 
 
-def execute_actions(file_index: FileIndex, os: IOSAbstraction, conf: Configuration):
-    files = file_index.get_all()
-    operations_done = 0
+def do_action_rename_through_temporary(op: PlannedOperation, os: IOSAbstraction, conf: Configuration):
+    """
+    Executes a half of a rename split by the planner. The user is asked about the
+    whole rename at the first half, and the second half follows without questions.
+    If the second half fails, the file is moved back to its original name.
+    """
+    remarks = []
+    if op.part == PlannedOperation.TO_TEMPORARY:
+        msg = "Rename \"%s\" to \"%s\" (through a temporary name \"%s\")?" % (op.source, op.partner.target, op.target)
+        if conf.prompt_on_actions and not os.ask_for_confirmation(msg):
+            return (None, remarks)
 
-    for uid, file in files.items():
-        new_target_names = []
-        for target_name, action in file.target_names:
+        result, error_message = os.rename_move(op.source, op.target)
+        if not result:
+            msg = "Could not rename \"%s\" to a temporary name \"%s\": %s" % (op.source, op.target, error_message)
+            print_error(msg)
+            remarks.append(msg)
+        return (result, remarks)
 
-            if action in [FileAction.RENAME_MOVE, FileAction.COPY, FileAction.LINK] \
-                    and file.current_name != target_name:
+    unprompted_conf = copy(conf)
+    unprompted_conf.prompt_on_actions = False
+    result, remarks = do_action_copy_move_common(op.source, op.target, op.action, os, unprompted_conf)
+    if not result:
+        restore_from_temporary(op, os, remarks)
+    return (result, remarks)
 
-                result, remarks = do_action_copy_move_common(file.current_name, target_name, action, os, conf)
-                if result:
-                    operations_done += 1
-                else:
-                    file.remarks += remarks
-                    new_target_names.append((target_name, action))
 
-            elif action == FileAction.DELETE:
-                result, remarks = do_action_delete(file.current_name, os, conf)
-                if result:
-                    operations_done += 1
-                else:
-                    file.remarks += remarks
-                    new_target_names.append((target_name, action))
+def restore_from_temporary(op: PlannedOperation, os: IOSAbstraction, remarks: list):
+    """
+    Moves the file back from the temporary name to its original name, after the
+    second half of a split rename could not be done. If another file has taken
+    the original name in the meantime, the file is left under the temporary name.
+    """
+    original_name = op.partner.source
+    if _exists(os, original_name):
+        msg = "Could not restore \"%s\" from the temporary name \"%s\": file already exists; " \
+              "the file is left as \"%s\"" % (original_name, op.source, op.source)
+        print_error(msg)
+        remarks.append(msg)
+        return
+
+    restored, error_message = os.rename_move(op.source, original_name)
+    if not restored:
+        msg = "Could not restore \"%s\" from the temporary name \"%s\": %s" % (original_name, op.source, error_message)
+        print_error(msg)
+        remarks.append(msg)
+
+
+def run_operations(operations: list, os: IOSAbstraction, conf: Configuration, journal: Journal = None,
+                   moved_to_temporary: set = None):
+    """
+    Executes the planned operations in the order given, recording their results
+    in the journal (if given). The result of an operation is True if it has been
+    done, False if it failed, or None if it has been declined by the user. The
+    operations depending on an operation that has not been done are skipped,
+    and fail with a remark.
+
+    Parameters:
+    moved_to_temporary: Set of the first halves of split renames done already
+
+    Returns:
+    generator:Tuples of the operation, its result and the remarks
+    """
+    if moved_to_temporary is None:
+        moved_to_temporary = set()
+    # Operations that failed, were declined or were skipped
+    not_done = set()
+
+    for op in operations:
+        if op.part == PlannedOperation.FROM_TEMPORARY and op.partner not in moved_to_temporary:
+            continue
+
+        blocker = next((predecessor for predecessor in op.get_predecessors() if predecessor in not_done), None)
+        if blocker is not None:
+            msg = "Skipped, as it depends on the operation \"%s\", which has not been done" % blocker
+            print_error("%s: %s" % (op, msg))
+            result, remarks = (False, [msg])
+            if op.part == PlannedOperation.FROM_TEMPORARY:
+                restore_from_temporary(op, os, remarks)
+        elif op.part == PlannedOperation.FROM_TEMPORARY:
+            result, remarks = do_action_rename_through_temporary(op, os, conf)
+        elif op.part == PlannedOperation.TO_TEMPORARY:
+            result, remarks = do_action_rename_through_temporary(op, os, conf)
+            if result:
+                moved_to_temporary.add(op)
+                if journal is not None:
+                    journal.record(op, Journal.DONE)
+                continue
+        elif op.action == FileAction.DELETE:
+            result, remarks = do_action_delete(op.source, os, conf)
+        else:
+            if op.action == FileAction.COPY and journal is not None \
+                    and (conf.allow_overwriting or not _exists(os, op.target)):
+                # Tells that the target may be overwritten when resuming, as it
+                # is either written by this copy or allowed to be overwritten
+                journal.record(op, Journal.STARTED)
+            result, remarks = do_action_copy_move_common(op.source, op.target, op.action, os, conf)
+
+        if not result:
+            not_done.add(op)
+        if journal is not None:
+            journal.record(op, Journal.DONE if result else Journal.SKIPPED if result is None else Journal.FAILED)
+        yield (op, result, remarks)
+
+
+def execute_actions(file_index: FileIndex, os: IOSAbstraction, conf: Configuration, entries: list = None,
+                    journal: Journal = None, scope: list = None):
+    """
+    Executes the operations assigned to the entries, in the order determined by
+    the planner, then keeps in the index only the entries whose operations have
+    not been done. If the list of entries is given, the other entries are
+    considered to have nothing to do. If the scope is given, only the entries
+    in the scope are considered so, and the rest of the index is kept.
+    """
+    if entries is None:
+        entries = list(file_index.get_all().values())
+    operations_done = 0
+    failed_targets = {}
 
-            elif action == FileAction.IGNORE:
-                new_target_names.append((target_name, action))
+    operations = plan_operations(entries, os)
+    if journal is not None:
+        journal.begin(operations)
 
-        file.target_names = new_target_names
+    for op, result, remarks in run_operations(operations, os, conf, journal):
+        if stats.enabled:
+            stats.count("operations.done" if result else "operations.declined" if result is None else "operations.failed")
+        # A declined operation counts as done, as there is nothing more to do about it
+        if result is not False:
+            operations_done += 1
+        else:
+            op.entry.remarks += remarks
+            failed_targets.setdefault(op.entry, set()).add((op.target_name, op.action))
 
-    file_index.purge()
+    for file in entries:
+        failed = failed_targets.get(file, ())
+        file.target_names = [(target_name, action) for target_name, action in file.target_names
+                             if action == FileAction.IGNORE or (target_name, action) in failed]
+
+    file_index.retain(entries, scope)
 
     return (operations_done, file_index.get_size())
 
 
+def run_chunked_sessions(file_index: FileIndex, os: IOSAbstraction, conf: Configuration, roots: list,
+                         journal: Journal = None):
+    """
+    Lets the user edit the index in chunks, one editor session per chunk, and
+    executes the operations of each chunk before opening the next one. The
+    editor file of the next chunk is prepared in the background while the
+    current one is edited and executed.
+
+    Parameters:
+    roots: Scanned directories, used to split the index by the top-level directories
+
+    Returns:
+    int:Number of operations done
+    """
+    chunks = split_into_chunks(file_index.get_entries_in_order(), conf.chunk_mode, conf.chunk_size, roots)
+    editor_cmd = getenv('EDITOR', 'vi')
+    operations_done = 0
+    # Entries changed by the chunks done so far; the editor files prepared
+    # before the change are outdated if they contain any of them
+    touched = set()
+
+    with ThreadPoolExecutor(1) as executor:
+        next_file = executor.submit(prepare_user_input, file_index, chunks[0]) if len(chunks) > 0 else None
+        try:
+            for chunk_id, chunk in enumerate(chunks):
+                file_name = next_file.result()
+                next_file = None
+                if chunk_id + 1 < len(chunks):
+                    next_file = executor.submit(prepare_user_input, file_index, chunks[chunk_id + 1])
+
+                if not any(file_index.contains(entry) for entry in chunk):
+                    unlink(file_name)
+                    continue
+                if any(entry.get_uid_number() in touched for entry in chunk):
+                    unlink(file_name)
+                    file_name = prepare_user_input(file_index, chunk)
+
+                os.show_info("Editing chunk %d of %d" % (chunk_id + 1, len(chunks)))
+                with stats.phase("editor"):
+                    entries = file_index.handle_user_input(edit_user_input(file_name, editor_cmd))
+                with stats.phase("execute"):
+                    ops_done, _ = execute_actions(file_index, os, conf, entries, journal, chunk)
+                operations_done += ops_done
+                touched.update(entry.get_uid_number() for entry in entries)
+        finally:
+            # Do not leave the file of a chunk that will not be edited
+            if next_file is not None:
+                unlink(next_file.result())
+
+    return operations_done
+
+
+def _exists(os: IOSAbstraction, path):
+    return os.isfile(path) or os.isdir(path)
+
+
+def _is_already_done(op, os: IOSAbstraction):
+    """
+    Checks whether an operation without a result in the journal has been done
+    before the execution was interrupted.
+    """
+    if op.action == FileAction.DELETE:
+        return not _exists(os, op.source)
+    if op.action == FileAction.RENAME_MOVE:
+        return not _exists(os, op.source) and _exists(os, op.target)
+    if op.action == FileAction.LINK:
+        return _exists(os, op.target)
+    # A copy might have been interrupted in the middle, so it is always repeated
+    return False
+
+
+def resume_actions(journal_file, os: IOSAbstraction, conf: Configuration, journal: Journal = None):
+    """
+    Executes the operations of the last plan in the journal that have not been
+    done yet.
+
+    Returns:
+    tuple:Number of operations done and number of operations that failed
+    """
+    sections = load_journal(journal_file)
+    if len(sections) == 0 or sections[-1][2]:
+        os.show_info("Nothing to resume in %s" % journal_file)
+        return (0, 0)
+
+    operations, _, _ = sections[-1]
+    os.invalidate_cache()
+    moved_to_temporary = set()
+    pending = []
+    for op in operations:
+        if op.state is None and _is_already_done(op, os):
+            op.state = Journal.DONE
+            if journal is not None:
+                journal.record(op, Journal.DONE)
+        if op.state is None:
+            pending.append(op)
+        elif op.part == PlannedOperation.TO_TEMPORARY and op.state == Journal.DONE \
+                and op.partner is not None and op.partner.state is None:
+            moved_to_temporary.add(op)
+
+    os.show_info("Resuming %d of %d operations" % (len(pending), len(operations)))
+    overwriting_conf = copy(conf)
+    overwriting_conf.allow_overwriting = True
+    operations_done = 0
+    operations_failed = 0
+    for op in pending:
+        # A copy interrupted in the middle leaves an incomplete target file behind.
+        # Any other existing target is not overwritten, as in a normal run.
+        op_conf = overwriting_conf if op.action == FileAction.COPY and op.started and _exists(os, op.target) else conf
+        for _, result, _ in run_operations([op], os, op_conf, journal, moved_to_temporary):
+            if result is False:
+                operations_failed += 1
+            else:
+                operations_done += 1
+
+    return (operations_done, operations_failed)
+
+
+def undo_actions(journal_file, os: IOSAbstraction, conf: Configuration, journal: Journal = None):
+    """
+    Reverts the operations recorded in the journal as done, starting from the
+    last one. Deletions cannot be reverted.
+
+    Returns:
+    tuple:Number of operations reverted and number of operations that could not be
+    """
+    operations_undone = 0
+    operations_failed = 0
+    for operations, completed, _ in reversed(load_journal(journal_file)):
+        for op in reversed(completed):
+            if op.state == Journal.UNDONE:
+                continue
+            if op.part == PlannedOperation.TO_TEMPORARY and op.partner is not None \
+                    and op.partner.state == Journal.FAILED:
+                # The file has been moved back already when the second half failed
+                continue
+
+            if op.action == FileAction.DELETE:
+                print_error("Cannot restore deleted file \"%s\"" % op.source)
+                result = False
+            elif op.action == FileAction.RENAME_MOVE:
+                if _exists(os, op.source):
+                    print_error("Cannot move \"%s\" back to \"%s\": file already exists" % (op.target, op.source))
+                    result = False
+                elif conf.prompt_on_actions and not os.ask_for_confirmation("Move \"%s\" back to \"%s\"?" % (op.target, op.source)):
+                    result = None
+                else:
+                    result, error_message = os.rename_move(op.target, op.source)
+                    if not result:
+                        print_error("Could not move \"%s\" back to \"%s\": %s" % (op.target, op.source, error_message))
+            else:
+                result, _ = do_action_delete(op.target, os, conf)
+
+            if result:
+                operations_undone += 1
+                if journal is not None:
+                    journal.record_undo(op)
+            elif result is False:
+                operations_failed += 1
+
+    return (operations_undone, operations_failed)
+
+
 def display_help():
     str_extensions = ""
     for ext_name, ext_class in get_extensions().items():
@@ -176,40 +531,171 @@ using a text editor, in a way similar to interactive rebase feature of Git SCM.
 USAGE: ifstool [options] directory1 [[-n] directory2 [[-n] directory_n]]\n
 Options available:
   -n, --nonrecursive=dirname  Do not enter subdirectories of the directory specified
+  -a, --apply-plan=path       Apply the plan from the file (or standard input if "-") instead of
+                              launching the editor. A plan in text format refers to the files by
+                              their ids, so the same directories have to be given as when it was
+                              dumped; the operations of the ids that refer to other files than
+                              when it was dumped are skipped. A plan in jsonl format can be
+                              applied without any directories.
   -A, --absolute-paths        Use absolute paths in the input.
+      --dump-plan=path        Write the plan to the file (or standard output if "-") instead of
+                              launching the editor, and exit without doing any operations.
   -D, --default-action=actn   Select default action for each file:
                               r - rename/move    d - delete
                               c - copy           l - link
                               i - ignore
   -c, --create-directories    Create new directories, if needed.
+      --chunks=mode[:N]       Split the index into chunks of at most N files (default: %d), each
+                              edited in a separate editor session and executed before the next
+                              one is opened. Modes available:
+                              count - consecutive files
+                              dir - files under the same top-level directory
+                              group - whole groups of files (e.g. duplicates found by the
+                                      df extension); ungrouped files are split by count
+                              Ignored when the plan is dumped or applied.
+      --exclude=glob          Skip the files and directories matching the pattern. Patterns
+                              containing "/" are matched against the path relative to the scanned
+                              directory, other ones against the name. Can be given many times.
+      --exclude-regex=regex   Skip the files and directories whose path relative to the scanned
+                              directory matches the regular expression. The paths of directories
+                              end with "/".
+  -F, --file-checks=checks    Comma-separated list of checks done on each file before it
+                              is added to the index (or "none"):
+                              broken - discard broken symlinks
+                              readable - discard files without read permission
+                              Both checks are done by default.
+  -H, --hash-cache            Keep the hashes computed by extensions in a persistent cache,
+                              so that unchanged files are not read again in the next runs.
+      --hash-cache-file=path  Location of the hash cache (implies -H). The default location
+                              is %s.
+      --hash-cache-limit=N    Maximum number of entries in the hash cache (default: %d).
+                              The least recently used ones are evicted.
+      --journal               Keep a journal of the operations executed, which allows to resume
+                              interrupted execution or revert it.
+      --journal-file=path     Location of the journal (implies --journal). The default location
+                              is %s.
+      --discard-journal       Start anew even if the journal holds an unfinished execution, which
+                              is otherwise refused, as the journal gets overwritten.
+      --journal-sync=secs     Maximum time between writing the journal records to the disk
+                              (default: %.1f). Use 0 to write them after each operation.
+      --resume                Execute the operations remaining from an interrupted run,
+                              according to the journal, without scanning the directories.
+                              Uses the journal at the default location, unless --journal-file
+                              is given.
+      --undo                  Revert the operations done according to the journal.
+      --include=glob          Take only the files matching any of the patterns given this way,
+                              or by --include-regex.
+      --include-regex=regex   Take only the files whose path relative to the scanned directory
+                              matches any of the regular expressions given this way, or by --include.
+  -j, --jobs=N                Number of threads post-processing the files (default: 2).
+  -J, --scan-jobs=N           Number of threads listing the directories in parallel.
+      --max-depth=N           Enter at most N levels of subdirectories (0 - none).
+      --min-size=size         Take only the files of at least the size given (suffixes: k, M, G, T).
+      --max-size=size         Take only the files of at most the size given.
+      --newer-than=time       Take only the files modified after the time, given as an age
+                              (like 12h, 30d, 2w) or an ISO date (like 2024-01-31T12:00).
+      --older-than=time       Take only the files modified before the time.
+      --one-filesystem        Do not enter directories on other filesystems.
   -m, --multistage            Enable multi-stage mode; keep reopening the editor as long
                               as there are files that have not been processed.
   -o, --allow-overwriting     Allow overwriting existing files.
+      --plan-format=format    Format of the plan dumped or applied:
+                              text - the format of the editor file (default)
+                              jsonl - JSON Lines, one entry with its name and targets per line
+  -p, --preserve-metadata     Preserve permission bits and timestamps of copied files.
+  -P, --process-pool          Run the post-processing of files by extensions in a pool of
+                              worker processes (of the size set by -j) instead of threads.
+                              Used for the extensions that support it.
+      --stats                 Show the timings of the phases, extension hooks, counters of
+                              files and filesystem calls, and queue depths at the end.
+      --stats-file=path       Write the statistics to a file, in JSON format.
+      --snapshot              Keep a snapshot of the scanned tree and of the analyses of the files
+                              done by extensions, so that the next runs only list the directories
+                              that have changed (had files created, removed or renamed in them)
+                              and only analyze the files that have changed.
+      --snapshot-file=path    Location of the snapshot (implies --snapshot). The default location
+                              is %s.
   -s, --simulate              Simulation mode - show the actions that would be done, but without
                               triggering any actual actions in the filesystem.
+      --stat-cache-ttl=secs   How long the information about existing files and directories
+                              is cached while executing the operations (default: 60).
+                              Use 0 to disable the cache, or "inf" to keep it for the whole run.
+  -W, --walk-order=order      Order in which the directory tree is traversed:
+                              depth - depth-first (default)
+                              breadth - breadth-first
   -x, --extension=name:[args] Use an extension. Available extensions are:
 %s
                               Use --extension=<name>:help for details on the extension
   -x, --extension=extname     Use the extension by the name specified
   -y, --yes-to-all            Do not ask for confirmation at actions, assume \"yes\" response
                               for all questions
-""" % str_extensions)
+""" % (DEFAULT_CHUNK_SIZE, get_default_cache_path(), HashCache.DEFAULT_LIMIT,
+       get_default_journal_path(), Journal.DEFAULT_SYNC_INTERVAL, get_default_snapshot_path(), str_extensions))
     exit(1)
 
 
+def parse_number(option: str, value: str, minimum, number_type=int, maximum=None):
+    """
+    Converts the value of a numeric option, exiting with an error if it is not
+    a number or is out of the range given. A bound of None is not checked.
+    """
+    try:
+        number = number_type(value)
+    except ValueError:
+        number = None
+    if number is None or number != number or (minimum is not None and number < minimum) \
+            or (maximum is not None and number > maximum):
+        print_error("Incorrect value of %s: %s" % (option, value))
+        exit(1)
+    return number
+
+
 def parse_input_args(args:list, config:Configuration, os_abs: IOSAbstraction):
     dirs_recursive = []
     dirs_nonrecursive = []
 
-    options, remainder = getopt.gnu_getopt(args, "n:AD:cdj:mosx:y", [
+    options, remainder = getopt.gnu_getopt(args, "n:a:AD:cdF:Hj:J:mopPsW:x:y", [
         "nonrecursive=",
         "default-action=",
+        "dump-plan=",
+        "apply-plan=",
         "absolute-paths",
+        "chunks=",
         "create-directories",
-        "jobs",
+        "exclude=",
+        "exclude-regex=",
+        "file-checks=",
+        "hash-cache",
+        "hash-cache-file=",
+        "hash-cache-limit=",
+        "include=",
+        "include-regex=",
+        "jobs=",
+        "journal",
+        "journal-file=",
+        "discard-journal",
+        "journal-sync=",
+        "scan-jobs=",
+        "max-depth=",
+        "max-size=",
+        "min-size=",
         "multistage",
+        "newer-than=",
+        "older-than=",
+        "one-filesystem",
         "allow-overwriting",
+        "plan-format=",
+        "preserve-metadata",
+        "process-pool",
+        "resume",
         "simulate",
+        "snapshot",
+        "snapshot-file=",
+        "stat-cache-ttl=",
+        "stats",
+        "stats-file=",
+        "undo",
+        "walk-order=",
         "extension=",
         "yes-to-all",
         "help"])
@@ -217,6 +703,16 @@ def parse_input_args(args:list, config:Configuration, os_abs: IOSAbstraction):
     for option, value in options:
         if option in ['-n', '--nonrecursive']:
             dirs_nonrecursive.append(value)
+        if option in ['-a', '--apply-plan']:
+            config.apply_plan_file = value
+        if option in ['--dump-plan']:
+            config.dump_plan_file = value
+        if option in ['--plan-format']:
+            if value in ALL_PLAN_FORMATS:
+                config.plan_format = value
+            else:
+                print_error("Incorrect plan format: %s" % value)
+                exit(1)
         if option in ['-A', '--absolute-paths']:
             config.use_absolute_paths = True
         if option in ['-D', '--default-action']:
@@ -225,18 +721,107 @@ def parse_input_args(args:list, config:Configuration, os_abs: IOSAbstraction):
             else:
                 print_error("Incorrect action: %s" % value)
                 exit(1)
+        if option in ['--chunks']:
+            mode, _, size = value.partition(':')
+            if mode not in ALL_CHUNK_MODES:
+                print_error("Incorrect chunk mode: %s" % mode)
+                exit(1)
+            config.chunk_mode = mode
+            if len(size) > 0:
+                config.chunk_size = parse_number("chunk size", size, 1)
         if option in ['-c', '--create-directories']:
             config.create_directories = True
         if option in ['-d', '--include-dirs']:
             config.include_directories = True
+        if option in ['--exclude']:
+            config.walk_filter.exclude(value)
+        if option in ['--exclude-regex', '--include-regex']:
+            try:
+                if option == '--exclude-regex':
+                    config.walk_filter.exclude_regex(value)
+                else:
+                    config.walk_filter.include_regex(value)
+            except re.error as ex:
+                print_error("Incorrect regular expression %s: %s" % (value, str(ex)))
+                exit(1)
+        if option in ['--include']:
+            config.walk_filter.include(value)
+        if option in ['--max-depth']:
+            config.walk_filter.max_depth = parse_number(option, value, 0)
+        if option in ['--min-size', '--max-size', '--newer-than', '--older-than']:
+            try:
+                if option == '--min-size':
+                    config.walk_filter.min_size = parse_size(value)
+                if option == '--max-size':
+                    config.walk_filter.max_size = parse_size(value)
+                if option == '--newer-than':
+                    config.walk_filter.newer_than = parse_time(value)
+                if option == '--older-than':
+                    config.walk_filter.older_than = parse_time(value)
+            except ValueError as ex:
+                print_error(str(ex))
+                exit(1)
+        if option in ['--one-filesystem']:
+            config.walk_filter.one_filesystem = True
+        if option in ['-F', '--file-checks']:
+            config.file_checks = []
+            if value != "none":
+                for check in value.split(','):
+                    if check not in FileCheck.ALL_CHECKS:
+                        print_error("Incorrect file check: %s" % check)
+                        exit(1)
+                    config.file_checks.append(check)
+        if option in ['-H', '--hash-cache']:
+            if config.hash_cache_file is None:
+                config.hash_cache_file = get_default_cache_path()
+        if option in ['--hash-cache-file']:
+            config.hash_cache_file = value
+        if option in ['--hash-cache-limit']:
+            config.hash_cache_limit = parse_number(option, value, 0)
         if option in ['-j', '--jobs']:
-            config.postprocess_num_threads = int(value)
+            config.postprocess_num_threads = parse_number(option, value, 0)
+        if option in ['--journal']:
+            if config.journal_file is None:
+                config.journal_file = get_default_journal_path()
+        if option in ['--journal-file']:
+            config.journal_file = value
+        if option in ['--discard-journal']:
+            config.discard_journal = True
+        if option in ['--journal-sync']:
+            config.journal_sync_interval = parse_number(option, value, 0, float)
+        if option in ['-J', '--scan-jobs']:
+            config.scan_num_threads = parse_number(option, value, 1)
         if option in ['-m', '--multistage']:
             config.multistage_mode = True
         if option in ['-o', '--allow-overwriting']:
             config.allow_overwriting = True
+        if option in ['-p', '--preserve-metadata']:
+            config.preserve_metadata = True
+        if option in ['-P', '--process-pool']:
+            config.use_process_pool = True
+        if option in ['--resume']:
+            config.resume_mode = True
         if option in ['-s', '--simulate']:
             config.simulation_mode = True
+        if option in ['--snapshot']:
+            if config.snapshot_file is None:
+                config.snapshot_file = get_default_snapshot_path()
+        if option in ['--snapshot-file']:
+            config.snapshot_file = value
+        if option in ['--stats']:
+            config.show_stats = True
+        if option in ['--stats-file']:
+            config.stats_file = value
+        if option in ['--stat-cache-ttl']:
+            config.stat_cache_ttl = None if value == "inf" else parse_number(option, value, 0, float)
+        if option in ['--undo']:
+            config.undo_mode = True
+        if option in ['-W', '--walk-order']:
+            if value in TreeWalker.ALL_ORDERS:
+                config.walk_order = value
+            else:
+                print_error("Incorrect walk order: %s" % value)
+                exit(1)
         if option in ['-x', '--extension']:
             use_extension(config, os_abs, value)
         if option in ['-y', '--yes-to-all']:
@@ -247,37 +832,136 @@ def parse_input_args(args:list, config:Configuration, os_abs: IOSAbstraction):
     for dir_name in remainder:
         dirs_recursive.append(dir_name)
 
+    if config.dump_plan_file is not None and config.apply_plan_file is not None:
+        print_error("--dump-plan and --apply-plan cannot be used together")
+        exit(1)
+    if config.apply_plan_file == "-" and config.prompt_on_actions:
+        print_error("The plan is read from the standard input, so the questions cannot be answered; use -y")
+        exit(1)
+
     return (dirs_nonrecursive, dirs_recursive)
 
-_index_fully_populated = False
+def postproc_worker(file_index: FileIndex, instance_id: int):
+    last_status_time = 0
+    while file_index.post_add_pop():
+        if instance_id == 0 and file_index.is_postprocess_queue_closed() and monotonic() - last_status_time > 0.1:
+            total_files = file_index.get_postprocess_total()
+            files_postprocessed = total_files - file_index.get_postprocess_queue_size()
+            print_status("Post-processing: %s %3d%%" % (
+                create_progress_bar(files_postprocessed, total_files, 50),
+                files_postprocessed * 100 / total_files))
+            last_status_time = monotonic()
 
 
-def postproc_worker(file_index: FileIndex, instance_id: int):
-    global _index_fully_populated
-    while file_index.post_add_pop() or not _index_fully_populated:
-        if _index_fully_populated:
-            if instance_id == 0:
-                total_files = file_index.get_index_size()
-                files_postprocessed = total_files - file_index.get_postprocess_queue_size()
-                print_status("Post-processing: %s %3d%%" % (
-                    create_progress_bar(files_postprocessed, total_files, 50),
-                    files_postprocessed * 100 / total_files))
+def notify_index_complete(file_index: FileIndex, config: Configuration):
+    for extension in config.extensions_chain:
+        if stats.enabled:
+            start = perf_counter()
+            extension.on_index_complete(file_index)
+            stats.add_time("%s.on_index_complete" % extension.on_name_query(), perf_counter() - start)
+        else:
+            extension.on_index_complete(file_index)
+    # The next stage is to be given only the changes done from now on
+    file_index.take_changes()
+
+
+def notify_index_changed(file_index: FileIndex, config: Configuration):
+    """
+    Passes the changes done by the previous stage of the multi-stage mode to the
+    extensions, so that they do not need to process the whole index again.
+    """
+    removed, changed = file_index.take_changes()
+    for extension in config.extensions_chain:
+        if stats.enabled:
+            start = perf_counter()
+            extension.on_index_changed(file_index, removed, changed)
+            stats.add_time("%s.on_index_changed" % extension.on_name_query(), perf_counter() - start)
+        else:
+            extension.on_index_changed(file_index, removed, changed)
+
+
+def run_from_journal(config: Configuration, os_abs: IOSAbstraction):
+    """
+    Resumes or reverts the execution recorded in the journal.
+    """
+    if config.journal_file is None:
+        config.journal_file = get_default_journal_path()
+    if not os_abs.isfile(config.journal_file):
+        print_error("No journal to resume or revert")
+        exit(1)
+
+    journal = None
+    if not config.simulation_mode:
+        journal = Journal(config.journal_file, config.journal_sync_interval, append=True)
+    try:
+        if config.undo_mode:
+            undone, failed = undo_actions(config.journal_file, os_abs, config, journal)
+            os_abs.show_info("%d operations reverted, %d could not be reverted" % (undone, failed))
+            # The operations not done are not to be resumed after the reverted ones
+            if journal is not None:
+                journal.finish()
         else:
-            # simple rate limiting, preventing the worker threads from consuming to much IO
-            # while the index is still being built.
-            sleep(0.05)
+            done, failed = resume_actions(config.journal_file, os_abs, config, journal)
+            os_abs.show_info("%d operations done, %d failed" % (done, failed))
+            if journal is not None:
+                journal.finish()
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def report_stats(config: Configuration):
+    if config.show_stats:
+        stats.print_report()
+    if config.stats_file is not None:
+        stats.write_report(config.stats_file)
 
 
 def run(args):
-    global _index_fully_populated
     config = Configuration()
     os_abs = OSAbstraction(config)
     file_index = FileIndex(config, os_abs)
 
     dirs_nonrecursive, dirs_recursive = parse_input_args(args, config, os_abs)
+    if config.dump_plan_file == "-":
+        # The standard output is taken by the plan
+        use_stream(stderr)
+
+    if config.show_stats or config.stats_file is not None:
+        stats.enable()
+
+    if config.resume_mode or config.undo_mode:
+        with stats.phase("execute"):
+            run_from_journal(config, os_abs)
+        report_stats(config)
+        return
+
+    if config.journal_file is not None and not config.simulation_mode and config.dump_plan_file is None \
+            and not config.discard_journal and has_unfinished_execution(config.journal_file):
+        print_error("The journal %s holds an unfinished execution; use --resume or --undo to finish it, "
+                    "or --discard-journal to start anew" % config.journal_file)
+        exit(1)
+
+    if config.hash_cache_file is not None:
+        config.hash_cache = HashCache(config.hash_cache_file, config.hash_cache_limit)
+    for extension in config.extensions_chain:
+        extension.on_config_complete(config)
+        if type(extension).before_directory_entered is not Extension.before_directory_entered:
+            config.walk_filter.add_directory_check(extension.before_directory_entered)
+
+    snapshot = None
+    if config.snapshot_file is not None:
+        snapshot = Snapshot.load(config.snapshot_file, config.extensions_chain)
+        file_index.use_snapshot(snapshot)
+
+    process_backend = None
+    if config.use_process_pool and len(config.extensions_chain) > 0:
+        process_backend = ProcessBackend(config.extensions_chain, config.postprocess_num_threads)
+        file_index.use_process_backend(process_backend)
 
-    # Start worker threads immediately, so that post-processing can start (with reduced
-    # throughput) while the index is still being built
+    # Start worker threads immediately, so that post-processing runs while the index
+    # is still being built. The queue between them is bounded, so the walk cannot get
+    # far ahead of post-processing.
     postproc_workers = []
     for thread_id in range(0, config.postprocess_num_threads):
         thread = Thread(target=postproc_worker, args=(file_index, thread_id))
@@ -285,37 +969,90 @@ def run(args):
         postproc_workers.append(thread)
     print_message("Started %d threads" % len(postproc_workers))
 
-    for dir_name in dirs_nonrecursive:
-        file_index.add(get_file_list_nonrecursive(dir_name, config.include_directories))
+    walker = TreeWalker(config.include_directories, config.walk_order, config.scan_num_threads, config.walk_filter,
+                        snapshot)
+    stats.start_sampling("postprocess queue", file_index.get_postprocess_queue_size)
+    stats.start_sampling("prefetched listings", walker.get_prefetched_count)
+    try:
+        with stats.phase("scan"):
+            file_index.add(walker.walk_all(dirs_nonrecursive, dirs_recursive))
+    finally:
+        file_index.close_postprocess_queue()
+        stats.stop_sampling("prefetched listings")
 
-    for dir_name in dirs_recursive:
-        file_index.add(get_file_list_recursive(dir_name, config.include_directories))
+    with stats.phase("postprocess"):
+        for worker in postproc_workers:
+            worker.join()
+    stats.stop_sampling("postprocess queue")
 
-    _index_fully_populated = True
+    if process_backend is not None:
+        process_backend.shutdown()
 
-    for worker in postproc_workers:
-        worker.join()
+    if snapshot is not None:
+        with stats.phase("snapshot"):
+            try:
+                snapshot.save(config.snapshot_file)
+            except OSError as ex:
+                print_warning("Cannot save the snapshot %s: %s" % (config.snapshot_file, str(ex)))
 
-    while True:
-        for extension in config.extensions_chain:
-            extension.on_index_complete(file_index)
-        inp = file_index.generate_user_input()
-        resp = get_user_input(inp, getenv('EDITOR', 'vi'))
-        file_index.handle_user_input(resp)
-        ops_done, remaining_entries = execute_actions(file_index, os_abs, config)
-        if remaining_entries > 0:
-            if config.multistage_mode:
-                if ops_done > 0:
-                    os_abs.show_info("%d operations done, %d files not processed, launching the editor again" % (ops_done, remaining_entries))
+    roots = dirs_nonrecursive + dirs_recursive
+    if config.use_absolute_paths:
+        roots = [os_abs.abspath(root) for root in roots]
+
+    if config.multistage_mode:
+        file_index.track_changes()
+
+    journal = None
+    first_stage = True
+    try:
+        while True:
+            with stats.phase("index complete"):
+                if first_stage:
+                    notify_index_complete(file_index, config)
+                    first_stage = False
+                else:
+                    notify_index_changed(file_index, config)
+            chunked = config.chunk_mode is not None and config.apply_plan_file is None
+            with stats.phase("editor"):
+                if config.dump_plan_file is not None:
+                    write_plan(file_index, config.dump_plan_file, config.plan_format)
+                    break
+                if config.apply_plan_file is not None:
+                    entries = handle_plan(file_index, read_plan(config.apply_plan_file), config.plan_format)
+                elif not chunked:
+                    resp = get_user_input(file_index, getenv('EDITOR', 'vi'))
+                    entries = file_index.handle_user_input(resp)
+            if journal is None and config.journal_file is not None and not config.simulation_mode:
+                journal = Journal(config.journal_file, config.journal_sync_interval)
+            if chunked:
+                ops_done = run_chunked_sessions(file_index, os_abs, config, roots, journal)
+                remaining_entries = file_index.get_size()
+            else:
+                with stats.phase("execute"):
+                    ops_done, remaining_entries = execute_actions(file_index, os_abs, config, entries, journal)
+            if remaining_entries > 0:
+                if config.multistage_mode and config.apply_plan_file is None:
+                    if ops_done > 0:
+                        os_abs.show_info("%d operations done, %d files not processed, launching the editor again" % (ops_done, remaining_entries))
+                    else:
+                        if os_abs.ask_for_confirmation("No operations done, still %d files not processed. Continue?" % remaining_entries) == False:
+                            break
                 else:
-                    if os_abs.ask_for_confirmation("No operations done, still %d files not processed. Continue?" % remaining_entries) == False:
-                        break
+                    os_abs.show_info("%d files not processed" % remaining_entries)
+                    write_plan_to_stream(file_index, stdout, config.plan_format)
+                    break
             else:
-                os_abs.show_info("%d files not processed" % remaining_entries)
-                os_abs.show_info(file_index.generate_user_input())
                 break
-        else:
-            break
+        if journal is not None:
+            journal.finish()
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if config.hash_cache is not None:
+        config.hash_cache.close()
+
+    report_stats(config)
 
 
 if __name__=="__main__":
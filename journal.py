@@ -0,0 +1,185 @@
+import os
+import json
+from time import monotonic
+
+
+def get_default_journal_path():
+    state_dir = os.getenv("XDG_STATE_HOME", os.path.join(os.path.expanduser("~"), ".local", "state"))
+    return os.path.join(state_dir, "ifstool", "journal.jsonl")
+
+
+class JournalOperation:
+    """
+    An operation read back from the journal. It has the same attributes as
+    PlannedOperation that are needed to execute or revert it.
+    """
+
+    __slots__ = ("section", "seq", "action", "part", "source", "target", "partner", "state", "started", "entry",
+                 "target_name")
+
+    def __init__(self, section, seq, action, part, source, target):
+        self.section = section
+        self.seq = seq
+        self.action = action
+        self.part = part
+        self.source = source
+        self.target = target
+        self.target_name = target
+        self.partner = None
+        self.state = None
+        self.started = False
+        self.entry = None
+
+    def get_predecessors(self):
+        # The dependencies between the operations are not kept in the journal
+        return ()
+
+
+class Journal:
+    """
+    Append-only log of the operations planned for execution and of their
+    results. Each record is a JSON array in a separate line:
+      ["begin", section]                  - a new plan follows
+      ["plan", seq, action, part, source, target, partner_seq]
+      ["start", seq]                      - a copy is about to write its target
+      ["done"|"fail"|"skip", seq]         - result of an operation of the last plan
+      ["undo", section, seq]              - a completed operation has been reverted
+      ["end"]                             - the execution finished
+
+    The whole plan is synced to the disk before the first operation is
+    executed. The results are synced in batches, at most every sync_interval
+    seconds, so after a crash the last few results may be missing; the
+    operations are then checked against the state of the filesystem when
+    resuming.
+    """
+
+    BEGIN = "begin"
+    PLANNED = "plan"
+    STARTED = "start"
+    DONE = "done"
+    FAILED = "fail"
+    SKIPPED = "skip"
+    UNDONE = "undo"
+    END = "end"
+
+    DEFAULT_SYNC_INTERVAL = 1.0
+
+    def __init__(self, path, sync_interval=DEFAULT_SYNC_INTERVAL, append=False):
+        self._path = path
+        self._sync_interval = sync_interval
+        self._last_sync_time = monotonic()
+        self._num_sections = 0
+
+        journal_dir = os.path.dirname(path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        if append:
+            self._num_sections = len(load_journal(path))
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False))
+        self._file.write("\n")
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync_time = monotonic()
+
+    def _sync_if_needed(self):
+        if monotonic() - self._last_sync_time >= self._sync_interval:
+            self.sync()
+
+    def begin(self, operations):
+        """
+        Writes the plan of execution and waits until it is stored on the disk.
+
+        Parameters:
+        operations: List of PlannedOperation objects, in the order of execution
+        """
+        self._write([self.BEGIN, self._num_sections])
+        self._num_sections += 1
+        for op in operations:
+            partner_seq = op.partner.seq if op.partner is not None else None
+            self._write([self.PLANNED, op.seq, op.action, op.part, op.source, op.target, partner_seq])
+        self.sync()
+
+    def record(self, op, state):
+        self._write([state, op.seq])
+        self._sync_if_needed()
+
+    def record_undo(self, op):
+        self._write([self.UNDONE, op.section, op.seq])
+        self._sync_if_needed()
+
+    def finish(self):
+        self._write([self.END])
+        self.sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def load_journal(path):
+    """
+    Reads the journal.
+
+    Returns:
+    list:Sections of the journal, each one being a tuple of the list of operations
+         (JournalOperation) in the order of execution, the list of the completed
+         operations in the order of completion, and the flag telling if the
+         execution of the section has finished
+    """
+    sections = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record torn by a crash
+                continue
+
+            kind = record[0]
+            if kind == Journal.BEGIN:
+                sections.append(([], [], {}, [False]))
+            elif len(sections) == 0:
+                continue
+            elif kind == Journal.PLANNED:
+                operations, completed, by_seq, finished = sections[-1]
+                op = JournalOperation(len(sections) - 1, record[1], record[2], record[3], record[4], record[5])
+                if record[6] is not None and record[6] in by_seq:
+                    op.partner = by_seq[record[6]]
+                    op.partner.partner = op
+                operations.append(op)
+                by_seq[op.seq] = op
+            elif kind == Journal.UNDONE:
+                op = sections[record[1]][2].get(record[2])
+                if op is not None:
+                    op.state = Journal.UNDONE
+            elif kind == Journal.END:
+                sections[-1][3][0] = True
+            elif kind == Journal.STARTED:
+                op = sections[-1][2].get(record[1])
+                if op is not None:
+                    op.started = True
+            else:
+                operations, completed, by_seq, finished = sections[-1]
+                op = by_seq.get(record[1])
+                if op is not None:
+                    op.state = kind
+                    if kind == Journal.DONE:
+                        completed.append(op)
+
+    return [(operations, completed, finished[0]) for operations, completed, by_seq, finished in sections]
+
+
+def has_unfinished_execution(path):
+    """
+    Tells whether the journal exists and its last plan has not been executed to
+    the end, so that it is still needed to resume or revert the execution.
+    """
+    if not os.path.isfile(path):
+        return False
+    sections = load_journal(path)
+    return len(sections) > 0 and not sections[-1][2]
@@ -1,19 +1,329 @@
 import os
+import errno
 import shutil
+import unicodedata
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from configuration import Configuration
-from sys import stdout
-from console_output import print_debug
-from console_output import print_status, print_prompt
+from file_check import FileCheck
+from console_output import print_debug, print_message
+from console_output import print_prompt
+from tree_walker import TreeWalker
+from walk_filter import WalkFilter
+from snapshot import SnapshotEntry
+from time import monotonic
+from stats import stats
+
+
+# Errors meaning that a copy method is not supported for the given pair of files
+_COPY_METHOD_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                            errno.ENOSYS, errno.EBADF, errno.EPERM, errno.ENOTSUP}
+
+# ioctl request of Linux for cloning a file (sharing its extents), _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 1 << 20
+COPY_MAX_BLOCK_SIZE = 1 << 30
+
+
+def _copy_reflink(src, dst, size):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks not supported")
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _get_block_size(size):
+    # The size reported by fstat is only a hint; the copy goes on until the end of file
+    return min(max(size, COPY_BUFFER_SIZE), COPY_MAX_BLOCK_SIZE)
+
+
+def _copy_range(src, dst, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not supported")
+    block_size = _get_block_size(size)
+    copied = 0
+    while True:
+        count = os.copy_file_range(src.fileno(), dst.fileno(), block_size)
+        if count == 0:
+            break
+        copied += count
+    # Some filesystems (like procfs) report no data instead of an error
+    if copied == 0:
+        raise OSError(errno.EOPNOTSUPP, "copy_file_range copied no data")
+
+
+def _copy_sendfile(src, dst, size):
+    block_size = _get_block_size(size)
+    copied = 0
+    while True:
+        count = os.sendfile(dst.fileno(), src.fileno(), copied, block_size)
+        if count == 0:
+            break
+        copied += count
+    if copied == 0:
+        raise OSError(errno.EOPNOTSUPP, "sendfile copied no data")
+
+
+def _copy_buffered(src, dst, size):
+    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+_COPY_METHODS = [
+    ("reflink", _copy_reflink),
+    ("copy_file_range", _copy_range),
+    ("sendfile", _copy_sendfile),
+    ("buffered", _copy_buffered)]
+
+
+def copy_file(old_path, new_path, preserve_metadata=False):
+    """
+    Copies the contents of a file using the cheapest method supported: a reflink
+    (the copy shares the data blocks with the original on filesystems like Btrfs
+    or XFS), copy_file_range or sendfile (the data does not leave the kernel), or
+    a buffered copy as the last resort. The contents are copied until the end
+    of file, regardless of the size reported for the file.
+
+    Parameters:
+    preserve_metadata: Whether to copy the permission bits and timestamps too
+
+    Returns:
+    str:Name of the method used
+    """
+    # Opening the target truncates it, which would wipe the source if both
+    # names refer to the same file
+    if os.path.exists(new_path) and os.path.samefile(old_path, new_path):
+        raise shutil.SameFileError("%s and %s are the same file" % (old_path, new_path))
+
+    with open(old_path, "rb") as src, open(new_path, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        for method, copy_function in _COPY_METHODS:
+            try:
+                copy_function(src, dst, size)
+                break
+            except OSError as ex:
+                # Only the methods failing before any data got copied can be replaced
+                if ex.errno not in _COPY_METHOD_UNSUPPORTED or dst.tell() != 0 \
+                        or os.fstat(dst.fileno()).st_size != 0:
+                    raise
+
+    if preserve_metadata:
+        shutil.copystat(old_path, new_path)
+    return method
+
+
+class _Listing(dict):
+    """
+    Cached directory listing: {name: kind}. Also counts the names by their
+    case-folded form, so that a name missing from the listing can be told apart
+    from one that may refer to an existing file on a case-insensitive filesystem.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._folded = {}
+
+    @staticmethod
+    def _fold(name):
+        return unicodedata.normalize("NFKD", name).casefold()
+
+    def __setitem__(self, name, kind):
+        if name not in self:
+            folded = self._fold(name)
+            self._folded[folded] = self._folded.get(folded, 0) + 1
+        super().__setitem__(name, kind)
+
+    def pop(self, name, default=None):
+        if name not in self:
+            return default
+        folded = self._fold(name)
+        self._folded[folded] -= 1
+        if self._folded[folded] == 0:
+            del self._folded[folded]
+        return super().pop(name)
+
+    def has_folded_match(self, name):
+        """
+        Tells whether the listing has a name that differs from the given one
+        only by case or Unicode normalization.
+        """
+        return self._fold(name) in self._folded
+
+
+class StatCache:
+    """
+    Cache of file existence and type information, used when executing the
+    operations. Queries about files are answered from the listing of their
+    directory, so many files moved to the same directory cost a single listing
+    instead of a stat call each. The operations done by ifstool update the
+    cached listings; changes made by others are picked up when a listing gets
+    older than the time-to-live, or after explicit invalidation. Directories
+    with more than max_listing_size entries are not cached, as listing them
+    costs more than the stat calls it would save; files in them are checked
+    with a stat call each.
+    """
+
+    FILE = 'f'
+    DIRECTORY = 'd'
+    OTHER = 'o'
+
+    MAX_LISTING_SIZE = 10000
+
+    # Marks the directories whose listings are not kept: the ones that cannot
+    # be listed, but may still be accessible, and the ones too big to cache
+    _UNLISTABLE = object()
+
+    def __init__(self, ttl=None, max_listing_size=MAX_LISTING_SIZE):
+        self._ttl = ttl
+        self._max_listing_size = max_listing_size
+        self._listings = {}
+
+    def _key(self, path):
+        return os.path.normpath(path) if len(path) > 0 else "."
+
+    def _get_listing(self, directory):
+        key = self._key(directory)
+        cached = self._listings.get(key)
+        if cached is not None and (self._ttl is None or monotonic() - cached[0] < self._ttl):
+            return cached[1]
+
+        if stats.enabled:
+            stats.count("syscalls.scandir")
+        try:
+            with os.scandir(key) as it:
+                listing = _Listing()
+                for entry in it:
+                    if len(listing) >= self._max_listing_size:
+                        listing = self._UNLISTABLE
+                        break
+                    if entry.is_dir():
+                        listing[entry.name] = self.DIRECTORY
+                    elif entry.is_file():
+                        listing[entry.name] = self.FILE
+                    else:
+                        listing[entry.name] = self.OTHER
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+        except OSError:
+            listing = self._UNLISTABLE
+
+        self._listings[key] = (monotonic(), listing)
+        return listing
+
+    def get_kind(self, path):
+        """
+        Returns the type of the file (FILE, DIRECTORY or OTHER), or None if the
+        file does not exist.
+        """
+        directory, name = os.path.split(self._key(path))
+        if len(name) == 0 or name in [os.curdir, os.pardir]:
+            return self._stat_kind(path)
+
+        listing = self._get_listing(directory)
+        if listing is self._UNLISTABLE:
+            return self._stat_kind(path)
+        if listing is None:
+            return None
+        kind = listing.get(name)
+        if kind is None and listing.has_folded_match(name):
+            # On a case-insensitive filesystem, the name may refer to the file
+            # listed under a name differing in case only
+            return self._stat_kind(path)
+        return kind
+
+    def _stat_kind(self, path):
+        if stats.enabled:
+            stats.count("syscalls.stat")
+        if os.path.isdir(path):
+            return self.DIRECTORY
+        if os.path.isfile(path):
+            return self.FILE
+        if os.path.lexists(path):
+            return self.OTHER
+        return None
+
+    def _get_cached_listing(self, path):
+        directory, name = os.path.split(self._key(path))
+        cached = self._listings.get(self._key(directory))
+        if cached is None or cached[1] is None or cached[1] is self._UNLISTABLE:
+            return None, name
+        return cached[1], name
+
+    def get_cached_kind(self, path):
+        """
+        Returns the type of the file if it is known without doing any system call,
+        None otherwise.
+        """
+        listing, name = self._get_cached_listing(path)
+        return None if listing is None else listing.get(name)
+
+    def record(self, path, kind):
+        # The listing is loaded if needed, so that operations made in the
+        # simulation mode are not lost when the directory is listed later
+        directory, name = os.path.split(self._key(path))
+        listing = self._get_listing(directory)
+        if listing is not None and listing is not self._UNLISTABLE:
+            listing[name] = kind
+
+    def record_new_directory(self, path):
+        """
+        Records the creation of a directory, along with the missing parents.
+        """
+        created = []
+        key = self._key(path)
+        while True:
+            created.append(key)
+            parent = os.path.dirname(key)
+            if parent == key or len(parent) == 0 or self.get_cached_kind(parent) == self.DIRECTORY:
+                break
+            key = parent
+
+        for directory in reversed(created):
+            self.record(directory, self.DIRECTORY)
+            if self._get_listing(directory) is None:
+                # Directory created in the simulation mode
+                self._listings[directory] = (monotonic(), _Listing())
+
+    def forget(self, path):
+        """
+        Records the removal of a file. If it was a directory, the cached listings
+        of its subtree are dropped.
+        """
+        listing, name = self._get_cached_listing(path)
+        kind = None
+        if listing is not None:
+            kind = listing.pop(name, None)
+        if kind != self.FILE:
+            self.invalidate(path)
+
+    def invalidate(self, path=None):
+        """
+        Drops the cached listings of the directory and its subdirectories, or of
+        all the directories if the path is not given.
+        """
+        if path is None:
+            self._listings = {}
+            return
+
+        key = self._key(path)
+        prefix = os.path.join(key, "")
+        for cached_dir in [d for d in self._listings if d == key or d.startswith(prefix)]:
+            del self._listings[cached_dir]
 
 
 class IOSAbstraction:
     def ask_for_confirmation(self, prompt): pass
+    def show_info(self, message): pass
 
     def abspath(self, path): pass
     def isdir(self, path): pass
     def mkdir(self, path): pass
     def isfile(self, path): pass
     def split_path(self, path): pass
+    def invalidate_cache(self, path=None): pass
+    def make_temporary_name(self, path): pass
+    def validate_file(self, item, checks): pass
     def rename_move(self, old_path, new_path): pass
     def delete(self, path): pass
     def copy(self, old_path, new_path): pass
@@ -23,6 +333,9 @@ class IOSAbstraction:
 class OSAbstraction(IOSAbstraction):
     def __init__(self, config: Configuration):
         self._conf = config
+        self._stat_cache = None
+        if config.stat_cache_ttl != 0:
+            self._stat_cache = StatCache(config.stat_cache_ttl)
 
     def ask_for_confirmation(self, prompt):
         print_prompt(prompt, ["&yes", "&no"], "n")
@@ -32,87 +345,166 @@ class OSAbstraction(IOSAbstraction):
         else:
             return False
 
+    def show_info(self, message):
+        print_message(message)
+
     def abspath(self, path):
         return os.path.abspath(path)
 
     def isdir(self, path):
-        return os.path.isdir(path)
+        if self._stat_cache is None:
+            return os.path.isdir(path)
+        return self._stat_cache.get_kind(path) == StatCache.DIRECTORY
 
     def mkdir(self, path):
-        try:
-            os.makedirs(path)
-            return (True, "")
-        except Exception as ex:
-            return (False, str(ex))
+        if self._conf.simulation_mode:
+            print_debug("mkdir -p %s" % path)
+        else:
+            if stats.enabled:
+                stats.count("syscalls.mkdir")
+            try:
+                os.makedirs(path)
+            except Exception as ex:
+                return (False, str(ex))
+
+        if self._stat_cache is not None:
+            self._stat_cache.record_new_directory(path)
+        return (True, "")
 
     def isfile(self, path):
-        return os.path.isfile(path)
+        if self._stat_cache is None:
+            return os.path.isfile(path)
+        return self._stat_cache.get_kind(path) == StatCache.FILE
+
+    def invalidate_cache(self, path=None):
+        """
+        Drops the cached information about the directory given (or all the
+        directories), so that changes made by others become visible.
+        """
+        if self._stat_cache is not None:
+            self._stat_cache.invalidate(path)
 
     def split_path(self, path):
         return (os.path.dirname(path), os.path.basename(path))
 
+    def make_temporary_name(self, path):
+        """
+        Returns an unused name in the same directory as the path given
+        """
+        directory, basename = self.split_path(path)
+        suffix = 0
+        while True:
+            name = os.path.join(directory, ".%s.ifstool-tmp%d" % (basename, suffix))
+            if not os.path.lexists(name):
+                return name
+            suffix += 1
+
+    def validate_file(self, item, checks):
+        """
+        Checks whether the file can be added to the index, without opening it.
+
+        Parameters:
+        item: Path, os.DirEntry or SnapshotEntry object of the file. For the latter
+              the file type known from the directory listing is used, so that only
+              symlinks need to be followed.
+        checks: List of checks to be done (see FileCheck)
+
+        Returns:
+        None if the file passed all the checks, error message otherwise
+        """
+        path = os.fspath(item)
+        try:
+            if FileCheck.BROKEN_LINKS in checks:
+                if not isinstance(item, (os.DirEntry, SnapshotEntry)) or item.is_symlink():
+                    if stats.enabled:
+                        stats.count("syscalls.stat")
+                    os.stat(path)
+            if FileCheck.READABLE in checks:
+                if stats.enabled:
+                    stats.count("syscalls.access")
+                if not os.access(path, os.R_OK):
+                    return "insufficient permissions"
+        except OSError as ex:
+            return str(ex)
+        return None
+
     def rename_move(self, old_path, new_path):
         print_debug("mv %s %s" % (old_path, new_path))
-        if self._conf.simulation_mode:
-            return (True, "")
-        else:
+        kind = None
+        if self._stat_cache is not None:
+            kind = self._stat_cache.get_cached_kind(old_path)
+            if kind is None:
+                kind = StatCache.DIRECTORY if os.path.isdir(old_path) else StatCache.FILE
+
+        if not self._conf.simulation_mode:
+            if stats.enabled:
+                stats.count("syscalls.rename")
             try:
                 os.rename(old_path, new_path)
-                return (True, "")
             except Exception as ex:
                 return (False, str(ex))
 
+        if self._stat_cache is not None:
+            self._stat_cache.forget(old_path)
+            self._stat_cache.forget(new_path)
+            self._stat_cache.record(new_path, kind)
+        return (True, "")
+
     def delete(self, path):
         print_debug("rm %s" % path)
-        if self._conf.simulation_mode:
-            return (True, "")
-        else:
+        if not self._conf.simulation_mode:
+            if stats.enabled:
+                stats.count("syscalls.unlink")
             try:
                 os.remove(path)
-                return (True, "")
             except Exception as ex:
                 return (False, str(ex))
 
+        if self._stat_cache is not None:
+            self._stat_cache.forget(path)
+        return (True, "")
+
     def copy(self, old_path, new_path):
-        print_debug("cp %s %s" % (old_path, new_path))
         if self._conf.simulation_mode:
-            return (True, "")
+            print_debug("cp %s %s" % (old_path, new_path))
         else:
+            if stats.enabled:
+                stats.count("syscalls.copy")
             try:
-                shutil.copyfile(old_path, new_path)
-                return (True, "")
+                method = copy_file(old_path, new_path, self._conf.preserve_metadata)
+                print_debug("cp %s %s (%s)" % (old_path, new_path, method))
             except Exception as ex:
                 return (False, str(ex))
 
+        if self._stat_cache is not None:
+            self._stat_cache.record(new_path, StatCache.FILE)
+        return (True, "")
+
     def make_link(self, old_path, new_path):
         dest_path = os.path.relpath(old_path, os.path.dirname(new_path))
         print_debug("ln -s %s %s" % (dest_path, new_path))
-        if self._conf.simulation_mode:
-            return (True, "")
-        else:
+        if not self._conf.simulation_mode:
+            if stats.enabled:
+                stats.count("syscalls.symlink")
             try:
                 os.symlink(dest_path, new_path)
-                return (True, "")
             except Exception as ex:
                 return (False, str(ex))
 
+        if self._stat_cache is not None:
+            self._stat_cache.record(new_path, StatCache.FILE)
+        return (True, "")
 
-def get_file_list_nonrecursive(directory: str, include_directories: bool):
-    for name in os.listdir(directory):
-        path = os.path.join(directory, name)
-        if os.path.isdir(path) and not include_directories:
-            continue
-        yield path
 
+def get_file_list_nonrecursive(directory: str, include_directories: bool, order: str = TreeWalker.DEPTH_FIRST,
+                               walk_filter: WalkFilter = None):
+    walker = TreeWalker(include_directories, order, walk_filter=walk_filter)
+    for entry in walker.walk(directory, recursive=False):
+        yield entry.path
 
-def get_file_list_recursive(directory: str, include_directories: bool):
-    print_status("Entering %s" % directory)
-    stdout.flush()
-    for name in os.listdir(directory):
-        path = os.path.join(directory, name)
-        if os.path.isdir(path):
-            if include_directories:
-                yield path
-            yield from get_file_list_recursive(path, include_directories)
-        else:
-            yield path
+
+def get_file_list_recursive(directory: str, include_directories: bool, order: str = TreeWalker.DEPTH_FIRST,
+                            walk_filter: WalkFilter = None):
+    walker = TreeWalker(include_directories, order, walk_filter=walk_filter)
+    for entry in walker.walk(directory):
+        yield entry.path
@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from file_index import FileIndexEntry
+from file_action import FileAction
+
+# Copies of the process-safe extensions, living in the worker process
+_worker_extensions = {}
+
+
+def _init_worker(extensions):
+    global _worker_extensions
+    _worker_extensions = extensions
+
+
+def _analyze_file(ext_id, filename):
+    entry = FileIndexEntry(filename, FileAction.IGNORE)
+    return _worker_extensions[ext_id].analyze_file(entry)
+
+
+class ProcessBackend:
+    """
+    Runs the post-processing of process-safe extensions in a pool of worker
+    processes, so that extensions doing their work in pure Python are not
+    serialized on a single core. Each post-processing thread waits for the
+    results of the file it handles, so the number of files analyzed at once
+    is bounded by the number of post-processing threads.
+
+    The workers are spawned rather than forked, as the main process is already
+    running threads at that point; the extensions are passed to them pickled.
+    """
+
+    def __init__(self, extensions: list, num_workers: int):
+        self._process_safe = {}
+        for ext_id, ext in enumerate(extensions):
+            if ext.on_process_safety_query():
+                self._process_safe[ext_id] = ext
+
+        self._executor = ProcessPoolExecutor(num_workers, mp_context=get_context("spawn"),
+                                             initializer=_init_worker, initargs=(self._process_safe,))
+
+    def analyze_file(self, ext_id, ext, entry):
+        """
+        Runs analyze_file of the extension on the file in a worker process if the
+        extension is process-safe, or in the calling thread otherwise.
+        """
+        if ext_id in self._process_safe:
+            return self._executor.submit(_analyze_file, ext_id, entry.current_name).result()
+        return ext.analyze_file(entry)
+
+    def after_file_added(self, ext_id, ext, entry):
+        if ext_id in self._process_safe:
+            ext.apply_file_analysis(entry, self.analyze_file(ext_id, ext, entry))
+        else:
+            ext.after_file_added(entry)
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -0,0 +1,202 @@
+import os
+import pickle
+import zlib
+from threading import Lock
+from time import time_ns
+from stats import stats
+from console_output import print_warning
+
+
+def get_default_snapshot_path():
+    cache_dir = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "ifstool", "snapshot.bin")
+
+
+class SnapshotEntry:
+    """
+    Entry of a directory listing taken from the snapshot. Has the same interface
+    as os.DirEntry, so that the tree walker, the walk filters and the index can
+    use it in place of one. The information about the file is cached from the
+    listing, except for stat(), which is done on the first call.
+    """
+
+    __slots__ = ("name", "path", "_is_dir", "_is_symlink", "_stat")
+
+    def __init__(self, directory, name, is_dir, is_symlink):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._is_dir = is_dir
+        self._is_symlink = is_symlink
+        self._stat = None
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return "<SnapshotEntry %r>" % self.name
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir if follow_symlinks or not self._is_symlink else False
+
+    def is_file(self, follow_symlinks=True):
+        return not self.is_dir(follow_symlinks)
+
+    def is_symlink(self):
+        return self._is_symlink
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks and self._is_symlink:
+            return os.lstat(self.path)
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+
+class Snapshot:
+    """
+    Snapshot of the scanned directory tree and of the analyses of the files
+    done by the extensions, kept between runs, so that the unchanged parts of
+    the tree are neither listed nor analyzed again.
+
+    A directory is listed again only if its modification time has changed, that
+    is if any file has been created, removed or renamed in it. The analysis of a
+    file is reused if the file has the same inode, size and modification time
+    as when it was analyzed; only the analyses of the extensions telling their
+    version (see Extension.on_analysis_version_query) are kept.
+
+    The snapshot stores what was seen in the current run only, so the parts of
+    the tree not scanned in the current run are dropped from it when it is saved.
+    It is stored as a zlib-compressed pickle.
+    """
+
+    FORMAT_VERSION = 1
+    # Directories modified this recently are not trusted to be unchanged next
+    # time, as a modification within the same tick of a coarse filesystem clock
+    # would go unnoticed
+    RACY_INTERVAL_NS = 2 * 10**9
+
+    def __init__(self, extensions: list):
+        self._lock = Lock()
+        # {directory: (mtime_ns, [(name, is_dir, is_symlink), ...])}
+        self._directories = {}
+        self._previous_directories = {}
+        # {path: ((st_ino, st_size, st_mtime_ns), {ext_id: analysis})}
+        self._analyses = {}
+        self._previous_analyses = {}
+        # Extensions whose analyses are kept: {ext_id: version}
+        self._versions = {}
+        for ext_id, ext in enumerate(extensions):
+            version = ext.on_analysis_version_query()
+            if version is not None and ext.on_process_safety_query():
+                self._versions[ext_id] = "%s:%s" % (ext.on_name_query(), version)
+
+    @classmethod
+    def load(cls, path, extensions: list):
+        """
+        Creates a snapshot, taking the data of the previous run from the file
+        given, unless it does not exist or is not compatible.
+        """
+        snapshot = cls(extensions)
+        try:
+            with open(path, "rb") as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return snapshot
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as ex:
+            print_warning("Cannot read the snapshot %s (%s), scanning the whole tree" % (path, str(ex)))
+            return snapshot
+
+        if not isinstance(data, dict) or data.get("version") != cls.FORMAT_VERSION:
+            print_warning("The snapshot %s has an incompatible format, scanning the whole tree" % path)
+            return snapshot
+        snapshot._previous_directories = data["directories"]
+        if data["extensions"] == snapshot._versions:
+            snapshot._previous_analyses = data["analyses"]
+        return snapshot
+
+    def save(self, path):
+        """
+        Writes the snapshot to the file. The file is replaced atomically, so an
+        interrupted write leaves the previous snapshot intact.
+        """
+        with self._lock:
+            data = {
+                "version": self.FORMAT_VERSION,
+                "extensions": self._versions,
+                "directories": self._directories,
+                "analyses": self._analyses
+            }
+            compressed = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+        snapshot_dir = os.path.dirname(path)
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+
+    def list_directory(self, directory, list_function):
+        """
+        Returns the entries of the directory, taken from the snapshot if the
+        directory has not changed since, or returned by the function given
+        otherwise. The listing is recorded for the next run.
+
+        Parameters:
+        directory: Path of the directory
+        list_function: Function listing the directory, returning os.DirEntry objects
+        """
+        # Taken before listing, so that a change made in the meantime makes the
+        # directory listed again next time
+        mtime_ns = os.stat(directory).st_mtime_ns
+        previous = self._previous_directories.get(directory)
+        if previous is not None and previous[0] == mtime_ns:
+            if stats.enabled:
+                stats.count("snapshot.directories_reused")
+            with self._lock:
+                self._directories[directory] = previous
+            return [SnapshotEntry(directory, name, is_dir, is_symlink) for name, is_dir, is_symlink in previous[1]]
+
+        if time_ns() - mtime_ns < self.RACY_INTERVAL_NS:
+            mtime_ns = None
+        entries = list_function(directory)
+        listing = (mtime_ns, [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in entries])
+        with self._lock:
+            self._directories[directory] = listing
+        return entries
+
+    def is_analysis_kept(self, ext_id):
+        return ext_id in self._versions
+
+    def get_analyses(self, path):
+        """
+        Returns the analyses of the file kept from the previous run, if the file
+        has not changed since.
+
+        Returns:
+        tuple:Key of the current state of the file (None if it cannot be determined),
+              and the analyses by the extension ids (empty if there are none)
+        """
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return (None, {})
+        file_key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+        previous = self._previous_analyses.get(path)
+        if previous is not None and previous[0] == file_key:
+            if stats.enabled:
+                stats.count("snapshot.analyses_reused")
+            return (file_key, previous[1])
+        return (file_key, {})
+
+    def set_analyses(self, path, file_key, analyses):
+        """
+        Records the analyses of the file, done when the file had the key given.
+        """
+        if file_key is None or len(analyses) == 0:
+            return
+        with self._lock:
+            self._analyses[path] = (file_key, analyses)
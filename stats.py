@@ -0,0 +1,184 @@
+import json
+from threading import Lock, Thread, Event
+from time import monotonic, perf_counter, process_time
+from console_output import print_message
+
+
+class _Phase:
+    """
+    Context manager measuring the wall and CPU time of a phase.
+    """
+
+    __slots__ = ("_stats", "_name", "_wall_start", "_cpu_start")
+
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+
+    def __enter__(self):
+        self._wall_start = perf_counter()
+        self._cpu_start = process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stats._add_phase(self._name, perf_counter() - self._wall_start, process_time() - self._cpu_start)
+        return False
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class Statistics:
+    """
+    Collects the timings and counters of a run. All the collection is skipped
+    unless the statistics are enabled; the code in the hot paths checks the
+    `enabled` attribute before measuring anything, so that a disabled instance
+    costs a single attribute lookup.
+
+    Collected data:
+      phases   - wall and CPU time of the phases of the run
+      timers   - total time and number of calls of the instrumented functions,
+                 like the extension hooks
+      counters - numbers of files, bytes hashed, filesystem calls, operations
+      queues   - depths of the queues, sampled periodically
+    """
+
+    SAMPLING_INTERVAL = 0.1
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self._start_time = monotonic()
+        self._phases = {}
+        self._timers = {}
+        self._counters = {}
+        self._queues = {}
+        self._samplers = {}
+        self._sampling_stop = Event()
+        self._sampling_thread = None
+
+    def enable(self):
+        self.enabled = True
+        self._start_time = monotonic()
+
+    def phase(self, name):
+        """
+        Returns a context manager measuring the phase. A phase entered several
+        times (like the editor session in the multistage mode) is summed up.
+        """
+        if not self.enabled:
+            return _NO_PHASE
+        return _Phase(self, name)
+
+    def _add_phase(self, name, wall_time, cpu_time):
+        with self._lock:
+            phase = self._phases.setdefault(name, [0.0, 0.0, 0])
+            phase[0] += wall_time
+            phase[1] += cpu_time
+            phase[2] += 1
+
+    def add_time(self, name, elapsed):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [elapsed, 1]
+            else:
+                timer[0] += elapsed
+                timer[1] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def start_sampling(self, name, get_depth):
+        """
+        Starts sampling the depth of a queue, returned by the function given,
+        until stop_sampling() is called with the same name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._samplers[name] = get_depth
+            self._queues.setdefault(name, [])
+            if self._sampling_thread is None:
+                self._sampling_stop.clear()
+                self._sampling_thread = Thread(target=self._sample, daemon=True)
+                self._sampling_thread.start()
+
+    def stop_sampling(self, name):
+        with self._lock:
+            get_depth = self._samplers.pop(name, None)
+            if get_depth is not None:
+                self._queues[name].append((monotonic() - self._start_time, get_depth()))
+            thread = self._sampling_thread if len(self._samplers) == 0 else None
+            if thread is not None:
+                self._sampling_thread = None
+                self._sampling_stop.set()
+        if thread is not None:
+            thread.join()
+
+    def _sample(self):
+        while not self._sampling_stop.wait(self.SAMPLING_INTERVAL):
+            with self._lock:
+                timestamp = monotonic() - self._start_time
+                for name, get_depth in self._samplers.items():
+                    self._queues[name].append((timestamp, get_depth()))
+
+    def get_report(self):
+        """
+        Returns:
+        dict:Collected data, in a form that can be serialized to JSON
+        """
+        with self._lock:
+            queues = {}
+            for name, samples in self._queues.items():
+                depths = [depth for _, depth in samples]
+                queues[name] = {
+                    "max": max(depths, default=0),
+                    "mean": sum(depths) / len(depths) if len(depths) > 0 else 0,
+                    "samples": [[round(timestamp, 3), depth] for timestamp, depth in samples]
+                }
+            return {
+                "phases": {name: {"wall": wall, "cpu": cpu, "count": count}
+                           for name, (wall, cpu, count) in self._phases.items()},
+                "timers": {name: {"total": total, "calls": calls}
+                           for name, (total, calls) in self._timers.items()},
+                "counters": dict(self._counters),
+                "queues": queues
+            }
+
+    def print_report(self):
+        report = self.get_report()
+        print_message("%-42s %10s %10s" % ("Phases:", "wall (s)", "CPU (s)"))
+        for name, phase in report["phases"].items():
+            print_message("  %-40s %10.3f %10.3f" % (name, phase["wall"], phase["cpu"]))
+        if len(report["timers"]) > 0:
+            print_message("%-42s %10s %10s" % ("Timers:", "total (s)", "calls"))
+            for name, timer in sorted(report["timers"].items()):
+                print_message("  %-40s %10.3f %10d" % (name, timer["total"], timer["calls"]))
+        if len(report["counters"]) > 0:
+            print_message("Counters:")
+            for name, value in sorted(report["counters"].items()):
+                print_message("  %-40s %21d" % (name, value))
+        if len(report["queues"]) > 0:
+            print_message("%-42s %10s %10s" % ("Queue depths:", "max", "mean"))
+            for name, queue in sorted(report["queues"].items()):
+                print_message("  %-40s %10d %10.1f" % (name, queue["max"], queue["mean"]))
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.get_report(), f, indent=2)
+
+
+# Statistics of the current run
+stats = Statistics()
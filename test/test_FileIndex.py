@@ -0,0 +1,226 @@
+import unittest
+import os
+import tempfile
+import json
+from io import StringIO
+from file_index import FileIndex
+from configuration import Configuration
+from os_abstraction import OSAbstraction
+from tree_walker import TreeWalker
+from extension import Extension
+from threading import Thread
+
+
+class CountingExtension(Extension):
+    def __init__(self):
+        self.postprocessed = []
+
+    def after_file_added(self, entry):
+        self.postprocessed.append(entry.current_name)
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.config = Configuration()
+        self.index = FileIndex(self.config, OSAbstraction(self.config))
+
+        open(os.path.join(self.root, "regular.txt"), "w").close()
+        os.symlink("regular.txt", os.path.join(self.root, "good_link"))
+        os.symlink("missing.txt", os.path.join(self.root, "broken_link"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def added_names(self):
+        return sorted(os.path.basename(entry.current_name) for entry in self.index.get_all().values())
+
+    def test_broken_links_discarded(self):
+        self.index.add(TreeWalker().walk(self.root))
+        self.assertEqual(self.added_names(), ["good_link", "regular.txt"])
+
+    def test_broken_links_discarded_for_paths(self):
+        self.index.add(os.path.join(self.root, name) for name in os.listdir(self.root))
+        self.assertEqual(self.added_names(), ["good_link", "regular.txt"])
+
+    def test_checks_disabled(self):
+        self.config.file_checks = []
+        self.index.add(TreeWalker().walk(self.root))
+        self.assertEqual(self.added_names(), ["broken_link", "good_link", "regular.txt"])
+
+    def test_postprocess_pipeline(self):
+        ext = CountingExtension()
+        self.config.extensions_chain.append(ext)
+        self.config.postprocess_queue_size = 2
+        index = FileIndex(self.config, OSAbstraction(self.config))
+
+        def consume():
+            while index.post_add_pop():
+                pass
+
+        workers = [Thread(target=consume) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        names = [os.path.join(self.root, "regular.txt")] * 20
+        index.add(names)
+        index.close_postprocess_queue()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(ext.postprocessed), 20)
+        self.assertEqual(index.get_postprocess_queue_size(), 0)
+
+    def test_postprocess_without_workers(self):
+        # With -j 0 nothing takes the files from the queue, so they are
+        # post-processed while being added instead of filling it up
+        ext = CountingExtension()
+        self.config.extensions_chain.append(ext)
+        self.config.postprocess_queue_size = 2
+        self.config.postprocess_num_threads = 0
+        index = FileIndex(self.config, OSAbstraction(self.config))
+
+        index.add([os.path.join(self.root, "regular.txt")] * 20)
+        index.close_postprocess_queue()
+
+        self.assertEqual(len(ext.postprocessed), 20)
+        self.assertEqual(index.get_postprocess_queue_size(), 0)
+        self.assertFalse(index.post_add_pop())
+
+    def test_write_user_input(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3"])
+        entries[0].assign_to_group("g1")
+        entries[2].assign_to_group("g1")
+        entries[1].metadata["key"] = "value"
+
+        stream = StringIO()
+        self.index.write_user_input(stream)
+        self.assertEqual(stream.getvalue(), self.index.generate_user_input())
+        self.assertEqual(stream.getvalue().split("\n"), [
+            "# group g1",
+            "%s r   file1" % entries[0].get_uid(),
+            "%s r   file3" % entries[2].get_uid(),
+            "",
+            "# ungrouped",
+            "%s r   file2" % entries[1].get_uid(),
+            "key = value",
+            ""])
+
+    def test_plan_with_sources(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3"])
+        stream = StringIO()
+        self.index.write_user_input(stream, with_sources=True)
+        lines = stream.getvalue().split("\n")
+        self.assertEqual(lines[:2], ["%s <   file1" % entries[0].get_uid(), "%s r   file1" % entries[0].get_uid()])
+
+        lines = [line.replace(" r ", " d ") for line in lines]
+        # The id of file2 refers to another file than when the plan was written
+        lines[2] = "%s <   file0" % entries[1].get_uid()
+        # No source line for file3
+        del lines[4]
+        touched = self.index.handle_user_input(iter(lines), require_sources=True)
+        self.assertEqual(touched, [entries[0]])
+        self.assertEqual(entries[0].target_names, [("file1", "d")])
+        self.assertEqual(entries[1].target_names, [("file2", "r")])
+        self.assertEqual(entries[2].target_names, [("file3", "r")])
+
+    def test_handle_user_input_touches_only_changed_entries(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3", "file4"])
+        entries[2].metadata["note"] = "multi\nline"
+        lines = self.index.generate_user_input().split("\n")
+
+        # rename file1, copy file3 and drop the line of file4
+        lines[0] = "%s r   renamed1" % entries[0].get_uid()
+        lines.insert(3, "%s c   copy3" % entries[2].get_uid())
+        lines = [line for line in lines if not line.endswith("file4")]
+
+        touched = self.index.handle_user_input(iter(lines))
+        self.assertEqual(touched, [entries[0], entries[2]])
+        self.assertEqual(entries[0].target_names, [("renamed1", "r")])
+        self.assertEqual(entries[2].target_names, [("copy3", "c")])
+        self.assertEqual(entries[1].target_names, [("file2", "r")])
+
+    def test_jsonl_plan(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3"])
+        entries[1].assign_to_group("g1")
+        entries[0].metadata["key"] = "value"
+
+        stream = StringIO()
+        self.index.write_user_input_jsonl(stream)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([record["source"] for record in records], ["file2", "file1", "file3"])
+        self.assertEqual(records[0]["group"], "g1")
+        self.assertEqual(records[1]["metadata"], {"key": "value"})
+
+        records[1]["targets"] = [{"action": "r", "name": "renamed1"}, {"action": "c", "name": "copy1"}]
+        records[2]["targets"] = [{"action": "d", "name": "file3"}]
+        touched = self.index.handle_user_input_jsonl(json.dumps(record) for record in records)
+        self.assertEqual(touched, [entries[0], entries[2]])
+        self.assertEqual(entries[0].target_names, [("renamed1", "r"), ("copy1", "c")])
+
+        # Applied to another index, the entries are created from the source names
+        other_index = FileIndex(self.config, OSAbstraction(self.config))
+        touched = other_index.handle_user_input_jsonl(json.dumps(record) for record in records)
+        self.assertEqual([(entry.current_name, entry.target_names) for entry in touched], [
+            ("file1", [("renamed1", "r"), ("copy1", "c")]),
+            ("file3", [("file3", "d")])])
+
+    def test_purge(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3"])
+        entries[0].reset()
+        self.index.remove(str(entries[2].get_uid_number()))
+        self.index.purge()
+        self.assertEqual(list(self.index.get_all().values()), [entries[1]])
+
+    def test_tracked_changes(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file%d" % i for i in range(4)])
+        entries[0].assign_to_group("g1")
+        self.index.track_changes()
+
+        self.index.remove(entries[3])
+        entries[0].target_names = [("renamed0", "r")]
+        entries[1].target_names = [("renamed1", "r")]
+        self.index.retain(entries[:2])
+        removed, changed = self.index.take_changes()
+        self.assertEqual(sorted(entry.current_name for entry in removed), ["file2", "file3"])
+        self.assertEqual(changed, entries[:2])
+
+        entries[1].target_names = []
+        self.index.retain([entries[1]], scope=[])
+        removed, changed = self.index.take_changes()
+        self.assertEqual(removed, [entries[1]])
+        self.assertEqual(changed, [])
+        # Removed entries keep their group
+        self.index.remove(entries[0])
+        removed, _ = self.index.take_changes()
+        self.assertEqual(removed[0].get_group_id(), "g1")
+
+    def test_group_index(self):
+        self.config.file_checks = []
+        entries = self.index.add(["file1", "file2", "file3"])
+        for entry in entries:
+            entry.assign_to_group("g1")
+        entries[2].assign_to_group("g2")
+        self.assertEqual(self.index.get_group_size("g1"), 2)
+        self.assertEqual(self.index.get_groups_of_size(1), ["g2"])
+
+        self.index.remove(entries[0])
+        self.assertEqual(sorted(self.index.get_groups_of_size(1)), ["g1", "g2"])
+
+        entries[2].ungroup()
+        self.assertEqual(self.index.get_groups(), ["g1"])
+        self.assertEqual(self.index.get_group_members("g1"), [entries[1]])
+        groups, ungrouped = self.index.get_files_by_groups()
+        self.assertEqual(groups, {"g1": [entries[1]]})
+        self.assertEqual(ungrouped, [entries[2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
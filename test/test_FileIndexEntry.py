@@ -32,6 +32,26 @@ class TestFileIndexEntry(unittest.TestCase):
         self.assertEqual(action, "l")
         self.assertEqual(filename, "testfile2")
 
+    def test_compact_representation(self):
+        entry = FileIndexEntry("./dir/subdir/testfile", "r")
+        self.assertEqual(entry.current_name, "./dir/subdir/testfile")
+        self.assertFalse(hasattr(entry, "__dict__"))
+
+        # Reading the targets keeps the compact form
+        self.assertEqual(entry.target_names, [("./dir/subdir/testfile", "r")])
+        self.assertEqual(entry._targets, "r")
+
+        entry.add_target_name("./dir/other", "c")
+        entry.remarks += ["remark"]
+        entry.metadata["key"] = "value"
+        self.assertEqual(entry.target_names, [("./dir/subdir/testfile", "r"), ("./dir/other", "c")])
+        self.assertEqual(entry.remarks, ["remark"])
+        self.assertEqual(entry.metadata, {"key": "value"})
+
+        entry.reset()
+        self.assertEqual(entry.target_names, [])
+        self.assertEqual(entry.remarks, [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+import os
+import tempfile
+from action_planner import plan_operations, PlannedOperation
+from configuration import Configuration
+from file_index import FileIndex, FileIndexEntry
+from os_abstraction import IOSAbstraction, OSAbstraction
+from ifstool import execute_actions
+
+
+class TestActionPlanner(unittest.TestCase):
+
+    def __init__(self, method_name):
+        unittest.TestCase.__init__(self, method_name)
+        self.os_mock = IOSAbstraction()
+        self.os_mock.make_temporary_name = lambda path: path + ".tmp"
+
+    def make_entry(self, name, *targets):
+        entry = FileIndexEntry(name, "r")
+        entry.target_names = list(targets)
+        return entry
+
+    def describe(self, plan):
+        return [str(op) for op in plan]
+
+    def test_chain(self):
+        entries = [self.make_entry("a", ("b", "r")), self.make_entry("b", ("c", "r"))]
+        self.assertEqual(self.describe(plan_operations(entries, self.os_mock)), ["r b -> c", "r a -> b"])
+
+    def test_swap(self):
+        entries = [self.make_entry("a", ("b", "r")), self.make_entry("b", ("a", "r"))]
+        plan = plan_operations(entries, self.os_mock)
+        self.assertEqual(self.describe(plan), ["r a -> a.tmp", "r b -> a", "r a.tmp -> b"])
+        self.assertEqual(plan[0].part, PlannedOperation.TO_TEMPORARY)
+        self.assertIs(plan[2].partner, plan[0])
+
+    def test_copy_before_move(self):
+        entries = [self.make_entry("a", ("b", "r"), ("c", "c")), self.make_entry("b", ("d", "d"))]
+        self.assertEqual(self.describe(plan_operations(entries, self.os_mock)),
+                         ["c a -> c", "d b -> None", "r a -> b"])
+
+
+class TestExecutePlan(unittest.TestCase):
+
+    def test_rotate_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            names = [os.path.join(root, name) for name in ["a", "b", "c"]]
+            for name in names:
+                with open(name, "w") as f:
+                    f.write(os.path.basename(name))
+
+            config = Configuration()
+            config.prompt_on_actions = False
+            os_abs = OSAbstraction(config)
+            index = FileIndex(config, os_abs)
+            entries = index.add(names)
+            for entry, target in zip(entries, names[1:] + names[:1]):
+                entry.target_names = [(target, "r")]
+
+            ops_done, remaining = execute_actions(index, os_abs, config)
+            self.assertEqual((ops_done, remaining), (3, 0))
+            self.assertEqual(sorted(os.listdir(root)), ["a", "b", "c"])
+            for name, expected in zip(names, ["c", "a", "b"]):
+                with open(name) as f:
+                    self.assertEqual(f.read(), expected)
+
+    def test_skip_dependent_operations(self):
+        with tempfile.TemporaryDirectory() as root:
+            names = [os.path.join(root, name) for name in ["a", "b", "c"]]
+            for name in names:
+                with open(name, "w") as f:
+                    f.write(os.path.basename(name))
+
+            config = Configuration()
+            config.prompt_on_actions = False
+            config.allow_overwriting = True
+            os_abs = OSAbstraction(config)
+            rename_move = os_abs.rename_move
+            os_abs.rename_move = lambda old_path, new_path: \
+                (False, "failure") if new_path == names[2] else rename_move(old_path, new_path)
+
+            index = FileIndex(config, os_abs)
+            entries = index.add(names[:2])
+            entries[0].target_names = [(names[1], "r")]
+            entries[1].target_names = [(names[2], "r")]
+            ops_done, remaining = execute_actions(index, os_abs, config)
+
+            # Moving "b" away failed, so "a" does not take its place
+            self.assertEqual((ops_done, remaining), (0, 2))
+            for name in names:
+                with open(name) as f:
+                    self.assertEqual(f.read(), os.path.basename(name))
+            self.assertTrue(entries[0].remarks[-1].startswith("Skipped"))
+            self.assertEqual(entries[0].target_names, [(names[1], "r")])
+
+    def test_restore_to_taken_name(self):
+        with tempfile.TemporaryDirectory() as root:
+            names = [os.path.join(root, name) for name in ["a", "b"]]
+            for name in names:
+                with open(name, "w") as f:
+                    f.write(os.path.basename(name))
+
+            config = Configuration()
+            config.prompt_on_actions = False
+            os_abs = OSAbstraction(config)
+            rename_move = os_abs.rename_move
+
+            def failing_to_b(old_path, new_path):
+                if new_path == names[1]:
+                    return (False, "failure")
+                return rename_move(old_path, new_path)
+
+            os_abs.rename_move = failing_to_b
+            index = FileIndex(config, os_abs)
+            entries = index.add(names)
+            entries[0].target_names = [(names[1], "r")]
+            entries[1].target_names = [(names[0], "r")]
+            execute_actions(index, os_abs, config)
+
+            # "b" has been moved to "a", so the file of "a" stays under the temporary name
+            temporary = [name for name in os.listdir(root) if name not in ["a", "b"]]
+            self.assertEqual(len(temporary), 1)
+            with open(names[0]) as f:
+                self.assertEqual(f.read(), "b")
+            with open(os.path.join(root, temporary[0])) as f:
+                self.assertEqual(f.read(), "a")
+            self.assertIn(temporary[0], entries[0].remarks[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,4 +9,7 @@ class TestApplication(unittest.TestCase):
         self.assertRaises(SystemExit, run, ["-xdf:help"])
         self.assertRaises(SystemExit, run, ["-xcadf.audio:help"])
 
-
+    def test_incorrect_numbers(self):
+        for args in [["-j", "x"], ["-J", "0"], ["--max-depth=-1"], ["--hash-cache-limit=many"],
+                     ["--journal-sync=nan"], ["--chunks=count:0"]]:
+            self.assertRaises(SystemExit, run, args + ["."])
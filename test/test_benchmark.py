@@ -0,0 +1,51 @@
+import unittest
+import os
+import tempfile
+from benchmark.tree_generator import TreeGenerator
+from benchmark.run_benchmarks import run_benchmarks, compare_results, ALL_PHASES
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def list_tree(self, root):
+        result = {}
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(directory, name)
+                with open(path, "rb") as f:
+                    result[os.path.relpath(path, root)] = f.read()
+        return result
+
+    def test_generator(self):
+        generator = TreeGenerator(depth=2, fan_out=3, num_files=50, max_size=1000,
+                                  duplicate_ratio=0.5, mp3_ratio=0.5, seed=1)
+        with tempfile.TemporaryDirectory() as root1, tempfile.TemporaryDirectory() as root2:
+            summary = generator.generate(root1)
+            self.assertEqual(summary["directories"], 1 + 3 + 9)
+            self.assertEqual(summary["files"], 50)
+            self.assertGreater(summary["duplicates"], 0)
+
+            tree = self.list_tree(root1)
+            self.assertEqual(len(tree), 50)
+            self.assertEqual(sum(len(content) for content in tree.values()), summary["total_size"])
+            self.assertTrue(any(name.endswith(".mp3") for name in tree))
+
+            # The same parameters give the same tree
+            generator.generate(root2)
+            self.assertEqual(self.list_tree(root2), tree)
+
+    def test_run_benchmarks(self):
+        with tempfile.TemporaryDirectory() as root:
+            TreeGenerator(depth=1, fan_out=2, num_files=20, max_size=1000, mp3_ratio=0.5).generate(root)
+            results = run_benchmarks(root, repeats=1)
+            self.assertEqual(sorted(results), sorted(ALL_PHASES))
+            self.assertEqual(results["walk"]["items"], 20)
+            self.assertEqual(results["execute_actions"]["items"], 20)
+
+            slower = {name: dict(result, seconds=result["seconds"] * 2 + 1) for name, result in results.items()}
+            self.assertTrue(all(regression for _, _, _, regression in compare_results(results, slower)))
+            self.assertFalse(any(regression for _, _, _, regression in compare_results(slower, results)))
+
+
+if __name__ == "__main__":
+    unittest.main()
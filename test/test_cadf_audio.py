@@ -0,0 +1,161 @@
+import unittest
+import os
+import struct
+import tempfile
+from file_index import FileIndex
+from configuration import Configuration
+from os_abstraction import OSAbstraction
+from extensions.cadf.audio import Extension_cadf_audio
+
+AUDIO = b'\xff\xfb\x90\x64' + bytes(range(256)) * 40
+
+
+def id3v2(payload, flags=0):
+    size = len(payload)
+    return b'ID3\x03\x00' + bytes([flags, (size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F]) + payload
+
+
+def id3v1(title):
+    return b'TAG' + title.ljust(125, b'\0')
+
+
+def flac(*blocks):
+    result = b'fLaC'
+    for i, (block_type, payload) in enumerate(blocks):
+        last = 0x80 if i == len(blocks) - 1 else 0
+        result += bytes([last | block_type]) + len(payload).to_bytes(3, "big") + payload
+    return result + AUDIO
+
+
+def wav(*chunks):
+    body = b'WAVE'
+    for chunk_id, payload in chunks + ((b'data', AUDIO),):
+        body += chunk_id + struct.pack("<I", len(payload)) + payload + b'\0' * (len(payload) & 1)
+    return b'RIFF' + struct.pack("<I", len(body)) + body
+
+
+def ogg_page(packets, sequence):
+    segment_table = b''
+    for packet in packets:
+        segment_table += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+    header = b'OggS\0\0' + b'\0' * 8 + b'\1\0\0\0' + struct.pack("<I", sequence) + b'\0' * 4
+    return header + bytes([len(segment_table)]) + segment_table + b''.join(packets)
+
+
+def mp4(*atoms):
+    result = b''
+    for atom_type, payload in ((b'ftyp', b'M4A \0\0\0\0'),) + atoms:
+        result += struct.pack(">I", len(payload) + 8) + atom_type + payload
+    return result
+
+
+class TestAudioRegion(unittest.TestCase):
+
+    def setUp(self):
+        self.ext = Extension_cadf_audio()
+
+    def test_plain(self):
+        offset, length, _ = self.ext._parse_mp3(AUDIO, "test.mp3")
+        self.assertEqual((offset, length), (0, len(AUDIO)))
+
+    def test_tags_and_padding(self):
+        head = id3v2(b'a' * 300) + b'\0' * 1000 + id3v2(b'b' * 20)
+        data = head + AUDIO + id3v1(b'title')
+        offset, length, structure = self.ext._parse_mp3(data, "test.mp3")
+        self.assertEqual((offset, length), (len(head), len(AUDIO)))
+        self.assertEqual([description for _, _, description in structure], ["ID3v2", "Zero-padding", "ID3v2", "ID3v1"])
+
+    def test_flac(self):
+        data = id3v2(b'x' * 50) + flac((0, b's' * 34), (4, b'comments'), (1, b'\0' * 100))
+        offset, length, _ = self.ext._parse_flac(data, "test.flac")
+        self.assertEqual(data[offset:offset + length], AUDIO)
+
+    def test_wav(self):
+        data = wav((b'fmt ', b'f' * 16), (b'LIST', b'INFOtags!'))
+        offset, length, _ = self.ext._parse_wav(data, "test.wav")
+        self.assertEqual(data[offset:offset + length], AUDIO)
+
+    def test_ogg(self):
+        comments = b'\x03vorbis' + b'c' * 600
+        data = ogg_page([b'\x01vorbis' + b'i' * 20], 0) + ogg_page([comments, b'\x05vorbis setup'], 1) \
+            + ogg_page([AUDIO[:200]], 2)
+        offset, length, _ = self.ext._parse_ogg(data, "test.ogg")
+        self.assertEqual(data[offset:offset + length], ogg_page([AUDIO[:200]], 2))
+
+    def test_mp4(self):
+        data = mp4((b'moov', b'tags' * 20), (b'free', b''), (b'mdat', AUDIO))
+        offset, length, _ = self.ext._parse_mp4(data, "test.m4a")
+        self.assertEqual(data[offset:offset + length], AUDIO)
+
+    def test_detect_format(self):
+        self.assertEqual(self.ext._detect_format(id3v2(b'x') + AUDIO), "mp3")
+        self.assertEqual(self.ext._detect_format(AUDIO), "mp3")
+        self.assertEqual(self.ext._detect_format(id3v2(b'x') + flac((0, b's'))), "flac")
+        self.assertEqual(self.ext._detect_format(wav()), "wav")
+        self.assertEqual(self.ext._detect_format(ogg_page([b'\x01vorbis'], 0)), "ogg")
+        self.assertEqual(self.ext._detect_format(mp4()), "mp4")
+        self.assertIsNone(self.ext._detect_format(b'plain text'))
+
+    def test_empty_and_truncated(self):
+        self.assertEqual(self.ext._parse_mp3(b'', "test.mp3")[:2], (0, 0))
+        self.assertEqual(self.ext._parse_mp3(id3v2(b'a' * 300)[:50], "test.mp3")[1], 0)
+
+
+class TestAudioDuplicates(unittest.TestCase):
+
+    def test_differently_tagged_duplicates(self):
+        contents = {
+            "a.mp3": id3v2(b'artist a') + AUDIO + id3v1(b'a'),
+            "b.mp3": id3v2(b'other artist, longer tag') + b'\0' * 64 + AUDIO,
+            "c.mp3": AUDIO[:-1] + b'x',
+            "d.txt": AUDIO,
+            "e.flac": flac((0, b's' * 34), (4, b'tags of e')),
+            "f.flac": id3v2(b'id3 tags') + flac((0, b's' * 34), (4, b'tags of f, longer'), (1, b'\0' * 10)),
+            "g.wav": wav((b'fmt ', b'f' * 16)),
+            "h.m4a": mp4((b'moov', b'other tags'), (b'mdat', AUDIO)),
+            "i.flac": b'fLaC\x84\x00',
+        }
+        with tempfile.TemporaryDirectory() as root:
+            for name, content in contents.items():
+                with open(os.path.join(root, name), "wb") as f:
+                    f.write(content)
+
+            config = Configuration()
+            ext = Extension_cadf_audio()
+            config.extensions_chain.append(ext)
+            index = FileIndex(config, OSAbstraction(config))
+            index.add(os.path.join(root, name) for name in sorted(contents))
+            index.close_postprocess_queue()
+            while index.post_add_pop():
+                pass
+            ext.on_index_complete(index)
+
+            groups, ungrouped = index.get_files_by_groups()
+            self.assertEqual([sorted(os.path.basename(entry.current_name) for entry in entries)
+                              for entries in groups.values()], [["a.mp3", "b.mp3", "e.flac", "f.flac", "g.wav", "h.m4a"]])
+            self.assertEqual([os.path.basename(entry.current_name) for entry in ungrouped], ["c.mp3", "i.flac"])
+
+    def test_chunk_size(self):
+        with tempfile.TemporaryDirectory() as root:
+            name = os.path.join(root, "a.mp3")
+            with open(name, "wb") as f:
+                f.write(AUDIO)
+            ext = Extension_cadf_audio()
+            digest = ext._hash_region(name, 0, len(AUDIO))
+            ext._read_chunk_size = 7
+            self.assertEqual(ext._hash_region(name, 0, len(AUDIO)), digest)
+
+    def test_probe(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name, content in [("audio.bin", flac((0, b's'))), ("text.bin", b'plain text')]:
+                with open(os.path.join(root, name), "wb") as f:
+                    f.write(content)
+            ext = Extension_cadf_audio()
+            self.assertFalse(ext.before_file_added(os.path.join(root, "audio.bin")))
+            ext._probe = True
+            self.assertTrue(ext.before_file_added(os.path.join(root, "audio.bin")))
+            self.assertFalse(ext.before_file_added(os.path.join(root, "text.bin")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import os
+import stat
+import tempfile
+from unittest import mock
+from configuration import Configuration
+from file_index import FileIndex
+from os_abstraction import OSAbstraction
+from chunker import split_into_chunks, CHUNK_BY_COUNT, CHUNK_BY_DIRECTORY, CHUNK_BY_GROUP
+from ifstool import run_chunked_sessions
+
+# Editor renaming every file to <name>.new, and logging the files it was run on
+EDITOR_SCRIPT = """#!/bin/sh
+echo "$1" >> "%s"
+sed -E -i 's/^([0-9]+ r +)(.*)$/\\1\\2.new/' "$1"
+"""
+
+
+class TestChunker(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.root = self._tempdir.name
+        self.config = Configuration()
+        self.config.prompt_on_actions = False
+        self.os_abs = OSAbstraction(self.config)
+        self.index = FileIndex(self.config, self.os_abs)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def create_files(self, names):
+        paths = []
+        for name in names:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(name)
+            paths.append(path)
+        return self.index.add(paths)
+
+    def names(self, chunks):
+        return [[os.path.relpath(entry.current_name, self.root) for entry in chunk] for chunk in chunks]
+
+    def test_by_count(self):
+        entries = self.create_files(["f%d" % i for i in range(5)])
+        chunks = split_into_chunks(entries, CHUNK_BY_COUNT, 2)
+        self.assertEqual(self.names(chunks), [["f0", "f1"], ["f2", "f3"], ["f4"]])
+
+    def test_by_directory(self):
+        entries = self.create_files(["a/x/1", "b/2", "a/3", "top", "b/4", "b/5"])
+        chunks = split_into_chunks(entries, CHUNK_BY_DIRECTORY, 2, [self.root])
+        self.assertEqual(self.names(chunks), [["a/x/1", "a/3"], ["b/2", "b/4"], ["b/5"], ["top"]])
+
+    def test_by_group(self):
+        entries = self.create_files(["f%d" % i for i in range(7)])
+        for entry, group in zip(entries, [1, 1, 2, 2, 3, None, None]):
+            entry.assign_to_group(group)
+        chunks = split_into_chunks(self.index.get_entries_in_order(), CHUNK_BY_GROUP, 3)
+        self.assertEqual(self.names(chunks), [["f0", "f1"], ["f2", "f3", "f4"], ["f5", "f6"]])
+
+    def test_chunked_sessions(self):
+        log_file = os.path.join(self.root, "editor.log")
+        editor = os.path.join(self.root, "editor.sh")
+        with open(editor, "w") as f:
+            f.write(EDITOR_SCRIPT % log_file)
+        os.chmod(editor, stat.S_IRWXU)
+
+        self.create_files(["data/f%d" % i for i in range(5)])
+        self.config.chunk_mode = CHUNK_BY_COUNT
+        self.config.chunk_size = 2
+        with mock.patch.dict(os.environ, {"EDITOR": editor}):
+            operations_done = run_chunked_sessions(self.index, self.os_abs, self.config, [self.root])
+
+        self.assertEqual(operations_done, 5)
+        self.assertEqual(self.index.get_size(), 0)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "data"))), ["f%d.new" % i for i in range(5)])
+        with open(log_file) as f:
+            edited_files = f.read().split()
+        self.assertEqual(len(edited_files), 3)
+        # The editor files are removed once read
+        self.assertFalse(any(os.path.exists(name) for name in edited_files))
+
+
+if __name__ == '__main__':
+    unittest.main()
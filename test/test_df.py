@@ -0,0 +1,110 @@
+import unittest
+import os
+import tempfile
+from file_index import FileIndex
+from configuration import Configuration
+from os_abstraction import OSAbstraction
+from extensions.df import Extension_df
+from extension_handler import validate_and_fill
+from process_backend import ProcessBackend
+
+
+class TestDuplicateFinder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        big = b"x" * (Extension_df.PARTIAL_HASH_BLOCK_SIZE * 3)
+        self.contents = {
+            "big1": big,
+            "big2": big,
+            "big_other_tail": big[:-1] + b"y",
+            "big_other_middle": big[:100] + b"y" + big[101:],
+            "small1": b"abc",
+            "small2": b"abc",
+            "small_other": b"abd",
+            "unique_size": b"abcd",
+        }
+        for name, content in self.contents.items():
+            with open(os.path.join(self.tmpdir.name, name), "wb") as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def build_index(self, policy, algo="sha224", use_process_pool=False):
+        config = Configuration()
+        ext = self.ext = Extension_df()
+        ext.on_params_passed(validate_and_fill({"unique": policy, "algo": algo, "chunk": "1000"}, ext.on_params_query()))
+        config.extensions_chain.append(ext)
+        index = FileIndex(config, OSAbstraction(config))
+        if use_process_pool:
+            backend = ProcessBackend(config.extensions_chain, 2)
+            index.use_process_backend(backend)
+        index.add(os.path.join(self.tmpdir.name, name) for name in sorted(self.contents))
+        index.close_postprocess_queue()
+        while index.post_add_pop():
+            pass
+        if use_process_pool:
+            backend.shutdown()
+        ext.on_index_complete(index)
+        return index
+
+    def group_names(self, index):
+        groups, ungrouped = index.get_files_by_groups()
+        result = sorted(sorted(os.path.basename(entry.current_name) for entry in entries)
+                        for entries in groups.values())
+        return result, sorted(os.path.basename(entry.current_name) for entry in ungrouped)
+
+    def test_ungroup_policy(self):
+        groups, ungrouped = self.group_names(self.build_index("ungroup"))
+        self.assertEqual(groups, [["big1", "big2"], ["small1", "small2"]])
+        self.assertEqual(ungrouped, ["big_other_middle", "big_other_tail", "small_other", "unique_size"])
+
+    def test_drop_policy(self):
+        index = self.build_index("drop")
+        groups, ungrouped = self.group_names(index)
+        self.assertEqual(groups, [["big1", "big2"], ["small1", "small2"]])
+        self.assertEqual(ungrouped, [])
+        self.assertEqual(index.get_size(), 4)
+
+    def test_index_changed(self):
+        index = self.build_index("ungroup")
+        index.track_changes()
+        entries = {os.path.basename(entry.current_name): entry for entry in index.get_all().values()}
+        big1, big2 = entries["big1"], entries["big2"]
+        index.remove(big1)
+        removed, changed = index.take_changes()
+        self.ext.on_index_changed(index, removed, changed)
+        self.assertIsNone(big2.get_group_id())
+        groups, _ = self.group_names(index)
+        self.assertEqual(groups, [["small1", "small2"]])
+
+    def test_group_policy(self):
+        groups, ungrouped = self.group_names(self.build_index("group"))
+        self.assertEqual(len(groups), 6)
+        self.assertEqual(ungrouped, [])
+
+    def test_group_policy_partial_hash_of_other_size(self):
+        # Same first and last blocks as big_other_tail, but longer
+        longer = b"x" * (Extension_df.PARTIAL_HASH_BLOCK_SIZE * 4)
+        self.contents["longer_other_tail"] = longer[:-1] + b"y"
+        self.contents["longer_other_head"] = b"y" + longer[1:]
+        for name in ["longer_other_tail", "longer_other_head"]:
+            with open(os.path.join(self.tmpdir.name, name), "wb") as f:
+                f.write(self.contents[name])
+
+        groups, ungrouped = self.group_names(self.build_index("group"))
+        self.assertEqual([group for group in groups if len(group) > 1], [["big1", "big2"], ["small1", "small2"]])
+        self.assertEqual(len(groups), 8)
+
+    def test_other_algorithm(self):
+        groups, ungrouped = self.group_names(self.build_index("ungroup", "blake2b"))
+        self.assertEqual(groups, [["big1", "big2"], ["small1", "small2"]])
+
+    def test_process_pool(self):
+        groups, ungrouped = self.group_names(self.build_index("ungroup", use_process_pool=True))
+        self.assertEqual(groups, [["big1", "big2"], ["small1", "small2"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
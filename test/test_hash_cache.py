@@ -0,0 +1,58 @@
+import unittest
+import os
+import tempfile
+from hash_cache import HashCache
+
+
+class TestHashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmpdir.name, "cache", "hashes.sqlite")
+        self.files = []
+        for name in ["a", "b", "c"]:
+            path = os.path.join(self.tmpdir.name, name)
+            with open(path, "w") as f:
+                f.write(name)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_values_persist(self):
+        cache = HashCache(self.cache_path)
+        cache.put(os.stat(self.files[0]), "full", "digest-a")
+        cache.close()
+
+        cache = HashCache(self.cache_path)
+        self.assertEqual(cache.get(os.stat(self.files[0]), "full"), "digest-a")
+        self.assertIsNone(cache.get(os.stat(self.files[0]), "audio"))
+        self.assertIsNone(cache.get(os.stat(self.files[1]), "full"))
+        cache.close()
+
+    def test_modified_file_is_not_served(self):
+        cache = HashCache(self.cache_path)
+        cache.put(os.stat(self.files[0]), "full", "digest-a")
+        cache.flush()
+        with open(self.files[0], "a") as f:
+            f.write("more content")
+        self.assertIsNone(cache.get(os.stat(self.files[0]), "full"))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = HashCache(self.cache_path, limit=2)
+        for path in self.files:
+            cache.put(os.stat(path), "full", path)
+        cache.flush()
+        cache.get(os.stat(self.files[0]), "full")
+        cache.close()
+
+        cache = HashCache(self.cache_path, limit=2)
+        self.assertEqual(cache.get(os.stat(self.files[0]), "full"), self.files[0])
+        self.assertIsNone(cache.get(os.stat(self.files[1]), "full"))
+        self.assertEqual(cache.get(os.stat(self.files[2]), "full"), self.files[2])
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
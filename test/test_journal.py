@@ -0,0 +1,125 @@
+import unittest
+import os
+import tempfile
+from configuration import Configuration
+from file_index import FileIndex
+from journal import Journal, load_journal, has_unfinished_execution
+from os_abstraction import OSAbstraction
+from action_planner import plan_operations
+from ifstool import execute_actions, resume_actions, undo_actions, run
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.root = self._tempdir.name
+        self.journal_file = os.path.join(self.root, "journal", "journal.jsonl")
+        self.names = [os.path.join(self.root, name) for name in ["a", "b", "c"]]
+        for name in self.names:
+            with open(name, "w") as f:
+                f.write(os.path.basename(name))
+
+        self.config = Configuration()
+        self.config.prompt_on_actions = False
+        self.os_abs = OSAbstraction(self.config)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return f.read()
+
+    def execute_rotation(self):
+        index = FileIndex(self.config, self.os_abs)
+        entries = index.add(self.names)
+        for entry, target in zip(entries, self.names[1:] + self.names[:1]):
+            entry.target_names = [(target, "r")]
+        journal = Journal(self.journal_file, sync_interval=0)
+        execute_actions(index, self.os_abs, self.config, None, journal)
+        journal.finish()
+        journal.close()
+
+    def test_records(self):
+        self.execute_rotation()
+        sections = load_journal(self.journal_file)
+        self.assertEqual(len(sections), 1)
+        operations, completed, finished = sections[0]
+        self.assertEqual(len(operations), 4)
+        self.assertEqual(completed, operations)
+        self.assertTrue(finished)
+
+    def test_resume(self):
+        self.execute_rotation()
+
+        # Pretend that the execution was interrupted after the second operation,
+        # and the result of the second one did not reach the disk
+        with open(self.journal_file) as f:
+            lines = f.readlines()
+        with open(self.journal_file, "w") as f:
+            f.writelines(lines[:-4])
+        for name in self.names:
+            os.remove(name)
+        for name, content in [(".a.ifstool-tmp0", "a"), ("a", "c"), ("b", "b")]:
+            with open(os.path.join(self.root, name), "w") as f:
+                f.write(content)
+
+        journal = Journal(self.journal_file, sync_interval=0, append=True)
+        self.assertEqual(resume_actions(self.journal_file, self.os_abs, self.config, journal), (2, 0))
+        journal.close()
+        self.assertEqual(sorted(os.listdir(self.root)), ["a", "b", "c", "journal"])
+        self.assertEqual([self.read(name) for name in ["a", "b", "c"]], ["c", "a", "b"])
+
+    def interrupt_copy(self, started):
+        """
+        Writes the journal of a copy of "a" to "b" interrupted before its result
+        has been recorded.
+        """
+        index = FileIndex(self.config, self.os_abs)
+        entry = index.add(self.names[:1])[0]
+        entry.target_names = [(self.names[1], "c")]
+        operations = plan_operations([entry], self.os_abs)
+        journal = Journal(self.journal_file, sync_interval=0)
+        journal.begin(operations)
+        if started:
+            journal.record(operations[0], Journal.STARTED)
+        journal.close()
+
+    def test_resume_interrupted_copy(self):
+        self.interrupt_copy(started=True)
+        self.assertEqual(resume_actions(self.journal_file, self.os_abs, self.config), (1, 0))
+        self.assertEqual(self.read("b"), "a")
+
+    def test_resume_does_not_overwrite_existing_target(self):
+        # "b" existed before the run, so the copy has never been started
+        self.interrupt_copy(started=False)
+        self.assertEqual(resume_actions(self.journal_file, self.os_abs, self.config), (0, 1))
+        self.assertEqual(self.read("b"), "b")
+
+    def test_unfinished_journal_kept(self):
+        self.interrupt_copy(started=False)
+        self.assertTrue(has_unfinished_execution(self.journal_file))
+        with open(self.journal_file) as f:
+            contents = f.read()
+
+        self.assertRaises(SystemExit, run, ["--journal-file=%s" % self.journal_file, "-y", self.root])
+        with open(self.journal_file) as f:
+            self.assertEqual(f.read(), contents)
+
+        self.execute_rotation()
+        self.assertFalse(has_unfinished_execution(self.journal_file))
+
+    def test_undo(self):
+        self.execute_rotation()
+        journal = Journal(self.journal_file, sync_interval=0, append=True)
+        self.assertEqual(undo_actions(self.journal_file, self.os_abs, self.config, journal), (4, 0))
+        journal.close()
+        self.assertEqual([self.read(name) for name in ["a", "b", "c"]], ["a", "b", "c"])
+
+        # Reverted operations are not reverted again
+        self.assertEqual(undo_actions(self.journal_file, self.os_abs, self.config), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
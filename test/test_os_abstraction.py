@@ -0,0 +1,185 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+import os_abstraction
+from os_abstraction import copy_file, OSAbstraction
+from configuration import Configuration
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def test_copy_file(self):
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "src")
+            dst = os.path.join(root, "dst")
+            content = os.urandom(3 * 1024 * 1024 + 17)
+            with open(src, "wb") as f:
+                f.write(content)
+            os.chmod(src, 0o640)
+            os.utime(src, (1000000000, 1000000000))
+
+            method = copy_file(src, dst, preserve_metadata=True)
+            self.assertIn(method, ["reflink", "copy_file_range", "sendfile", "buffered"])
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(os.stat(dst).st_mode & 0o777, 0o640)
+            self.assertEqual(os.stat(dst).st_mtime, 1000000000)
+
+    def test_copy_empty_file(self):
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "src")
+            dst = os.path.join(root, "dst")
+            open(src, "wb").close()
+            copy_file(src, dst)
+            self.assertEqual(os.path.getsize(dst), 0)
+
+    def test_copy_wrong_size(self):
+        # The size reported for the source is not to be trusted, like for a
+        # file growing while being copied
+        real_fstat = os.fstat
+
+        def fstat_reporting_small_size(fd):
+            stat_result = list(real_fstat(fd))
+            stat_result[6] = 10
+            return os.stat_result(stat_result)
+
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "src")
+            content = os.urandom(3 * 1024 * 1024 + 17)
+            with open(src, "wb") as f:
+                f.write(content)
+            for method in ["copy_file_range", "sendfile", "buffered"]:
+                dst = os.path.join(root, method)
+                with mock.patch("os_abstraction.os.fstat", side_effect=fstat_reporting_small_size), \
+                        mock.patch("os_abstraction._COPY_METHODS", [m for m in os_abstraction._COPY_METHODS
+                                                                     if m[0] == method]):
+                    try:
+                        copy_file(src, dst)
+                    except OSError:
+                        # The method is not supported here
+                        continue
+                with open(dst, "rb") as f:
+                    self.assertEqual(f.read(), content, method)
+
+    def test_copy_to_same_file(self):
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "src")
+            with open(src, "wb") as f:
+                f.write(b"content")
+            os.link(src, os.path.join(root, "hardlink"))
+            for dst in [os.path.join(root, ".", "src"), os.path.join(root, "hardlink")]:
+                self.assertRaises(OSError, copy_file, src, dst)
+            with open(src, "rb") as f:
+                self.assertEqual(f.read(), b"content")
+
+            config = Configuration()
+            os_ = OSAbstraction(config)
+            self.assertFalse(os_.copy(src, os.path.join(root, ".", "src"))[0])
+
+    @unittest.skipUnless(os.path.exists("/proc/self/status"), "procfs not available")
+    def test_copy_procfs_file(self):
+        # Files of procfs report the size of 0
+        with tempfile.TemporaryDirectory() as root:
+            dst = os.path.join(root, "dst")
+            copy_file("/proc/self/status", dst)
+            with open(dst) as f:
+                self.assertIn("Name:", f.read())
+
+
+class TestStatCache(unittest.TestCase):
+
+    def _create_os(self, simulate=False):
+        conf = Configuration()
+        conf.simulation_mode = simulate
+        conf.stat_cache_ttl = None
+        return OSAbstraction(conf)
+
+    def test_operations_update_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "a")
+            open(src, "w").close()
+            os.mkdir(os.path.join(root, "dir"))
+            os_ = self._create_os()
+
+            self.assertTrue(os_.isfile(src))
+            self.assertTrue(os_.isdir(os.path.join(root, "dir")))
+            self.assertFalse(os_.isfile(os.path.join(root, "b")))
+
+            self.assertTrue(os_.rename_move(src, os.path.join(root, "b"))[0])
+            self.assertFalse(os_.isfile(src))
+            self.assertTrue(os_.isfile(os.path.join(root, "b")))
+
+            self.assertTrue(os_.mkdir(os.path.join(root, "new", "sub"))[0])
+            self.assertTrue(os_.isdir(os.path.join(root, "new")))
+            self.assertTrue(os_.isdir(os.path.join(root, "new", "sub")))
+            self.assertFalse(os_.isfile(os.path.join(root, "new", "sub", "b")))
+
+            self.assertTrue(os_.copy(os.path.join(root, "b"), os.path.join(root, "new", "sub", "b"))[0])
+            self.assertTrue(os_.isfile(os.path.join(root, "new", "sub", "b")))
+
+            self.assertTrue(os_.delete(os.path.join(root, "b"))[0])
+            self.assertFalse(os_.isfile(os.path.join(root, "b")))
+
+    def test_external_changes_need_invalidation(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "a")
+            os_ = self._create_os()
+            self.assertFalse(os_.isfile(path))
+            open(path, "w").close()
+            self.assertFalse(os_.isfile(path))
+            os_.invalidate_cache(root)
+            self.assertTrue(os_.isfile(path))
+
+    def test_simulation_mode(self):
+        with tempfile.TemporaryDirectory() as root:
+            src = os.path.join(root, "a")
+            open(src, "w").close()
+            os_ = self._create_os(simulate=True)
+
+            self.assertTrue(os_.mkdir(os.path.join(root, "new", "sub"))[0])
+            self.assertTrue(os_.isdir(os.path.join(root, "new", "sub")))
+            self.assertFalse(os.path.exists(os.path.join(root, "new")))
+            self.assertTrue(os_.isdir(os.path.join(root, "new")))
+
+            os_.rename_move(src, os.path.join(root, "new", "a"))
+            self.assertTrue(os.path.isfile(src))
+            self.assertFalse(os_.isfile(src))
+            self.assertTrue(os_.isfile(os.path.join(root, "new", "a")))
+
+    def test_case_insensitive_names(self):
+        with tempfile.TemporaryDirectory() as root:
+            open(os.path.join(root, "foo"), "w").close()
+            os_ = self._create_os()
+            self.assertFalse(os_.isfile(os.path.join(root, "bar")))
+
+            # Emulates a case-insensitive filesystem for the checks done by stat
+            def ignoring_case(function):
+                return lambda path: function(os.path.join(os.path.dirname(path), os.path.basename(path).lower()))
+
+            with mock.patch.object(os_abstraction.os.path, "isfile", ignoring_case(os.path.isfile)), \
+                    mock.patch.object(os_abstraction.os.path, "isdir", ignoring_case(os.path.isdir)), \
+                    mock.patch.object(os_abstraction.os.path, "lexists", ignoring_case(os.path.lexists)):
+                self.assertTrue(os_.isfile(os.path.join(root, "Foo")))
+                self.assertTrue(os_.isfile(os.path.join(root, "FOO")))
+                self.assertFalse(os_.isfile(os.path.join(root, "Bar")))
+
+            self.assertTrue(os_.delete(os.path.join(root, "foo"))[0])
+            self.assertFalse(os_.isfile(os.path.join(root, "Foo")))
+
+    def test_big_directories_not_cached(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name in ["a", "b", "c"]:
+                open(os.path.join(root, name), "w").close()
+            cache = os_abstraction.StatCache(max_listing_size=2)
+            self.assertEqual(cache.get_kind(os.path.join(root, "a")), os_abstraction.StatCache.FILE)
+            self.assertIsNone(cache.get_kind(os.path.join(root, "d")))
+            self.assertIsNone(cache.get_cached_kind(os.path.join(root, "a")))
+
+            # Changes are seen without invalidation, as nothing is cached
+            open(os.path.join(root, "d"), "w").close()
+            self.assertEqual(cache.get_kind(os.path.join(root, "d")), os_abstraction.StatCache.FILE)
+
+
+if __name__ == "__main__":
+    unittest.main()
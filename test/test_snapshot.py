@@ -0,0 +1,120 @@
+import unittest
+import os
+import tempfile
+from configuration import Configuration
+from extensions.df import Extension_df
+from extension_handler import validate_and_fill
+from file_index import FileIndex
+from os_abstraction import OSAbstraction
+from snapshot import Snapshot, SnapshotEntry
+from tree_walker import TreeWalker
+
+
+class CountingExtension_df(Extension_df):
+    def __init__(self):
+        super().__init__()
+        self.analyzed = []
+
+    def analyze_file(self, entry):
+        self.analyzed.append(os.path.basename(entry.current_name))
+        return super().analyze_file(entry)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.tree = os.path.join(self.root, "tree")
+        self.snapshot_file = os.path.join(self.root, "state", "snapshot.bin")
+        for path, content in [("a", "same"), ("sub1/b", "same"), ("sub1/deep/c", "other"), ("sub2/d", "unique")]:
+            full_path = os.path.join(self.tree, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "w") as f:
+                f.write(content)
+        self.set_old_mtimes()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def set_old_mtimes(self):
+        # The directories modified just now are always listed again
+        for directory, _, files in os.walk(self.tree):
+            for name in files:
+                os.utime(os.path.join(directory, name), (1000000, 1000000))
+            os.utime(directory, (1000000, 1000000))
+
+    def build_index(self):
+        """
+        Builds the index with the df extension, using and saving the snapshot.
+
+        Returns:
+        tuple:Index, names of the directories listed, names of the files analyzed
+        """
+        config = Configuration()
+        ext = CountingExtension_df()
+        ext.on_params_passed(validate_and_fill({"unique": "ungroup"}, ext.on_params_query()))
+        config.extensions_chain.append(ext)
+        snapshot = Snapshot.load(self.snapshot_file, config.extensions_chain)
+        index = FileIndex(config, OSAbstraction(config))
+        index.use_snapshot(snapshot)
+
+        walker = TreeWalker(snapshot=snapshot)
+        listed = []
+        scan_directory = walker._scan_directory
+
+        def recording_scan_directory(directory):
+            listed.append(os.path.relpath(directory, self.tree))
+            return scan_directory(directory)
+
+        walker._scan_directory = recording_scan_directory
+        index.add(walker.walk(self.tree))
+        index.close_postprocess_queue()
+        while index.post_add_pop():
+            pass
+        ext.on_index_complete(index)
+        snapshot.save(self.snapshot_file)
+        return index, sorted(listed), sorted(ext.analyzed)
+
+    def group_names(self, index):
+        groups, _ = index.get_files_by_groups()
+        return [sorted(os.path.basename(entry.current_name) for entry in entries) for entries in groups.values()]
+
+    def test_unchanged_tree(self):
+        _, listed, analyzed = self.build_index()
+        self.assertEqual(listed, [".", "sub1", "sub1/deep", "sub2"])
+        self.assertEqual(analyzed, ["a", "b", "c", "d"])
+
+        index, listed, analyzed = self.build_index()
+        self.assertEqual(listed, [])
+        self.assertEqual(analyzed, [])
+        self.assertEqual(index.get_size(), 4)
+        self.assertTrue(all(isinstance(entry, SnapshotEntry) for entry in
+                            TreeWalker(snapshot=Snapshot.load(self.snapshot_file, [])).walk(self.tree)))
+        self.assertEqual(self.group_names(index), [["a", "b"]])
+
+    def test_changed_tree(self):
+        self.build_index()
+        with open(os.path.join(self.tree, "sub2", "e"), "w") as f:
+            f.write("same")
+        with open(os.path.join(self.tree, "sub1", "deep", "c"), "w") as f:
+            f.write("changed")
+        self.set_old_mtimes()
+        os.utime(os.path.join(self.tree, "sub2"), (2000000, 2000000))
+
+        index, listed, analyzed = self.build_index()
+        self.assertEqual(listed, ["sub2"])
+        # The file changed in place is analyzed again, although its directory is not listed
+        self.assertEqual(analyzed, ["c", "e"])
+        self.assertEqual(self.group_names(index), [["a", "b", "e"]])
+
+    def test_corrupted_snapshot(self):
+        os.makedirs(os.path.dirname(self.snapshot_file))
+        with open(self.snapshot_file, "wb") as f:
+            f.write(b"garbage")
+        _, listed, _ = self.build_index()
+        self.assertEqual(len(listed), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import json
+import os
+import tempfile
+from time import sleep
+from stats import Statistics
+
+
+class TestStatistics(unittest.TestCase):
+
+    def test_disabled(self):
+        stats = Statistics()
+        with stats.phase("scan"):
+            pass
+        stats.start_sampling("queue", lambda: 1)
+        stats.stop_sampling("queue")
+        report = stats.get_report()
+        self.assertEqual(report["phases"], {})
+        self.assertEqual(report["queues"], {})
+
+    def test_enabled(self):
+        stats = Statistics()
+        stats.enable()
+        for _ in range(2):
+            with stats.phase("scan"):
+                sleep(0.01)
+        stats.count("files.added")
+        stats.count("files.added", 2)
+        stats.add_time("df.after_file_added", 0.5)
+        stats.add_time("df.after_file_added", 0.25)
+
+        depth = [5]
+        stats.SAMPLING_INTERVAL = 0.01
+        stats.start_sampling("queue", lambda: depth[0])
+        sleep(0.05)
+        depth[0] = 0
+        stats.stop_sampling("queue")
+
+        report = stats.get_report()
+        self.assertEqual(report["phases"]["scan"]["count"], 2)
+        self.assertGreaterEqual(report["phases"]["scan"]["wall"], 0.02)
+        self.assertEqual(report["counters"], {"files.added": 3})
+        self.assertEqual(report["timers"]["df.after_file_added"], {"total": 0.75, "calls": 2})
+        self.assertEqual(report["queues"]["queue"]["max"], 5)
+        self.assertEqual(report["queues"]["queue"]["samples"][-1][1], 0)
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "stats.json")
+            stats.write_report(path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)["counters"], {"files.added": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import os
+import tempfile
+import threading
+from tree_walker import TreeWalker
+from walk_filter import WalkFilter, parse_size, parse_time
+
+
+class TestTreeWalker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for path in ["a.txt", "sub1/b.txt", "sub1/deep/c.txt", "sub2/d.txt"]:
+            full_path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, "w").close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def relpaths(self, entries):
+        return [os.path.relpath(entry.path, self.root) for entry in entries]
+
+    def test_depth_first(self):
+        walker = TreeWalker(False, TreeWalker.DEPTH_FIRST)
+        paths = self.relpaths(walker.walk(self.root))
+        self.assertEqual(sorted(paths), ["a.txt", "sub1/b.txt", "sub1/deep/c.txt", "sub2/d.txt"])
+        # the whole subtree of sub1 is yielded before moving on to its siblings
+        sub1_positions = [pos for pos, path in enumerate(paths) if path.startswith("sub1")]
+        self.assertEqual(sub1_positions[-1] - sub1_positions[0], 1)
+
+    def test_breadth_first(self):
+        walker = TreeWalker(True, TreeWalker.BREADTH_FIRST)
+        paths = self.relpaths(walker.walk(self.root))
+        self.assertEqual(len(paths), 7)
+        self.assertEqual(paths[-1], "sub1/deep/c.txt")
+
+    def test_nonrecursive(self):
+        walker = TreeWalker(False)
+        paths = self.relpaths(walker.walk(self.root, recursive=False))
+        self.assertEqual(paths, ["a.txt"])
+
+    def test_parallel_order_matches_sequential(self):
+        for subdir in range(20):
+            for name in range(5):
+                full_path = os.path.join(self.root, "many", "d%02d" % subdir, "f%d" % name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                open(full_path, "w").close()
+
+        for order in TreeWalker.ALL_ORDERS:
+            sequential = TreeWalker(True, order).walk_all([self.root], [self.root])
+            parallel = TreeWalker(True, order, num_threads=4).walk_all([self.root], [self.root])
+            self.assertEqual(self.relpaths(sequential), self.relpaths(parallel))
+
+    def test_parallel_with_nonrecursive_root(self):
+        # More subdirectories in the non-recursive root than listings fetched ahead
+        for subdir in range(300):
+            os.makedirs(os.path.join(self.root, "flat", "d%03d" % subdir))
+            os.makedirs(os.path.join(self.root, "deep", "d%03d" % subdir))
+        flat = os.path.join(self.root, "flat")
+        deep = os.path.join(self.root, "deep")
+
+        walker = TreeWalker(False, num_threads=4)
+        listed = []
+        list_directory = walker._list_directory
+
+        def recording_list_directory(directory):
+            listed.append((os.path.relpath(directory, self.root), threading.current_thread() is threading.main_thread()))
+            return list_directory(directory)
+
+        walker._list_directory = recording_list_directory
+        list(walker.walk_all([flat], [deep]))
+
+        # The subdirectories of the non-recursive root are never read
+        self.assertFalse(any(path.startswith("flat/") for path, _ in listed))
+        self.assertEqual(len([path for path, _ in listed if path.startswith("deep/")]), 300)
+        # and they do not keep the recursive root from being fetched ahead
+        listed_in_main_thread = [path for path, in_main_thread in listed if in_main_thread]
+        self.assertLess(len(listed_in_main_thread), 150)
+
+    def walk_listed(self, walk_filter, num_threads=1, order=TreeWalker.DEPTH_FIRST):
+        """
+        Returns the paths walked, and the directories listed on the way
+        """
+        walker = TreeWalker(False, order, num_threads, walk_filter)
+        listed = []
+        list_directory = walker._list_directory
+
+        def recording_list_directory(directory):
+            listed.append(os.path.relpath(directory, self.root))
+            return list_directory(directory)
+
+        walker._list_directory = recording_list_directory
+        return sorted(self.relpaths(walker.walk_all([], [self.root]))), sorted(listed)
+
+    def test_filter_patterns(self):
+        walk_filter = WalkFilter()
+        walk_filter.exclude("deep")
+        walk_filter.include("*.txt")
+        walk_filter.exclude_regex("^sub2/")
+        for num_threads in [1, 4]:
+            paths, listed = self.walk_listed(walk_filter, num_threads)
+            self.assertEqual(paths, ["a.txt", "sub1/b.txt"])
+            # Excluded subtrees are never read
+            self.assertEqual(listed, [".", "sub1"])
+
+        walk_filter = WalkFilter()
+        walk_filter.include("sub1/*/*.txt")
+        paths, _ = self.walk_listed(walk_filter)
+        self.assertEqual(paths, ["sub1/deep/c.txt"])
+
+    def test_filter_depth(self):
+        walk_filter = WalkFilter()
+        walk_filter.max_depth = 1
+        for order in TreeWalker.ALL_ORDERS:
+            paths, listed = self.walk_listed(walk_filter, order=order)
+            self.assertEqual(paths, ["a.txt", "sub1/b.txt", "sub2/d.txt"])
+            self.assertEqual(listed, [".", "sub1", "sub2"])
+
+    def test_filter_size_and_time(self):
+        with open(os.path.join(self.root, "sub1", "b.txt"), "w") as f:
+            f.write("x" * 2048)
+        os.utime(os.path.join(self.root, "a.txt"), (0, 0))
+        walk_filter = WalkFilter()
+        walk_filter.min_size = parse_size("1k")
+        paths, _ = self.walk_listed(walk_filter)
+        self.assertEqual(paths, ["sub1/b.txt"])
+
+        walk_filter = WalkFilter()
+        walk_filter.newer_than = parse_time("1970-01-02")
+        paths, _ = self.walk_listed(walk_filter)
+        self.assertEqual(paths, ["sub1/b.txt", "sub1/deep/c.txt", "sub2/d.txt"])
+
+    def test_directory_checks(self):
+        walk_filter = WalkFilter()
+        walk_filter.add_directory_check(lambda path: os.path.basename(path) != "sub1")
+        paths, listed = self.walk_listed(walk_filter, 4)
+        self.assertEqual(paths, ["a.txt", "sub2/d.txt"])
+        self.assertEqual(listed, [".", "sub2"])
+
+    def test_parse(self):
+        self.assertEqual(parse_size("10"), 10)
+        self.assertEqual(parse_size("3M"), 3 << 20)
+        self.assertEqual(parse_time("2d", now=1000000), 1000000 - 2 * 86400)
+        self.assertRaises(ValueError, parse_size, "ten")
+        self.assertRaises(ValueError, parse_time, "yesterday")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, perf_counter
+from console_output import print_status
+from stats import stats
+
+
+class TreeWalker:
+    """
+    Iterates over the directory tree using os.scandir, without recursion.
+    The file type information returned by scandir (d_type) is reused, so
+    that no additional stat calls are needed to tell directories from files.
+
+    With more than one thread, directory listings are fetched ahead of time
+    by a pool of workers, each of them spreading the subdirectories it finds
+    across the pool. The entries are still yielded in the same order as in
+    the single-threaded walk, so the resulting index is stable between runs.
+
+    With a Snapshot given, the directories that have not changed since the
+    previous run are not listed; their entries are taken from the snapshot.
+
+    A WalkFilter, if given, decides which files are yielded and which
+    directories are entered; the directories it rejects are never listed,
+    neither by the walk nor ahead of time.
+    """
+
+    DEPTH_FIRST = "depth"
+    BREADTH_FIRST = "breadth"
+    ALL_ORDERS = [DEPTH_FIRST, BREADTH_FIRST]
+
+    STATUS_INTERVAL = 0.1
+    PREFETCH_PER_THREAD = 64
+
+    def __init__(self, include_directories=False, order=DEPTH_FIRST, num_threads=1, walk_filter=None, snapshot=None):
+        assert(order in self.ALL_ORDERS)
+        self._include_directories = include_directories
+        self._filter = walk_filter if walk_filter is not None and walk_filter.is_active() else None
+        self._snapshot = snapshot
+        self._order = order
+        self._last_status_time = 0
+        self._num_threads = num_threads
+        self._executor = None
+        # {directory: (future, root)}
+        self._prefetched = {}
+        # Recursive roots whose walk has ended; no more listings are fetched for them
+        self._finished_roots = set()
+        self._prefetch_lock = Lock()
+        self._max_prefetched = num_threads * self.PREFETCH_PER_THREAD
+
+    def _report_progress(self, directory):
+        now = monotonic()
+        if now - self._last_status_time >= self.STATUS_INTERVAL:
+            print_status("Entering %s" % directory)
+            self._last_status_time = now
+
+    def _list_directory(self, directory):
+        if self._snapshot is not None:
+            return self._snapshot.list_directory(directory, self._scan_directory)
+        return self._scan_directory(directory)
+
+    def _scan_directory(self, directory):
+        """
+        Returns the list of entries in a directory. The directory handle is
+        closed before returning, so that the number of open descriptors does not
+        depend on the depth of the tree.
+        """
+        if not stats.enabled:
+            with os.scandir(directory) as it:
+                return list(it)
+
+        start = perf_counter()
+        with os.scandir(directory) as it:
+            entries = list(it)
+        stats.add_time("walk.listing", perf_counter() - start)
+        stats.count("syscalls.scandir")
+        stats.count("files.walked", len(entries))
+        return entries
+
+    def _list_and_spread(self, directory, root, depth, recursive=True):
+        entries = self._list_directory(directory)
+        # The subdirectories of a directory walked non-recursively are not entered
+        if not recursive:
+            return entries
+
+        if self._filter is None:
+            self._spread((entry.path for entry in entries if entry.is_dir()), root, depth + 1)
+        elif self._filter.max_depth is None or depth < self._filter.max_depth:
+            self._spread((entry.path for entry in entries if entry.is_dir() and self._filter.accept_directory(entry, root)),
+                         root, depth + 1)
+        return entries
+
+    def _accept_file(self, entry, root):
+        if self._filter is None or self._filter.accept_file(entry, root):
+            return True
+        if stats.enabled:
+            stats.count("files.filtered")
+        return False
+
+    def _accept_directory(self, entry, root):
+        if self._filter is None or self._filter.accept_directory(entry, root):
+            return True
+        if stats.enabled:
+            stats.count("directories.pruned")
+        return False
+
+    def _enters(self, depth):
+        """
+        Tells whether the subdirectories found in a directory at the depth given
+        (0 for the root) are to be entered.
+        """
+        return self._filter is None or self._filter.max_depth is None or depth < self._filter.max_depth
+
+    def _spread(self, directories, root, depth, recursive=True):
+        """
+        Schedules the listing of directories on the worker pool, as long as
+        the number of listings fetched ahead stays within the limit.
+
+        Parameters:
+        directories: Paths of the directories to be listed
+        root: Root directory of the walk they were found in
+        depth: Depth of the directories below the root
+        recursive: Whether the subdirectories of the directories are to be listed too
+        """
+        with self._prefetch_lock:
+            if self._executor is None or root in self._finished_roots:
+                return
+            for directory in directories:
+                if len(self._prefetched) >= self._max_prefetched:
+                    break
+                if directory not in self._prefetched:
+                    future = self._executor.submit(self._list_and_spread, directory, root, depth, recursive)
+                    self._prefetched[directory] = (future, root)
+
+    def _listing(self, directory, root, depth, recursive=True):
+        if self._executor is None:
+            return self._list_directory(directory)
+
+        with self._prefetch_lock:
+            prefetched = self._prefetched.pop(directory, None)
+
+        if prefetched is None:
+            return self._list_and_spread(directory, root, depth, recursive)
+        return prefetched[0].result()
+
+    def _drop_prefetched(self, root):
+        """
+        Drops the listings fetched ahead for the walk from the root given, once
+        it has ended, so that they do not take the place of the listings needed
+        by the walks of other roots.
+        """
+        with self._prefetch_lock:
+            self._finished_roots.add(root)
+            for directory, (future, future_root) in list(self._prefetched.items()):
+                if future_root == root:
+                    future.cancel()
+                    del self._prefetched[directory]
+
+    def get_prefetched_count(self):
+        """
+        Returns the number of directory listings fetched ahead of time
+        """
+        return len(self._prefetched)
+
+    def walk_all(self, dirs_nonrecursive, dirs_recursive):
+        """
+        Yields the entries of all the directories specified, in the same order
+        as consecutive calls to walk() would.
+        """
+        if self._num_threads > 1:
+            self._executor = ThreadPoolExecutor(self._num_threads)
+            for directory in dirs_nonrecursive:
+                self._spread([directory], directory, 0, recursive=False)
+            for directory in dirs_recursive:
+                self._spread([directory], directory, 0)
+        try:
+            for directory in dirs_nonrecursive:
+                yield from self.walk(directory, recursive=False)
+            for directory in dirs_recursive:
+                with self._prefetch_lock:
+                    self._finished_roots.discard(directory)
+                yield from self.walk(directory)
+                if self._executor is not None:
+                    self._drop_prefetched(directory)
+        finally:
+            if self._executor is not None:
+                with self._prefetch_lock:
+                    executor = self._executor
+                    self._executor = None
+                    self._prefetched = {}
+                    self._finished_roots = set()
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def walk(self, directory, recursive=True):
+        """
+        Yields os.DirEntry objects for the files (and optionally directories)
+        found in the directory.
+
+        Parameters:
+        directory: Root directory of the walk
+        recursive: If False, subdirectories are not entered
+        """
+        if not recursive:
+            for entry in self._listing(directory, directory, 0, recursive=False):
+                if entry.is_dir():
+                    if self._include_directories and self._accept_directory(entry, directory):
+                        yield entry
+                elif self._accept_file(entry, directory):
+                    yield entry
+        elif self._order == self.DEPTH_FIRST:
+            yield from self._walk_depth_first(directory)
+        else:
+            yield from self._walk_breadth_first(directory)
+
+    def _walk_depth_first(self, directory):
+        self._report_progress(directory)
+        stack = [iter(self._listing(directory, directory, 0))]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+
+            if entry.is_dir():
+                if not self._accept_directory(entry, directory):
+                    continue
+                if self._include_directories:
+                    yield entry
+                depth = len(stack) - 1
+                if self._enters(depth):
+                    self._report_progress(entry.path)
+                    stack.append(iter(self._listing(entry.path, directory, depth + 1)))
+            elif self._accept_file(entry, directory):
+                yield entry
+
+    def _walk_breadth_first(self, directory):
+        pending = deque([(directory, 0)])
+        while pending:
+            current_dir, depth = pending.popleft()
+            self._report_progress(current_dir)
+            for entry in self._listing(current_dir, directory, depth):
+                if entry.is_dir():
+                    if not self._accept_directory(entry, directory):
+                        continue
+                    if self._include_directories:
+                        yield entry
+                    if self._enters(depth):
+                        pending.append((entry.path, depth + 1))
+                elif self._accept_file(entry, directory):
+                    yield entry
@@ -0,0 +1,217 @@
+import os
+import re
+from datetime import datetime
+from fnmatch import translate
+from time import time
+
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+_SIZE_FORMAT = re.compile(r"^(\d+)([kmgt]?)b?$", re.IGNORECASE)
+_AGE_FORMAT = re.compile(r"^(\d+)([smhdw])$")
+
+
+def parse_size(value):
+    """
+    Parses a size given in bytes, optionally with a unit: k, M, G or T
+    (powers of 1024), like "10M".
+
+    Returns:
+    int:Size in bytes
+    """
+    match = _SIZE_FORMAT.match(value.strip())
+    if match is None:
+        raise ValueError("Incorrect size: %s" % value)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def parse_time(value, now=None):
+    """
+    Parses a point in time given either as an age relative to now, like "30d"
+    (units: s, m, h, d, w), or as an ISO 8601 date or date and time.
+
+    Returns:
+    float:Timestamp
+    """
+    match = _AGE_FORMAT.match(value.strip())
+    if match is not None:
+        return (time() if now is None else now) - int(match.group(1)) * AGE_UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        raise ValueError("Incorrect time: %s" % value)
+
+
+class _Glob:
+    """
+    Compiled glob pattern. Patterns containing a path separator are matched
+    against the path relative to the root of the walk, the other ones against
+    the name only.
+    """
+
+    __slots__ = ("_match", "_whole_path")
+
+    def __init__(self, pattern):
+        self._whole_path = os.sep in pattern
+        self._match = re.compile(translate(pattern.strip(os.sep) if self._whole_path else pattern)).match
+
+    def matches(self, name, relative_path):
+        return self._match(relative_path if self._whole_path else name) is not None
+
+
+class WalkFilter:
+    """
+    Decides which files are yielded by the walk and which directories are
+    entered. The excluded directories are not listed at all, so none of the
+    files below them is read.
+
+    The methods may be called from several threads at once, when the listings
+    are fetched in parallel.
+
+    Attributes:
+    max_depth: Number of levels of subdirectories entered below the root of
+               the walk; 0 means only the files in the root. None for no limit.
+    one_filesystem: Do not enter directories on other filesystems than the root
+    min_size, max_size: Range of file sizes, in bytes, or None
+    newer_than, older_than: Range of file modification times, as timestamps, or None
+    """
+
+    def __init__(self):
+        self._include_globs = []
+        self._exclude_globs = []
+        self._include_regexes = []
+        self._exclude_regexes = []
+        self._directory_checks = []
+        self._root_devices = {}
+        self.max_depth = None
+        self.one_filesystem = False
+        self.min_size = None
+        self.max_size = None
+        self.newer_than = None
+        self.older_than = None
+
+    def include(self, pattern):
+        """
+        Adds a glob pattern; if any are added, only the files matching one of
+        them are yielded.
+        """
+        self._include_globs.append(_Glob(pattern))
+
+    def exclude(self, pattern):
+        """
+        Adds a glob pattern of the files and directories to be skipped.
+        """
+        self._exclude_globs.append(_Glob(pattern))
+
+    def include_regex(self, expression):
+        """
+        Adds a regular expression searched for in the paths relative to the root;
+        if any are added, only the files matching one of them are yielded.
+        """
+        self._include_regexes.append(re.compile(expression).search)
+
+    def exclude_regex(self, expression):
+        """
+        Adds a regular expression searched for in the paths relative to the root
+        of the files and directories to be skipped.
+        """
+        self._exclude_regexes.append(re.compile(expression).search)
+
+    def add_directory_check(self, check):
+        """
+        Adds a function called with the path of each directory before it is
+        entered, returning False if the directory is to be skipped.
+        """
+        self._directory_checks.append(check)
+
+    def is_active(self):
+        """
+        Tells whether the filter may reject anything
+        """
+        return (len(self._include_globs) + len(self._exclude_globs) + len(self._include_regexes) +
+                len(self._exclude_regexes) + len(self._directory_checks) > 0 or
+                self.max_depth is not None or self.one_filesystem or
+                self.min_size is not None or self.max_size is not None or
+                self.newer_than is not None or self.older_than is not None)
+
+    def _is_excluded(self, entry, relative_path, is_directory=False):
+        for glob in self._exclude_globs:
+            if glob.matches(entry.name, relative_path):
+                return True
+        # The paths of directories end with the separator for the regular
+        # expressions, so that "^build/" excludes the directory itself
+        if is_directory:
+            relative_path += os.sep
+        for search in self._exclude_regexes:
+            if search(relative_path) is not None:
+                return True
+        return False
+
+    def _get_root_device(self, root):
+        device = self._root_devices.get(root)
+        if device is None:
+            device = os.stat(root).st_dev
+            self._root_devices[root] = device
+        return device
+
+    def accept_directory(self, entry, root):
+        """
+        Tells whether the directory found in the walk from the root given is to
+        be entered (and yielded, if directories are yielded).
+
+        Parameters:
+        entry: os.DirEntry of the directory
+        root: Root directory of the walk
+        """
+        if self._is_excluded(entry, _get_relative_path(entry, root), True):
+            return False
+        if self.one_filesystem:
+            try:
+                if entry.stat().st_dev != self._get_root_device(root):
+                    return False
+            except OSError:
+                return False
+        for check in self._directory_checks:
+            if not check(entry.path):
+                return False
+        return True
+
+    def accept_file(self, entry, root):
+        """
+        Tells whether the file found in the walk from the root given is to be
+        yielded.
+
+        Parameters:
+        entry: os.DirEntry of the file
+        root: Root directory of the walk
+        """
+        relative_path = _get_relative_path(entry, root)
+        if self._is_excluded(entry, relative_path):
+            return False
+
+        if len(self._include_globs) > 0 or len(self._include_regexes) > 0:
+            included = any(glob.matches(entry.name, relative_path) for glob in self._include_globs) or \
+                any(search(relative_path) is not None for search in self._include_regexes)
+            if not included:
+                return False
+
+        if self.min_size is not None or self.max_size is not None or \
+                self.newer_than is not None or self.older_than is not None:
+            try:
+                stat_result = entry.stat()
+            except OSError:
+                # Left for the file checks of the index to report
+                return True
+            if self.min_size is not None and stat_result.st_size < self.min_size:
+                return False
+            if self.max_size is not None and stat_result.st_size > self.max_size:
+                return False
+            if self.newer_than is not None and stat_result.st_mtime < self.newer_than:
+                return False
+            if self.older_than is not None and stat_result.st_mtime > self.older_than:
+                return False
+        return True
+
+
+def _get_relative_path(entry, root):
+    return entry.path[len(root):].lstrip(os.sep)